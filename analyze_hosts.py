@@ -3,30 +3,41 @@ This file will be used to analyze which companies host the urls posted on subred
 '''
 
 import sqlite3
+import combine
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
 
-def extract_data(subreddit):
+GROUPING_COLUMNS = {'Domain': 'domain', 'Company': 'org_name', 'State-Province': 'state_prov'}
+
+
+def extract_data(subreddit, grouping=None):
     '''
-    A Function to extract relevant information from analysis.sql database
+    A Function to extract relevant information from analysis.sql database. Reads the host_rollup
+    table, which combine.go keeps up to date, after bringing it up to date with anything written
+    since.
 
     Inputs:
         subreddit: (str) the name of the subreddit (without /r) which will be used for analysis
+        grouping: (str) optional attribute ('Company', 'Domain' or 'State-Province') to sum by in
+            SQL, so only one row per group is read; by default all three are kept
     Returns: (pd DataFrame) a dataframe of the data extracted from the database
     '''
+    combine.migrate('data/analysis.sql', combine.ANALYSIS_MIGRATIONS)
+    combine.refresh_host_rollup('data/analysis.sql')
     connection = sqlite3.connect('data/analysis.sql')
     cursor = connection.cursor()
-    command = '''SELECT SUM(a.ip_weight) AS weighted, b.subreddit, a.domain, a.org_name, a.state_prov
-                 FROM analysis_ips AS a INNER JOIN analysis_urls AS b ON a.url_id = b.url_id
-                 WHERE b.subreddit = ? GROUP BY b.subreddit, a.domain, a.org_name, a.state_prov'''
+    groups = [GROUPING_COLUMNS[grouping]] if grouping is not None else \
+        ['domain', 'org_name', 'state_prov']
+    command = f'''SELECT SUM(weighted) AS weighted, subreddit, {', '.join(groups)}
+                 FROM host_rollup WHERE subreddit = ? GROUP BY subreddit, {', '.join(groups)}'''
     filter = [subreddit]
     cursor.execute(command, filter)
     table = cursor.fetchall()
-    df = pd.DataFrame(table)
-    df.columns = ['Weighted', 'Subreddit', 'Domain', 'Company', 'State-Province']
-    return df
+    connection.close()
+    names = {column: name for name, column in GROUPING_COLUMNS.items()}
+    return pd.DataFrame(table, columns=['Weighted', 'Subreddit'] + [names[col] for col in groups])
 
 
 def clean_data(df, grouping='Company'):
@@ -45,7 +56,7 @@ def clean_data(df, grouping='Company'):
     filtered_df = data[filt]
     #filtered_df.drop(labels="", inplace=True)
     other = pd.Series([sum(data.values) - sum(filtered_df.values)], index=["Other"])
-    return filtered_df.append(other)
+    return pd.concat([filtered_df, other])
 
 
 def build_chart(quar_df, quar_subreddit, compare_df, compare_subreddit, grouping='Company'):
@@ -85,8 +96,8 @@ def go(quar_subreddit, compare_subreddit, grouping="Company"):
         grouping: (str) The category the data is grouped by. Defaults to Company but user can also select
             Domain or State/Province 
     '''
-    df = extract_data(quar_subreddit)
-    df_2 = extract_data(compare_subreddit)
+    df = extract_data(quar_subreddit, grouping)
+    df_2 = extract_data(compare_subreddit, grouping)
     cleaned_data = clean_data(df, grouping)
     cleaned_2 = clean_data(df_2, grouping)
     return build_chart(cleaned_data, quar_subreddit, cleaned_2, compare_subreddit, grouping)
\ No newline at end of file
@@ -3,28 +3,52 @@ This program will be used to analyze the spread of urls between related subreddi
 '''
 
 import sqlite3
+import multiprocessing
+import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 import datetime as dt
+import functools
+import combine
+import url_index
 
+QUARANTINED = ['TheRedPill', 'The_Donald', 'FULLCOMMUNISM', 'watchpeopledie']
+INSERT_SPREAD = '''INSERT OR REPLACE INTO {table}
+    (main_subreddit, compare_subreddit, quar_date, day, rate) VALUES (?, ?, ?, ?, ?)'''
+# tables spread_matrix saves to, matching urls as posted and by canonical url
+SPREAD_TABLES = {False: 'spread_daily', True: 'spread_daily_canonical'}
 
-def extract_data(subreddit):
+# subreddit DataFrames shared with the spread_matrix worker processes
+_frames = {}
+
+
+def extract_data(subreddit, start_date=None, end_date=None):
     '''
     A Function to extract relevant information from analysis.sql database
 
     Inputs:
         subreddit: (str) the name of the subreddit (without /r) which will be used for analysis
+        start_date: (dt DateTime) optional earliest post date to read
+        end_date: (dt DateTime) optional latest post date to read
 
     Returns: (pd DataFrame) a dataframe of the data extracted from the database
     '''
     connection = sqlite3.connect('data/analysis.sql')
     cursor = connection.cursor()
     command = '''SELECT url_text AS url, domain, post_date FROM analysis_urls WHERE subreddit = ?'''
-    cursor.execute(command, [subreddit])
+    params = [subreddit]
+    # post_date is stored as a unix timestamp, so the window is filtered by the
+    # (subreddit, post_date) index instead of in pandas
+    if start_date is not None:
+        command += ' AND post_date >= ?'
+        params.append(int(start_date.replace(tzinfo=dt.timezone.utc).timestamp()))
+    if end_date is not None:
+        command += ' AND post_date <= ?'
+        params.append(int(end_date.replace(tzinfo=dt.timezone.utc).timestamp()))
+    cursor.execute(command, params)
     table = cursor.fetchall()
-    df = pd.DataFrame(table)
-    df.columns = ['url', 'domain', 'post_date']
+    df = pd.DataFrame(table, columns=['url', 'domain', 'post_date'])
     df['post_date'] = pd.to_datetime(df['post_date'], unit='s')
     return df
 
@@ -52,11 +76,19 @@ def build_comparison_dict(subreddit_df, window_start, window_end):
     return comparison_dict
 
 
-def calc_daily_spread(main_subreddit, compare_subreddit, start_date, end_date):
+def calc_daily_spread(main_subreddit, compare_subreddit, start_date, end_date, canonical=False):
     '''
     A function to calculate the percentage of URLs that 'spillover' to an adjacent subreddit during
     the analysis period.
 
+    For each day, the main subreddit posts from the day before to the day after are checked for
+    the same domain and url on the comparison subreddit within three days of the start of the day.
+    All days are computed at once: every main post is paired with the (at most two) days whose
+    window it falls in, and each pair is matched to the next comparison post with the same
+    domain and url using a sorted as-of merge. With canonical, urls match on
+    url_index.canonical_url instead, so the same page posted with or without 'www.', a trailing
+    slash or tracking parameters counts as spread.
+
     Inputs:
         main_subreddit: (str) The main subreddit of interest - should be a quarantined subreddit
         compare_subreddit: (str) The adjacent subreddit against which we can compare spread
@@ -64,34 +96,97 @@ def calc_daily_spread(main_subreddit, compare_subreddit, start_date, end_date):
             quarantine date
         end_date: (dt DateTime) The end date of the analysis period, defined as 6 weeks before the
             quarantine date
+        canonical: (bool) match urls by canonical url rather than by domain and url as posted
     
     Returns: (dict) A dictionary whose keys are each day in the analysis period and whose values are
         the daily rates of spread on the comparison url
     '''
+    n_days = max((end_date - start_date).days, 0)
+    day = 86400 * 10**9
+    start = np.datetime64(start_date, 'ns').astype('int64')
+
+    main = main_subreddit[main_subreddit['post_date'].notna()]
+    compare = compare_subreddit[compare_subreddit['post_date'].notna()]
+    if canonical:
+        # one code per canonical url shared by both subreddits
+        keys = pd.concat([main['url'], compare['url']]).map(url_index.canonical_url,
+                                                            na_action='ignore')
+        codes = keys.groupby(keys, sort=False, dropna=False).ngroup().to_numpy()
+    else:
+        # one code per (domain, url) shared by both subreddits
+        keys = pd.concat([main[['domain', 'url']], compare[['domain', 'url']]])
+        codes = keys.groupby(['domain', 'url'], sort=False, dropna=False).ngroup().to_numpy()
+    main_codes, compare_codes = codes[:len(main)], codes[len(main):]
+    main_times = to_nanoseconds(main['post_date']) - start
+    compare_times = to_nanoseconds(compare['post_date']) - start
+
+    # a post counts towards the day it falls on and, unless it is exactly midnight, the next day
+    first_day = main_times // day
+    off_midnight = np.flatnonzero(main_times % day != 0)
+    rows = np.concatenate([np.arange(len(main)), off_midnight])
+    days = np.concatenate([first_day, first_day[off_midnight] + 1])
+    in_period = (days >= 0) & (days < n_days)
+    rows, days = rows[in_period], days[in_period]
+    totals = np.bincount(days, minlength=n_days)
+
+    found = next_post_within(main_codes[rows], days * day, compare_codes, compare_times, 3 * day)
+    counts = np.bincount(days[found], minlength=n_days)
+
     current_day = start_date
     add_day = dt.timedelta(days=1)
-    add_three_days = dt.timedelta(days=3)
     daily_dict = {}
-
-    for i in range((end_date - start_date).days):
+    for i in range(n_days):
         daily_dict[current_day] = 0
-        compare_dict = build_comparison_dict(compare_subreddit, current_day, current_day + add_three_days)
-        filt = (main_subreddit['post_date'] > current_day - add_day) & (main_subreddit['post_date'] < current_day + add_day)
-        filtered_df = main_subreddit[filt]
-        for row in filtered_df.itertuples():
-            _, url, domain, _ = row
-            urls = compare_dict.get(domain, False)
-            if type(urls) is not bool:
-                if url in urls:
-                    daily_dict[current_day] += 1
-        if daily_dict[current_day] != 0:
-            daily_dict[current_day] = daily_dict[current_day] / len(filtered_df)
+        if counts[i] != 0:
+            daily_dict[current_day] = int(counts[i]) / int(totals[i])
         current_day = current_day + add_day
-    
+
     return daily_dict
 
 
-def build_line_chart(daily_dict, quar_date, main_subreddit, compare_subreddit):
+def to_nanoseconds(dates):
+    '''
+    Converts a column of post dates to int64 nanoseconds since the epoch
+
+    Inputs:
+        dates: (pd Series) datetime column without missing values
+
+    Returns: (np array) int64 nanoseconds
+    '''
+    return dates.to_numpy().astype('datetime64[ns]').astype('int64')
+
+
+def next_post_within(codes, times, compare_codes, compare_times, window):
+    '''
+    Checks, for each query, whether the comparison subreddit has a post with the same code
+    between the query time and the query time plus the window (both inclusive)
+
+    Inputs:
+        codes: (np array) (domain, url) codes of the queries
+        times: (np array) int64 start times of the queries
+        compare_codes: (np array) (domain, url) codes of the comparison posts
+        compare_times: (np array) int64 times of the comparison posts
+        window: (int) length of the window, in the same units as the times
+
+    Returns: (np array) of bools, one per query
+    '''
+    found = np.zeros(len(codes), dtype=bool)
+    if len(codes) == 0 or len(compare_codes) == 0:
+        return found
+    queries = pd.DataFrame({'code': codes, 'time': times, 'query': np.arange(len(codes))})
+    posts = pd.DataFrame({'code': compare_codes, 'time': compare_times,
+                          'post': np.arange(len(compare_codes))})
+    merged = pd.merge_asof(queries.sort_values('time'), posts.sort_values('time'), on='time',
+                           by='code', direction='forward')
+    # post indexes instead of times come back from the merge, so the times stay exact int64
+    matched = merged['post'].notna().to_numpy()
+    query = merged['query'].to_numpy()[matched]
+    post = merged['post'].to_numpy()[matched].astype('int64')
+    found[query] = compare_times[post] <= times[query] + window
+    return found
+
+
+def build_line_chart(daily_dict, quar_date, main_subreddit, compare_subreddit, canonical=False):
     '''
     A function that builds a line chart of the analysis then saves it in the directory
 
@@ -100,6 +195,7 @@ def build_line_chart(daily_dict, quar_date, main_subreddit, compare_subreddit):
         quar_date: (dt DateTime) the date the main subreddit was quarantined
         main_subreddit: (str) the name of the quarantined subreddit
         compare_subreddit: (str) the name of the adjacent subreddit used for comparison
+        canonical: (bool) the spread matched canonical urls, saved as a separate chart
     '''
     plt.clf()
     sns.set_palette("rocket")
@@ -117,7 +213,8 @@ def build_line_chart(daily_dict, quar_date, main_subreddit, compare_subreddit):
     labels = ["Quarantine Date"]
     plt.legend(handles=handles[3:], labels=labels)
     fig = lp.get_figure()
-    fig.savefig(f'output/{main_subreddit}_{compare_subreddit}.png')
+    suffix = '_canonical' if canonical else ''
+    fig.savefig(f'output/{main_subreddit}_{compare_subreddit}{suffix}.png')
 
 
 def go(main_subreddit, compare_subreddit, quar_date):
@@ -130,12 +227,122 @@ def go(main_subreddit, compare_subreddit, quar_date):
         compare_subreddit: (str)
         quar_date: (str)
     '''
-    main = extract_data(main_subreddit)
-    compare = extract_data(compare_subreddit)
+    dt_quar, start_date, end_date = analysis_period(quar_date)
+    first, last = data_window(start_date, end_date)
+    main = extract_data(main_subreddit, first, last)
+    compare = extract_data(compare_subreddit, first, last)
+
+    daily = calc_daily_spread(main, compare, start_date, end_date)
+    build_line_chart(daily, dt_quar, main_subreddit, compare_subreddit)
+
+
+def analysis_period(quar_date):
+    '''
+    Gives the analysis period around a quarantine date
 
+    Inputs:
+        quar_date: (str) quarantine date as YYYY-MM-DD
+
+    Returns: (tuple) the quarantine date, and the start and end of the period six weeks either
+        side of it, as dt DateTimes
+    '''
     dt_quar = dt.datetime.strptime(quar_date, '%Y-%m-%d')
-    start_date = dt_quar - dt.timedelta(weeks=6)
-    end_date = dt_quar + dt.timedelta(weeks=6)
+    return dt_quar, dt_quar - dt.timedelta(weeks=6), dt_quar + dt.timedelta(weeks=6)
 
-    daily = calc_daily_spread(main, compare, start_date, end_date)
-    build_line_chart(daily, dt_quar, main_subreddit, compare_subreddit)
\ No newline at end of file
+
+def data_window(start_date, end_date):
+    '''
+    Gives the post dates calc_daily_spread can look at for an analysis period: one day before
+    it and three days past it
+
+    Inputs:
+        start_date: (dt DateTime) start of the analysis period
+        end_date: (dt DateTime) end of the analysis period
+
+    Returns: (tuple) first and last post dates to extract
+    '''
+    return start_date - dt.timedelta(days=1), end_date + dt.timedelta(days=3)
+
+
+def read_pairs(subreddits_path='data/subreddits.txt', quarantined=QUARANTINED):
+    '''
+    Pairs each quarantined subreddit with every other subreddit listed under the same
+    quarantine date
+
+    Inputs:
+        subreddits_path: (str) file of 'name,YYYY-MM-DD' lines
+        quarantined: (list of strs) the quarantined subreddits
+
+    Returns: (list of tuples) (main subreddit, compare subreddit, quarantine date)
+    '''
+    with open(subreddits_path) as links:
+        subreddits = [line.split(',') for line in links.read().split('\n') if line]
+    return [(main, compare, quar_date) for main, quar_date in subreddits if main in quarantined
+            for compare, compare_date in subreddits
+            if compare_date == quar_date and compare not in quarantined]
+
+
+def share_frames(frames):
+    '''
+    Worker process initializer that receives the subreddit DataFrames once, so they are not
+    sent again with every pair
+    '''
+    _frames.update(frames)
+
+
+def pair_spread(pair, canonical=False):
+    '''
+    Worker function that calculates the daily spread for one (main, compare, quarantine date)
+    pair from the shared subreddit DataFrames
+    '''
+    main_subreddit, compare_subreddit, quar_date = pair
+    _, start_date, end_date = analysis_period(quar_date)
+    return calc_daily_spread(_frames[main_subreddit], _frames[compare_subreddit], start_date,
+                             end_date, canonical)
+
+
+def spread_matrix(pairs=None, processes=None, charts=False, canonical=False):
+    '''
+    Calculates the daily spread for many subreddit pairs at once and saves it to the
+    spread_daily table of analysis.sql. Each subreddit is extracted once, over the union of the
+    windows of the pairs it is in, and the pairs are spread over worker processes.
+
+    Inputs:
+        pairs: (list of tuples) (main subreddit, compare subreddit, quarantine date) pairs,
+            defaults to every pair from read_pairs
+        processes: (int) number of worker processes, defaults to one per core
+        charts: (bool) also save a line chart for each pair, as go does
+        canonical: (bool) match urls by canonical url (see calc_daily_spread) and save to the
+            spread_daily_canonical table instead
+
+    Returns: (pd DataFrame) one row per pair and day, as saved in spread_daily
+    '''
+    if pairs is None:
+        pairs = read_pairs()
+    windows = {}
+    for main_subreddit, compare_subreddit, quar_date in pairs:
+        first, last = data_window(*analysis_period(quar_date)[1:])
+        for subreddit in (main_subreddit, compare_subreddit):
+            known_first, known_last = windows.get(subreddit, (first, last))
+            windows[subreddit] = (min(first, known_first), max(last, known_last))
+    frames = {subreddit: extract_data(subreddit, first, last)
+              for subreddit, (first, last) in windows.items()}
+
+    with multiprocessing.Pool(processes, initializer=share_frames, initargs=(frames,)) as pool:
+        dailies = pool.map(functools.partial(pair_spread, canonical=canonical), pairs)
+
+    rows = [(main_subreddit, compare_subreddit, quar_date, day.strftime('%Y-%m-%d'), float(rate))
+            for (main_subreddit, compare_subreddit, quar_date), daily in zip(pairs, dailies)
+            for day, rate in daily.items()]
+    combine.migrate('data/analysis.sql', combine.ANALYSIS_MIGRATIONS)
+    connection = sqlite3.connect('data/analysis.sql')
+    with connection:
+        connection.executemany(INSERT_SPREAD.format(table=SPREAD_TABLES[canonical]), rows)
+    connection.close()
+
+    if charts:
+        for (main_subreddit, compare_subreddit, quar_date), daily in zip(pairs, dailies):
+            dt_quar = analysis_period(quar_date)[0]
+            build_line_chart(daily, dt_quar, main_subreddit, compare_subreddit, canonical)
+    return pd.DataFrame(rows, columns=['main_subreddit', 'compare_subreddit', 'quar_date', 'day',
+                                       'rate'])
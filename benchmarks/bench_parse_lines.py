@@ -0,0 +1,72 @@
+'''
+Microbenchmark of url_tools.parse_lines over a corpus of saved WhoIs
+responses (ARIN, ARIN with a referral, RIPE, APNIC and RWhois), against the
+parser it replaced, which read the bytes repr that subprocess returned.
+
+Usage: python benchmarks/bench_parse_lines.py [response directory]
+'''
+
+import os
+import re
+import sys
+import glob
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import url_tools
+
+RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'whois_responses')
+# the whois_keys combine.go asks for, plus the block keys ip_whois adds
+GO_KEYS = {'OrgName', 'City', 'StateProv', 'Country', 'RegDate'} | \
+    url_tools.WHOIS_BLOCK_KEYS
+
+
+def parse_lines_before(whois_stdout):
+    '''
+    The original parser, kept here as the baseline.
+    '''
+    line_dict = {}
+    for line in str(whois_stdout).split('\\n'):
+        if re.search(':', line) and not re.match('#', line):
+            field = re.search('.*?(?=:)', line).group()
+            val = re.search(r'(?<=:)(?:\s*)(.*)', line).groups()[0]
+            if not re.match('Comment:', field):
+                line_dict[field] = val
+    if line_dict == {}:
+        return None
+    return line_dict
+
+
+def per_response(function, corpus, number):
+    '''
+    Output:
+        (float) microseconds per response, best of five runs
+    '''
+    runs = timeit.repeat(lambda: [function(text) for text in corpus],
+        number = number, repeat = 5)
+    return min(runs) / number / len(corpus) * 1e6
+
+
+def main(directory = RESPONSES, number = 200):
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.txt'))):
+        with open(path, encoding = 'utf-8') as fh:
+            corpus.append(fh.read())
+    # the old parser was handed check_output's bytes
+    as_bytes = [text.encode('utf-8') for text in corpus]
+    lines = sum(len(text.splitlines()) for text in corpus)
+    print(f'{len(corpus)} responses, {lines} lines')
+    before = per_response(parse_lines_before, as_bytes, number)
+    every_key = per_response(url_tools.parse_lines, corpus, number)
+    go_keys = per_response(
+        lambda text: url_tools.parse_lines(text, GO_KEYS), corpus, number)
+    print(f'before:                 {before:8.1f} us per response')
+    print(f'after, every key:       {every_key:8.1f} us per response '
+        f'({before / every_key:.1f}x)')
+    print(f'after, combine.go keys: {go_keys:8.1f} us per response '
+        f'({before / go_keys:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,148 @@
+'''
+Memory benchmark of the records combine.go passes between its stages:
+bytes held per enriched url, measured with tracemalloc, for the UrlRecords
+of records.py against the per-url dicts they replaced.
+
+Each synthetic url is posted on one of a few subreddits and resolves to two
+IP addresses out of a shared pool. Each address has a WhoIs response parsed
+from the saved responses in benchmarks/whois_responses. The dicts get a copy
+of each parsed response, as ip_whois hands back a fresh json.loads of the
+cache for every url, while the UrlRecords share one WhoisRecord per
+address. Strings are made afresh for every url, as sqlite3 and the lookups
+return them.
+
+Usage: python benchmarks/bench_records_memory.py [number of urls]
+'''
+
+import os
+import sys
+import glob
+import json
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import records
+import url_tools
+
+RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'whois_responses')
+# combine.go's default whois_keys
+WHOIS_KEYS = ['OrgName', 'City', 'StateProv', 'Country', 'RegDate']
+SUBREDDITS = ['TheRedPill', 'MGTOW', 'MensRights', 'Conservative',
+    'LateStageCapitalism', 'FULLCOMMUNISM']
+IPS = 500
+DOMAINS = 300
+
+
+def fresh(text):
+    '''
+    A copy of a string that is not the same object, like one read from
+    sqlite.
+    '''
+    return text.encode('utf-8').decode('utf-8')
+
+
+def parsed_responses():
+    '''
+    Output:
+        (list of strs) parsed WhoIs responses as json, as the cache holds
+        them
+    '''
+    keys = set(WHOIS_KEYS) | url_tools.WHOIS_BLOCK_KEYS
+    parsed = []
+    for path in sorted(glob.glob(os.path.join(RESPONSES, '*.txt'))):
+        with open(path, encoding = 'utf-8') as fh:
+            parsed.append(json.dumps(url_tools.parse_lines(fh.read(), keys)))
+    return parsed
+
+
+def urls(count, seed = 0):
+    '''
+    Output:
+        (list of tuples) (url_id, url, subreddit, post date, post id, domain
+        number, ip numbers) for each synthetic url
+    '''
+    rnd = random.Random(seed)
+    return [(f'{rnd.getrandbits(128):032x}',
+        f'https://site{i % DOMAINS}.com/story/{i}-{rnd.getrandbits(32):x}',
+        rnd.choice(SUBREDDITS), 1550000000 + rnd.randrange(86400 * 84),
+        f'{rnd.getrandbits(32):x}', i % DOMAINS,
+        rnd.sample(range(IPS), 2)) for i in range(count)]
+
+
+def address(number):
+    return f'104.{number // 250}.{number % 250}.{number % 7 + 1}'
+
+
+def enriched_dicts(rows, whois):
+    '''
+    Output:
+        (list of dicts) urls as the stages left them before records.py
+    '''
+    chunk = []
+    for url_id, url, subreddit, date, post_id, domain, ips in rows:
+        row = {'url_id': fresh(url_id), 'url': fresh(url),
+            'subreddit': fresh(subreddit), 'date': date,
+            'post_id': fresh(post_id), 'checkpoint': fresh(subreddit)}
+        row['eff_url'] = row['url']
+        row['domain'] = f'site{domain}.com'
+        row['ips'] = [address(number) for number in ips]
+        row['whois'] = [(ip, json.loads(whois[number % len(whois)]))
+            for ip, number in zip(row['ips'], ips)]
+        chunk.append(row)
+    return chunk
+
+
+def enriched_records(rows, whois):
+    '''
+    Output:
+        (list of UrlRecords) urls as the stages leave them now
+    '''
+    keys = tuple(records.intern(key) for key in WHOIS_KEYS)
+    whois_records = {}
+    chunk = []
+    for url_id, url, subreddit, date, post_id, domain, ips in rows:
+        record = records.UrlRecord(fresh(url_id), fresh(url),
+            fresh(subreddit), date, fresh(post_id), fresh(subreddit))
+        record.eff_url = record.url
+        record.set_domain(f'site{domain}.com')
+        record.hosts = [records.ResolvedHost(address(number))
+            for number in ips]
+        for host, number in zip(record.hosts, ips):
+            if number not in whois_records:
+                whois_records[number] = records.WhoisRecord.from_parsed(
+                    json.loads(whois[number % len(whois)]), keys)
+            host.whois = whois_records[number]
+        chunk.append(record)
+    return chunk
+
+
+def bytes_per_url(build, rows, whois):
+    '''
+    Output:
+        (float) bytes still allocated per url once build has returned
+    '''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    chunk = build(rows, whois)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del chunk
+    return (after - before) / len(rows)
+
+
+def main(count = 20000):
+    count = int(count)
+    whois = parsed_responses()
+    rows = urls(count)
+    print(f'{count} urls, 2 addresses each out of {IPS}, '
+        f'{len(whois)} WhoIs responses')
+    before = bytes_per_url(enriched_dicts, rows, whois)
+    after = bytes_per_url(enriched_records, rows, whois)
+    print(f'dicts:      {before:8.0f} bytes per url')
+    print(f'UrlRecords: {after:8.0f} bytes per url ({before / after:.1f}x less)')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,112 @@
+'''
+Benchmark of analyze_spread.calc_daily_spread, the vectorized pass over every
+day of the analysis period, against the per-day loop it replaced, on
+synthetic subreddit pairs at 1x, 10x and 100x the volume of the scraped
+data (about 10,000 urls per subreddit over the twelve week period, as in
+data/MGTOW.sql and data/Conservative.sql).
+
+The posts use a skewed mix of domains and a shared pool of urls, so a share
+of the main subreddit's links also turn up on the comparison subreddit.
+Both versions must give bit-identical daily rates of the same types. The loop takes minutes at
+100x, so by default it is only timed up to 10x.
+
+Usage: python benchmarks/bench_spread.py [largest scale to time the loop at]
+'''
+
+import os
+import sys
+import time
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import analyze_spread
+
+SCALES = (1, 10, 100)
+URLS_PER_SUBREDDIT = 10000
+QUAR_DATE = '2019-01-24'
+
+
+def calc_daily_spread_before(main_subreddit, compare_subreddit, start_date, end_date):
+    '''
+    The original per-day loop, kept here as the baseline.
+    '''
+    current_day = start_date
+    add_day = dt.timedelta(days=1)
+    add_three_days = dt.timedelta(days=3)
+    daily_dict = {}
+
+    for i in range((end_date - start_date).days):
+        daily_dict[current_day] = 0
+        compare_dict = analyze_spread.build_comparison_dict(compare_subreddit, current_day,
+                                                            current_day + add_three_days)
+        filt = (main_subreddit['post_date'] > current_day - add_day) & \
+            (main_subreddit['post_date'] < current_day + add_day)
+        filtered_df = main_subreddit[filt]
+        for row in filtered_df.itertuples():
+            _, url, domain, _ = row
+            urls = compare_dict.get(domain, False)
+            if type(urls) is not bool:
+                if url in urls:
+                    daily_dict[current_day] += 1
+        if daily_dict[current_day] != 0:
+            daily_dict[current_day] = daily_dict[current_day] / len(filtered_df)
+        current_day = current_day + add_day
+
+    return daily_dict
+
+
+def synthetic_subreddit(rng, size, first, last, domains, urls_per_domain):
+    '''
+    Returns: (pd DataFrame) url, domain and post_date columns, as extract_data gives them
+    '''
+    # a few domains get most of the links, as on the scraped subreddits
+    domain = rng.zipf(1.5, size) % domains
+    url = rng.integers(0, urls_per_domain, size)
+    seconds = rng.integers(int(first.timestamp()), int(last.timestamp()), size)
+    return pd.DataFrame({'url': [f'https://d{d}.com/{u}' for d, u in zip(domain, url)],
+                         'domain': [f'https://d{d}.com' for d in domain],
+                         'post_date': pd.to_datetime(seconds, unit='s')})
+
+
+def timed(function, *args):
+    '''
+    Returns: (tuple) the function's result and its run time in seconds
+    '''
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def main(loop_up_to=10):
+    loop_up_to = float(loop_up_to)
+    _, start_date, end_date = analyze_spread.analysis_period(QUAR_DATE)
+    # as utc, since extract_data reads unix timestamps
+    first, last = [day.replace(tzinfo=dt.timezone.utc)
+                   for day in analyze_spread.data_window(start_date, end_date)]
+    for scale in SCALES:
+        rng = np.random.default_rng(scale)
+        size = URLS_PER_SUBREDDIT * scale
+        # the url pool grows with the volume, so the share of urls that spread stays alike
+        main_df, compare_df = [synthetic_subreddit(rng, size, first, last, 1500, 20 * scale)
+                               for _ in range(2)]
+        after, vectorized = timed(analyze_spread.calc_daily_spread, main_df, compare_df,
+                                  start_date, end_date)
+        line = f'{scale:4d}x, {size:8d} urls per subreddit: vectorized {vectorized:8.3f} s'
+        if scale <= loop_up_to:
+            before, loop = timed(calc_daily_spread_before, main_df, compare_df, start_date,
+                                 end_date)
+            # bit-identical rates, with the same types: int 0 on days without spread and
+            # Python floats, not numpy scalars, otherwise
+            assert list(before) == list(after), f'days differ at {scale}x'
+            assert before == after, f'daily rates differ at {scale}x'
+            assert [type(rate) for rate in before.values()] == \
+                [type(rate) for rate in after.values()], f'rate types differ at {scale}x'
+            line += f', loop {loop:8.3f} s ({loop / vectorized:.0f}x)'
+        print(line)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
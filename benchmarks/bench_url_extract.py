@@ -0,0 +1,131 @@
+'''
+Throughput benchmark of url_extract.post_links, the one-pass link
+extraction extract_rows uses, against the regexes scraper.py ran per post
+before it, over post bodies.
+
+Given a Pushshift submissions dump (RS_*.zst or NDJSON) the posts are read
+from it. Otherwise they are rebuilt from the urls in the scraped subreddit
+databases under data/: each post gets its scraped links back, text links as
+markdown inside a few sentences of prose and media links as its url, since
+the databases keep the links but not the rest of the post.
+
+Usage: python benchmarks/bench_url_extract.py [dump path] [most posts]
+'''
+
+import os
+import re
+import sys
+import glob
+import random
+import sqlite3
+import itertools
+import collections
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import post_stream
+import url_extract
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'data')
+PROSE = ('Saw this earlier today and thought it belonged here. ',
+    'The whole thread is worth a read, especially the replies. ',
+    'Source below, judge for yourselves. ',
+    'Not sure what to make of it but here it is. ',
+    'Edit: fixed the link, thanks to everyone who pointed it out. ')
+
+
+def post_links_before(post):
+    '''
+    The extraction scraper.py used to run per post, kept here as the
+    baseline, returning what it inserted instead of inserting it.
+    '''
+    links = []
+    if 'selftext' in post:
+        domain_links = re.findall(r'\(https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+',
+            post['selftext'])
+        domain_links = [re.sub('[()]', '', x) for x in domain_links]
+        all_links = re.findall(r'\(https?://[^\s]+\)', post['selftext'])
+        all_links = [re.sub('[()]', '', x) for x in all_links]
+        for ind, link in enumerate(all_links):
+            if 'redd.it' not in link and 'reddit.com' not in link:
+                links.append((link, domain_links[ind], 'text'))
+    all_links = re.findall(r'https?://[^\s]+', post['url'])
+    for a_link in all_links:
+        if 'redd.it' not in a_link and 'reddit.com' not in a_link:
+            domain_link = re.findall(
+                r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+', a_link)
+            links.append((a_link, domain_link[0], 'media'))
+    return links
+
+
+def dump_posts(path, most):
+    '''
+    Output:
+        (list of dicts) the first most posts of a dump, as the scraper sees
+        them
+    '''
+    return [post_stream.project(post_stream.loads(line))
+        for line in itertools.islice(post_stream.iter_lines(path), most)]
+
+
+def rebuilt_posts(most, seed = 0):
+    '''
+    Output:
+        (list of dicts) up to most posts rebuilt from data/*.sql
+    '''
+    rnd = random.Random(seed)
+    links = collections.defaultdict(lambda: {'text': [], 'media': []})
+    for path in sorted(glob.glob(os.path.join(DATA, '*.sql'))):
+        try:
+            with sqlite3.connect(path) as connection:
+                rows = connection.execute('''SELECT post_id, url_type,
+                    url_text FROM urls''').fetchall()
+        except sqlite3.DatabaseError:
+            # analysis.sql and other stores without a urls table
+            continue
+        for post_id, url_type, url_text in rows:
+            if url_type in ('text', 'media'):
+                links[post_id][url_type].append(url_text)
+    posts = []
+    for post_id, found in itertools.islice(links.items(), most):
+        text = []
+        for link in found['text']:
+            text += rnd.sample(PROSE, 2)
+            text.append(f'[link]({link}) ')
+        if text:
+            text += rnd.sample(PROSE, rnd.randint(0, 3))
+        url = found['media'][0] if found['media'] else \
+            f'https://www.reddit.com/r/sub/comments/{post_id}/'
+        posts.append({'id': post_id, 'created_utc': 0,
+            'selftext': ''.join(text), 'url': url})
+    return posts
+
+
+def per_second(function, posts, number = 3):
+    '''
+    Output:
+        (float) posts per second, best of five runs
+    '''
+    runs = timeit.repeat(lambda: [function(post) for post in posts],
+        number = number, repeat = 5)
+    return len(posts) * number / min(runs)
+
+
+def main(path = None, most = 100000):
+    most = int(most)
+    posts = dump_posts(path, most) if path else rebuilt_posts(most)
+    size = sum(len(post.get('selftext', '')) + len(post['url'])
+        for post in posts)
+    print(f'{len(posts)} posts, {size / 2 ** 20:.1f} MiB of text and urls')
+    differ = sum(post_links_before(post) != url_extract.post_links(post)
+        for post in posts)
+    print(f'posts whose links differ: {differ}')
+    before = per_second(post_links_before, posts)
+    after = per_second(url_extract.post_links, posts)
+    print(f'before: {before:10.0f} posts per second')
+    print(f'after:  {after:10.0f} posts per second ({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
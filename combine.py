@@ -3,114 +3,678 @@ This file will be used to combine the scaper.py output and the url_tools.py file
 '''
 
 import url_tools
+import scraper
+import domain_cache
+import url_index
+import records
 import sqlite3
+import collections
+import queue
+import threading
+import time
+import traceback
 import pandas as pd
 
-def sql_to_pd(db_path, tab_name):
+# columns with few distinct values, loaded as categoricals
+CATEGORY_COLUMNS = {'subreddit', 'subreddit_name', 'domain', 'url_domain',
+    'url_type', 'org_name', 'city', 'state_prov', 'country'}
+# columns holding unix timestamps
+DATE_COLUMNS = {'post_date'}
+
+def read_table(db_path, tab_name, columns = None, where = None, params = (),
+    chunksize = 50000, dates = 'int64'):
+    '''
+    Reads a sql table from a database as a stream of typed DataFrames, so
+    that only one chunk of the table is held in memory at a time.
+
+    Inputs:
+        db_path: (str) path to sql database
+        tab_name: (str) name of desired table
+        columns: (list of strs, or None) columns to read, None for all
+        where: (str, or None) SQL condition rows must meet, with ?
+            placeholders, e.g. 'post_date >= ?'
+        params: (sequence) values for the placeholders in where
+        chunksize: (int) number of rows per DataFrame
+        dates: (str) 'int64' to keep timestamp columns as unix seconds, or
+            'datetime' to convert them to datetime64
+
+    Output:
+        (generator of pd.DataFrames) chunks of the table, with CATEGORY_COLUMNS
+        as categoricals and DATE_COLUMNS as nullable Int64 or datetime64
+        (missing dates are <NA> or NaT)
+    '''
+    selected = '*'
+    if columns is not None:
+        selected = ', '.join(f'"{col}"' for col in columns)
+    command = f'SELECT {selected} FROM {tab_name}'
+    if where is not None:
+        command += f' WHERE {where}'
+    connection = sqlite3.connect(db_path)
+    try:
+        for chunk in pd.read_sql_query(command, connection,
+            params = list(params), chunksize = chunksize):
+            chunk.columns = [col[col.find(".")+1:] for col in chunk.columns]
+            for col in chunk.columns:
+                if col in CATEGORY_COLUMNS:
+                    chunk[col] = chunk[col].astype('category')
+                elif col in DATE_COLUMNS:
+                    # nullable, so rows without a post date read as <NA>
+                    chunk[col] = chunk[col].astype('Int64')
+                    if dates == 'datetime':
+                        chunk[col] = pd.to_datetime(chunk[col], unit = 's')
+            yield chunk
+    finally:
+        connection.close()
+
+def concat_chunks(chunks):
+    '''
+    Joins DataFrame chunks from read_table into one DataFrame, keeping the
+    categorical columns categorical even when chunks saw different values.
+
+    Input:
+        chunks: (iterable of pd.DataFrames) chunks with the same columns
+
+    Output:
+        (pd.DataFrame) all rows, or None if there were no chunks
+    '''
+    chunks = list(chunks)
+    if not chunks:
+        return None
+    df = pd.concat(chunks, ignore_index = True)
+    for col in df.columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            df[col] = pd.api.types.union_categoricals(
+                [chunk[col] for chunk in chunks])
+    return df
+
+def sql_to_pd(db_path, tab_name, columns = None, where = None, params = (),
+    dates = 'int64'):
     '''
     Reads in sql table from a database as pd.DataFrame.
     
     Inputs:
         db_path: (str) path to sql database
         tab_name: (str) name of desired table
+        columns, where, params, dates: see read_table
 
     Output:
         (pd.DataFrame) of desired table
     '''
-    connection = sqlite3.connect(db_path)
-    cursor = connection.cursor()
-    command = f'''
-    SELECT * FROM {tab_name};'''
-    cursor.execute(command)
-    table = cursor.fetchall()
-    df = pd.DataFrame(table)
-    header = []
-    for tup in cursor.description:
-        col = tup[0]
-        if "." in col:
-            col = col[col.find(".")+1:]
-        header.append(col)
-    df.columns = header
+    df = concat_chunks(read_table(db_path, tab_name, columns, where, params,
+        dates = dates))
+    if df is None:
+        connection = sqlite3.connect(db_path)
+        cursor = connection.execute(f'SELECT * FROM {tab_name} LIMIT 0')
+        header = [tup[0] for tup in cursor.description]
+        connection.close()
+        df = pd.DataFrame(columns = columns if columns is not None else header)
     return df
 
+# Schema migrations for the domain cache and the analysis database. Each
+# entry upgrades a database from version i to i + 1 (tracked in sqlite's
+# user_version), so existing files are upgraded in place by init_dbs. Only
+# ever append to these lists.
+DOMAIN_CACHE_MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS domains 
+    (domain VARCHAR(255),
+    ip VARCHAR(255));
+    CREATE TABLE IF NOT EXISTS redir 
+    (url VARCHAR(255),
+    eff_url VARCHAR(255),
+    success INT);
+    """,
+    """
+    DELETE FROM redir WHERE rowid NOT IN
+        (SELECT MAX(rowid) FROM redir GROUP BY url);
+    CREATE UNIQUE INDEX IF NOT EXISTS redir_url ON redir (url);
+    DELETE FROM domains WHERE rowid NOT IN
+        (SELECT MIN(rowid) FROM domains GROUP BY domain, ip);
+    CREATE UNIQUE INDEX IF NOT EXISTS domains_domain_ip
+        ON domains (domain, ip);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS whois
+    (network VARCHAR(64) PRIMARY KEY,
+    ip_version INT,
+    prefix_len INT,
+    record TEXT,
+    fetched REAL);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS failures
+    (kind VARCHAR(16),
+    key VARCHAR(255),
+    error VARCHAR(32),
+    failures INT,
+    retry_at REAL,
+    PRIMARY KEY (kind, key));
+    INSERT OR IGNORE INTO failures
+        SELECT 'redirect', url, 'error', 1, 0 FROM redir WHERE success = 0;
+    INSERT OR IGNORE INTO failures
+        SELECT 'dns', domain, 'no_answer', 1, 0 FROM domains
+        WHERE ip IS NULL;
+    """,
+]
+
+ANALYSIS_MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS analysis_urls 
+    (url_id VARCHAR(255) PRIMARY KEY,
+    url_text VARCHAR(255),
+    subreddit VARCHAR(255), 
+    domain VARCHAR(255),
+    post_date DATE);
+    CREATE TABLE IF NOT EXISTS analysis_ips
+    (url_id VARCHAR(255),
+    ip_address VARCHAR(255),
+    domain VARCHAR(255),
+    org_name VARCHAR(255),
+    city VARCHAR(255),
+    state_prov VARCHAR(255),    
+    country VARCHAR(255),
+    ip_weight REAL,
+    FOREIGN KEY (url_id) REFERENCES analysis_urls(url_id));
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS analysis_urls_subreddit
+        ON analysis_urls (subreddit, post_date);
+    DELETE FROM analysis_ips WHERE rowid NOT IN
+        (SELECT MIN(rowid) FROM analysis_ips GROUP BY url_id, ip_address);
+    CREATE UNIQUE INDEX IF NOT EXISTS analysis_ips_url_id
+        ON analysis_ips (url_id, ip_address);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS combine_progress
+    (subreddit VARCHAR(255) PRIMARY KEY,
+    last_rowid INT,
+    updated REAL);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS spread_daily
+    (main_subreddit VARCHAR(255),
+    compare_subreddit VARCHAR(255),
+    quar_date DATE,
+    day DATE,
+    rate REAL,
+    PRIMARY KEY (main_subreddit, compare_subreddit, day));
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS url_index
+    (url_hash INTEGER PRIMARY KEY,
+    canonical TEXT,
+    postings BLOB);
+    CREATE TABLE IF NOT EXISTS url_index_subreddits
+    (subreddit_id INTEGER PRIMARY KEY,
+    subreddit VARCHAR(255) UNIQUE);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS host_rollup
+    (subreddit VARCHAR(255),
+    org_name VARCHAR(255),
+    state_prov VARCHAR(255),
+    domain VARCHAR(255),
+    day DATE,
+    weighted REAL);
+    CREATE INDEX IF NOT EXISTS host_rollup_subreddit
+        ON host_rollup (subreddit, day);
+    CREATE TABLE IF NOT EXISTS host_rollup_state
+    (id INTEGER PRIMARY KEY CHECK (id = 1),
+    last_rowid INT,
+    updated REAL);
+    """,
+    """
+    -- rowids only mean something within the database they came from, so
+    -- checkpoints are kept per source database. The old ones cannot be told
+    -- apart and are dropped; the next run rescans, still skipping urls
+    -- already in analysis_urls.
+    DROP TABLE IF EXISTS combine_progress;
+    CREATE TABLE combine_progress
+    (source VARCHAR(255),
+    subreddit VARCHAR(255),
+    last_rowid INT,
+    updated REAL,
+    PRIMARY KEY (source, subreddit));
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS spread_daily_canonical
+    (main_subreddit VARCHAR(255),
+    compare_subreddit VARCHAR(255),
+    quar_date DATE,
+    day DATE,
+    rate REAL,
+    PRIMARY KEY (main_subreddit, compare_subreddit, day));
+    """,
+]
+
+# Lookups run once per url (or per chart) that must be served by an index
+HOT_LOOKUPS = {
+    'domain_cache': [
+        "SELECT eff_url FROM redir WHERE url == 'x'",
+        "SELECT ip FROM domains WHERE domain == 'x'",
+        "SELECT record, fetched FROM whois WHERE network == 'x'",
+    ],
+    'analysis': [
+        """SELECT SUM(a.ip_weight) AS weighted, b.subreddit, a.domain,
+           a.org_name, a.state_prov
+           FROM analysis_ips AS a INNER JOIN analysis_urls AS b
+           ON a.url_id = b.url_id WHERE b.subreddit = 'x'
+           GROUP BY b.subreddit, a.domain, a.org_name, a.state_prov""",
+        """SELECT SUM(weighted), subreddit, org_name FROM host_rollup
+           WHERE subreddit = 'x' GROUP BY org_name""",
+        """SELECT url_text AS url, domain, post_date FROM analysis_urls
+           WHERE subreddit = 'x' AND post_date >= 0 AND post_date <= 1""",
+    ],
+}
+
+def migrate(db_path, migrations):
+    '''
+    Brings a database up to the latest schema version by running, in order,
+    every migration it has not seen yet. Each migration runs in its own
+    transaction together with the version bump.
+
+    Inputs:
+        db_path: (str) path to sql database
+        migrations: (list of strs) sql scripts, one per schema version
+
+    Output:
+        (int) schema version of the database after migrating
+    '''
+    connection = sqlite3.connect(db_path)
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+    for number, script in enumerate(migrations[version:], start = version + 1):
+        connection.executescript(
+            f'BEGIN; {script} PRAGMA user_version = {number}; COMMIT;')
+    connection.close()
+    return max(version, len(migrations))
+
 def init_dbs(domain_cache_path, analysis_path):
     '''
-    Creates domain cache and analysis database if they do not exist.
+    Creates domain cache and analysis database if they do not exist, and
+    upgrades existing ones to the latest schema.
 
     Inputs:
         domain_cache_path: (str) path to domain sql cache
         analysis_path: (str) path to analysis sql
     '''
-    connection = sqlite3.connect(domain_cache_path)
-    cursor = connection.cursor()
-    tabs = cursor.execute(
-        "SELECT name FROM sqlite_master WHERE type='table'").fetchall()
-    tabs = [tab[0] for (tab) in tabs]
-
-    if 'domains' not in tabs:
-        cursor.execute("""
-        CREATE TABLE domains 
-        (domain VARCHAR(255),
-        ip VARCHAR(255))
-        """)
-        connection.commit()
-
-    if 'redir' not in tabs:
-        cursor.execute("""
-        CREATE TABLE redir 
-        (url VARCHAR(255),
-        eff_url VARCHAR(255),
-        success INT)
-        """)
-        connection.commit()
+    migrate(domain_cache_path, DOMAIN_CACHE_MIGRATIONS)
+    migrate(analysis_path, ANALYSIS_MIGRATIONS)
+
+# (subreddit, day) partitions of host_rollup touched by analysis_ips rows past
+# the last refresh; a day of None holds urls without a post date
+ROLLUP_DIRTY = '''
+    CREATE TEMP TABLE rollup_dirty AS
+    SELECT DISTINCT b.subreddit,
+        CAST(b.post_date / 86400 AS INTEGER) * 86400 AS day_start
+    FROM analysis_ips AS a INNER JOIN analysis_urls AS b
+    ON a.url_id = b.url_id WHERE a.rowid > ?'''
+ROLLUP_CLEAR = '''
+    DELETE FROM host_rollup WHERE rowid IN (
+        SELECT r.rowid FROM rollup_dirty AS d INNER JOIN host_rollup AS r
+        ON r.subreddit = d.subreddit
+        AND r.day IS date(d.day_start, 'unixepoch'))'''
+ROLLUP_DAYS = '''
+    INSERT INTO host_rollup
+    SELECT b.subreddit, a.org_name, a.state_prov, a.domain,
+        date(d.day_start, 'unixepoch'), SUM(a.ip_weight)
+    FROM rollup_dirty AS d
+    INNER JOIN analysis_urls AS b ON b.subreddit = d.subreddit
+        AND b.post_date >= d.day_start AND b.post_date < d.day_start + 86400
+    INNER JOIN analysis_ips AS a ON a.url_id = b.url_id
+    WHERE d.day_start IS NOT NULL
+    GROUP BY b.subreddit, a.org_name, a.state_prov, a.domain, d.day_start'''
+ROLLUP_UNDATED = '''
+    INSERT INTO host_rollup
+    SELECT b.subreddit, a.org_name, a.state_prov, a.domain, NULL,
+        SUM(a.ip_weight)
+    FROM rollup_dirty AS d
+    INNER JOIN analysis_urls AS b ON b.subreddit = d.subreddit
+        AND b.post_date IS NULL
+    INNER JOIN analysis_ips AS a ON a.url_id = b.url_id
+    WHERE d.day_start IS NULL
+    GROUP BY b.subreddit, a.org_name, a.state_prov, a.domain'''
+
+def refresh_host_rollup(analysis_path):
+    '''
+    Brings host_rollup, the weighted host share per (subreddit, org_name,
+    state_prov, domain, day), up to date with analysis_ips. Only the
+    (subreddit, day) partitions with analysis_ips rows added since the last
+    refresh are recomputed, so a refresh after a small combine run is cheap,
+    and rows replaced by a re-run are not counted twice.
+
+    Inputs:
+        analysis_path: (str) path to analysis sql
+
+    Output:
+        (int) number of partitions recomputed
+    '''
+    connection = sqlite3.connect(analysis_path)
+    try:
+        state = connection.execute(
+            'SELECT last_rowid FROM host_rollup_state WHERE id = 1').fetchone()
+        last_rowid = state[0] if state is not None else 0
+        newest = connection.execute(
+            'SELECT MAX(rowid) FROM analysis_ips').fetchone()[0] or 0
+        if newest <= last_rowid:
+            return 0
+        with connection:
+            connection.execute(ROLLUP_DIRTY, [last_rowid])
+            dirty = connection.execute(
+                'SELECT COUNT(*) FROM rollup_dirty').fetchone()[0]
+            connection.execute(ROLLUP_CLEAR)
+            connection.execute(ROLLUP_DAYS)
+            connection.execute(ROLLUP_UNDATED)
+            connection.execute('''INSERT OR REPLACE INTO host_rollup_state
+                (id, last_rowid, updated) VALUES (1, ?, ?)''',
+                [newest, time.time()])
+            connection.execute('DROP TABLE rollup_dirty')
+        return dirty
+    finally:
+        connection.close()
+
+def unindexed_lookups(domain_cache_path, analysis_path):
+    '''
+    Checks the query plan of every lookup in HOT_LOOKUPS and reports the ones
+    that fall back to a full table scan.
+
+    Inputs:
+        domain_cache_path: (str) path to domain sql cache
+        analysis_path: (str) path to analysis sql
+
+    Output:
+        (list of strs) queries whose plan scans a table without an index
+    '''
+    unindexed = []
+    for db_path, queries in [(domain_cache_path, HOT_LOOKUPS['domain_cache']),
+        (analysis_path, HOT_LOOKUPS['analysis'])]:
+        connection = sqlite3.connect(db_path)
+        for query in queries:
+            plan = connection.execute('EXPLAIN QUERY PLAN ' + query).fetchall()
+            if any(detail.startswith('SCAN') and 'INDEX' not in detail
+                for *_, detail in plan):
+                unindexed.append(query)
+        connection.close()
+    return unindexed
+
+# Default number of worker threads for each concurrent stage of go(). The
+# write stage always has a single writer.
+STAGE_WORKERS = {'resolve': 4, 'lookup': 4, 'enrich': 4}
+_DONE = object()
+
+INSERT_URL_DATA = \
+    '''INSERT INTO analysis_urls
+        (url_id, url_text, subreddit, domain, post_date)
+        VALUES(?, ?, ?, ?, ?)'''
+INSERT_DATA_IP = \
+    '''INSERT OR REPLACE INTO analysis_ips(url_id, ip_address, domain,
+                    org_name, city, state_prov, country, ip_weight)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?);'''
+# whois keys filling the org_name, city, state_prov and country columns
+IP_WHOIS_KEYS = ['OrgName', 'City', 'StateProv', 'Country']
+
+def pending_urls(sql_path, analysis_path, subreddit, consolidated = False,
+    chunk_size = 10000):
+    '''
+    Reads the urls of a subreddit that still need to be enriched: rows past
+    the subreddit's checkpoint for sql_path whose url_id is not yet in
+    analysis_urls. Rows are read chunk_size at a time, each block with its
+    own query starting after the last rowid of the one before, so memory
+    stays bounded and no read is held open on analysis sql while go()'s
+    writer commits.
+
+    Inputs:
+        sql_path: (str) path to the subreddit's sql database, which the
+            checkpoint is stored under together with the subreddit
+        analysis_path: (str) path to analysis sql
+        subreddit: (str) subreddit name the checkpoint is stored under
+        consolidated: (bool) sql_path is the store shared by all subreddits,
+            so only rows of this subreddit are read
+        chunk_size: (int) number of rows per block
+
+    Output:
+        (generator of lists) blocks of (rowid, url_id, url_text, post_date,
+        subreddit_name, post_id) tuples, in rowid order
+    '''
+    connection = sqlite3.connect(sql_path)
+    connection.execute('ATTACH DATABASE ? AS analysis', [analysis_path])
+    checkpoint = connection.execute('''SELECT last_rowid FROM
+        analysis.combine_progress WHERE source = ? AND subreddit = ?''',
+        [sql_path, subreddit]).fetchone()
+    last_rowid = checkpoint[0] if checkpoint is not None else 0
+    command = '''
+        SELECT rowid, url_id, url_text, post_date, subreddit_name, post_id
+        FROM urls
+        WHERE rowid > ? AND url_id NOT IN
+            (SELECT url_id FROM analysis.analysis_urls)'''
+    params = []
+    if consolidated:
+        command += ' AND subreddit_name = ?'
+        params.append(subreddit)
+    command += ' ORDER BY rowid LIMIT ?'
+    try:
+        while True:
+            rows = connection.execute(command,
+                [last_rowid] + params + [chunk_size]).fetchall()
+            if not rows:
+                break
+            yield rows
+            last_rowid = rows[-1][0]
+    finally:
+        connection.close()
+
+class Progress:
+    '''
+    Tracks how many of each subreddit's urls are still in the pipeline, so
+    that a subreddit's checkpoint is only moved once every url fed for it has
+    been written. Shared by the feeding thread and the writer.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = {}
+        self.last_rowid = {}
+        self.sources = {}
+        self.fed_all = set()
+
+    def fed(self, subreddit, count, last_rowid, source):
+        '''
+        Records that count urls of a subreddit, up to last_rowid in the
+        source database, were fed.
+        '''
+        with self.lock:
+            self.remaining[subreddit] = \
+                self.remaining.get(subreddit, 0) + count
+            self.last_rowid[subreddit] = last_rowid
+            self.sources[subreddit] = source
+
+    def done_feeding(self, subreddit):
+        '''
+        Records that every pending url of a subreddit has been fed.
+        '''
+        with self.lock:
+            self.remaining.setdefault(subreddit, 0)
+            self.fed_all.add(subreddit)
+
+    def written(self, counts):
+        '''
+        Records committed urls and returns the subreddits that just finished.
+
+        Input:
+            counts: (dict) number of urls committed per subreddit
+
+        Output:
+            (list of tuples) (source, subreddit, last rowid) for finished
+            subreddits
+        '''
+        with self.lock:
+            for subreddit, count in counts.items():
+                self.remaining[subreddit] -= count
+            return self._finished()
+
+    def _finished(self):
+        finished = [(subreddit, self.last_rowid.get(subreddit))
+            for subreddit in self.fed_all if self.remaining[subreddit] == 0]
+        for subreddit, _ in finished:
+            self.fed_all.discard(subreddit)
+        return [(self.sources[subreddit], subreddit, last_rowid)
+            for subreddit, last_rowid in finished if last_rowid is not None]
+
+    def finish(self):
+        '''
+        Output:
+            (list of tuples) (source, subreddit, last rowid) for every
+            subreddit that finished without the writer noticing
+        '''
+        with self.lock:
+            return self._finished()
+
+def save_checkpoints(connection, finished):
+    '''
+    Moves the checkpoints of finished subreddits, see Progress.
+
+    Inputs:
+        connection: (sqlite3.Connection) open connection to analysis sql
+        finished: (list of tuples) (source, subreddit, last rowid)
+    '''
+    connection.executemany('''INSERT OR REPLACE INTO combine_progress
+        (source, subreddit, last_rowid, updated) VALUES (?, ?, ?, ?)''',
+        [(source, subreddit, last_rowid, time.time())
+            for source, subreddit, last_rowid in finished])
+    connection.commit()
+
+def run_stage(work, in_queue, out_queue, workers, errors):
+    '''
+    Starts worker threads that take chunks of UrlRecords off in_queue, apply
+    work to them and put the result on out_queue, until each receives _DONE.
+    A chunk whose work raises is dropped and the exception kept in errors, so
+    one bad chunk cannot stall the stages around it.
+
+    Inputs:
+        work: (function) takes and returns a list of UrlRecords
+        in_queue: (queue.Queue) chunks to process
+        out_queue: (queue.Queue) destination for processed chunks
+        workers: (int) number of worker threads
+        errors: (list) collects exceptions raised by work
+
+    Output:
+        (list) of the started threads
+    '''
+    def worker():
+        while True:
+            chunk = in_queue.get()
+            if chunk is _DONE:
+                break
+            try:
+                out_queue.put(work(chunk))
+            except Exception as error:
+                traceback.print_exc()
+                errors.append(error)
 
+    threads = [threading.Thread(target = worker, daemon = True)
+        for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def write_rows(in_queue, analysis_path, batch_size, test, errors, progress):
+    '''
+    Single writer for go(): inserts enriched url rows into the analysis
+    database with one executemany per table, and adds them to the url index,
+    committing every batch_size urls, until it receives _DONE. Moves a
+    subreddit's checkpoint once all of its urls are committed.
+
+    Inputs:
+        in_queue: (queue.Queue) chunks of enriched UrlRecords
+        analysis_path: (str) path to analysis sql
+        batch_size: (int) number of urls to insert per transaction
+        test: (bool) print the results for the first few urls
+        errors: (list) collects exceptions raised while writing
+        progress: (Progress) tracks which subreddits are finished
+    '''
     connection = sqlite3.connect(analysis_path)
-    cursor = connection.cursor()
-    tabs = cursor.execute(
-        "SELECT name FROM sqlite_master WHERE type='table'").fetchall()
-    tabs = [tab[0] for (tab) in tabs]
-
-    if 'analysis_urls' not in tabs:
-        cursor.execute("""
-        CREATE TABLE analysis_urls 
-        (url_id VARCHAR(255) PRIMARY KEY,
-        url_text VARCHAR(255),
-        subreddit VARCHAR(255), 
-        domain VARCHAR(255),
-        post_date DATE);
-        """)
-        connection.commit()
-
-    if 'analysis_ips' not in tabs:
-        cursor.execute("""
-        CREATE TABLE analysis_ips
-        (url_id VARCHAR(255),
-        ip_address VARCHAR(255),
-        domain VARCHAR(255),
-        org_name VARCHAR(255),
-        city VARCHAR(255),
-        state_prov VARCHAR(255),    
-        country VARCHAR(255),
-        ip_weight REAL,
-        FOREIGN KEY (url_id) REFERENCES analysis_urls(url_id));
-        """)
-        connection.commit()
+    url_batch = []
+    ip_batch = []
+    counter = 0
+
+    def flush():
+        try:
+            connection.executemany(INSERT_URL_DATA,
+                [record.url_params() for record in url_batch])
+            connection.executemany(INSERT_DATA_IP, ip_batch)
+            url_index.add_posts(connection,
+                [record.index_params() for record in url_batch])
+            connection.commit()
+            counts = collections.Counter(record.checkpoint
+                for record in url_batch)
+            save_checkpoints(connection, progress.written(counts))
+        except Exception as error:
+            connection.rollback()
+            traceback.print_exc()
+            errors.append(error)
+        url_batch.clear()
+        ip_batch.clear()
 
+    while True:
+        chunk = in_queue.get()
+        if chunk is _DONE:
+            break
+        for record in chunk:
+            url_batch.append(record)
+            ip_batch.extend(record.ip_params(IP_WHOIS_KEYS))
+            if test and counter < 3:
+                counter += 1
+                print('Processing url: ' + str(record.url))
+                print('\'---> Redirected url: ' + str(record.eff_url))
+                for host in record.hosts:
+                    if host.ip is None or host.whois is None:
+                        continue
+                    print('\tWhoIs lookup using ip address: ' + host.address)
+                    for key in ['OrgName', 'Country', 'StateProv', 'City']:
+                        print('\t\t'+ key + " : " + str(host.whois.get(key)))
+        if len(url_batch) >= batch_size:
+            flush()
+    flush()
     connection.close()
 
 def go(subreddits = None, test = False,
-    whois_keys = ['OrgName','City','StateProv','Country','RegDate']):
+    whois_keys = ['OrgName','City','StateProv','Country','RegDate'],
+    max_in_flight = 50, workers = None, chunk_size = 200, queue_size = 8,
+    batch_size = 1000, consolidated = False):
     '''
     Reads in subreddit post url's from sql databases created by scraper, 
-    uses url_tools' url_to_ip to get IP information on each url, and finally 
-    uses url_tools' ip_whois to get ARIN WhoIs data for each IP address.
+    uses url_tools to follow redirects and get IP information on each url, and
+    finally uses url_tools' ip_whois to get ARIN WhoIs data for each IP address.
     Results are added to 'analysis_ips' and 'analysis_domains' in the analysis
     sql database.
 
+    Only urls not yet in analysis_urls are read (see pending_urls), and each
+    subreddit's progress is checkpointed, so an interrupted or repeated run
+    picks up where the last one stopped.
+
+    Urls flow in chunks through a pipeline of stages - resolve (redirects),
+    lookup (DNS), enrich (WhoIs) and write - each run by its own worker
+    threads and joined by bounded queues, so a slow stage holds back the ones
+    before it instead of letting chunks pile up in memory. A single writer
+    batches the inserts.
+
+    Failed redirect, DNS and WhoIs lookups are cached with a retry time that
+    depends on the kind of failure (see negative_cache), and a RetryWorker
+    looks up the ones that come due in the background while the pipeline
+    runs.
+
     Inputs:
         subreddits: (list of strs, or None) list of subreddits to process, if
         None, the list from data/subreddits.txt will be processed.
         whois_keys: (list of strs) target fields to pull from IP WhoIs lookups
+        max_in_flight: (int) number of redirects each resolve worker follows
+            concurrently
+        workers: (dict, or None) number of worker threads for the 'resolve',
+            'lookup' and 'enrich' stages, missing stages use STAGE_WORKERS
+        chunk_size: (int) number of urls read and passed between stages at a
+            time
+        queue_size: (int) maximum number of chunks waiting between stages
+        batch_size: (int) number of urls inserted per transaction
+        consolidated: (bool) read urls from the single store scraper writes
+            with consolidated = True instead of one database per subreddit
 
     Returns:
         None, but analysis database will be updated with analysis results.
@@ -119,60 +683,95 @@ def go(subreddits = None, test = False,
         links = open('data/subreddits_1.txt')
         subreddits = links.read().split('\n')
         links.close()
-    if test:
-        counter = 0
-    connection = sqlite3.connect('data/analysis.sql')
-    cursor = connection.cursor()
+    workers = dict(STAGE_WORKERS, **(workers or {}))
     domain_cache_path = 'domain_cache.sql'
     analysis_path = 'data/analysis.sql'
     init_dbs(domain_cache_path, analysis_path)
+    cache = domain_cache.get_cache(domain_cache_path)
+    # failed lookups that come due are retried alongside the pipeline
+    retries = url_tools.RetryWorker(cache, whois_keys = whois_keys)
+    retries.start()
 
-    insert_data_ip = \
-        '''INSERT INTO analysis_ips(url_id, ip_address, domain,
-                        org_name, city, state_prov, country, ip_weight)
-            VALUES (:url_id, :ip, :domain, :OrgName, :City,
-                    :StateProv, :Country, :ip_weight);'''
+    keys = tuple(records.intern(key) for key in whois_keys)
+    # one WhoisRecord per IP, shared by every url hosted on it
+    whois_records = {}
+    failed_whois = records.WhoisRecord.from_parsed(None, keys)
 
-    for subreddit in subreddits:
-        sub = subreddit.split(",")[0]
-        sql_path = f'data/{sub}.sql'
-        subreddit_df = sql_to_pd(sql_path, 'urls')
-
-        for row in subreddit_df.itertuples():
-            _, url_id, url, _, _, date, subreddit, _ = row
-            domain, ips = url_tools.url_to_ip(url, test = test)
-            who_is_scrape = url_tools.ip_whois(ips, test = test)
-            row_insert = {'url_id' : url_id, 'url' : url,
-                'subreddit': subreddit, 'domain' : domain, 'date' : date} 
-            insert_url_data = \
-            '''INSERT INTO analysis_urls
-                (url_id, url_text, subreddit, domain, post_date)
-                VALUES(:url_id, :url, :subreddit, :domain, :date)'''
-            cursor.execute(insert_url_data, row_insert)
-            
-            for ip, page_info in who_is_scrape:
+    def resolve(chunk):
+        eff_urls = url_tools.prefetch_redirects([record.url
+            for record in chunk], max_in_flight = max_in_flight,
+            cache = cache)
+        for record in chunk:
+            record.eff_url = eff_urls[url_tools.clean_url(record.url)]
+        return chunk
+
+    def lookup(chunk):
+        for record in chunk:
+            record.set_domain(url_tools.effective_domain(record.eff_url))
+        url_tools.prefetch_domains([record.domain for record in chunk],
+            cache = cache)
+        resolved = cache.get_domains([record.domain for record in chunk])
+        for record in chunk:
+            record.hosts = [records.ResolvedHost(ip)
+                for ip in resolved.get(record.domain, [None])]
+        return chunk
+
+    def enrich(chunk):
+        url_tools.prefetch_whois([host.address for record in chunk
+            for host in record.hosts], cache = cache,
+            whois_keys = whois_keys)
+        for record in chunk:
+            ips = [host.address for host in record.hosts]
+            for host, (ip, parsed) in zip(record.hosts,
+                url_tools.ip_whois(ips, cache = cache,
+                whois_keys = whois_keys)):
                 if ip is None:
                     continue
-                if page_info is None:
-                    row_insert = {key: None for key in whois_keys}
-                elif any([key not in page_info for key in whois_keys]):
-                    row_insert = {}
-                    for key in whois_keys:
-                        if key not in page_info:
-                            row_insert[key] = '**WHOIS KEY NOT FOUND**'
-                        else:
-                            row_insert[key] = page_info[key]
-                else:
-                    row_insert = {key: val for key, val in page_info.items()\
-                        if key in whois_keys}
-                
-                row_insert.update({'url_id' : url_id, 'ip' : ip,
-                    'domain' : domain, 'ip_weight' : (1 / len(ips))})
-                cursor.execute(insert_data_ip, row_insert)
-
-            if test:
-                counter += 1
-                if counter > 3:
-                    test = False
+                if parsed is None:
+                    host.whois = failed_whois
+                    continue
+                if ip not in whois_records:
+                    whois_records[ip] = records.WhoisRecord.from_parsed(
+                        parsed, keys)
+                host.whois = whois_records[ip]
+        return chunk
 
-            connection.commit()
+    queues = [queue.Queue(maxsize = queue_size) for _ in range(4)]
+    errors = []
+    stages = []
+    for number, (name, work) in enumerate(
+        [('resolve', resolve), ('lookup', lookup), ('enrich', enrich)]):
+        stages.append((workers[name], run_stage(work, queues[number],
+            queues[number + 1], workers[name], errors)))
+    progress = Progress()
+    writer = threading.Thread(target = write_rows, daemon = True,
+        args = (queues[3], analysis_path, batch_size, test, errors,
+        progress))
+    writer.start()
+
+    for subreddit in subreddits:
+        sub = subreddit.split(",")[0]
+        sql_path = scraper.urls_path(sub, consolidated)
+        for rows in pending_urls(sql_path, analysis_path, sub, consolidated,
+            chunk_size):
+            progress.fed(sub, len(rows), rows[-1][0], sql_path)
+            queues[0].put([records.UrlRecord(url_id, url, subreddit, date,
+                post_id, sub) for _, url_id, url, date, subreddit, post_id
+                in rows])
+        progress.done_feeding(sub)
+
+    for number, (count, threads) in enumerate(stages):
+        for _ in range(count):
+            queues[number].put(_DONE)
+        for thread in threads:
+            thread.join()
+    queues[3].put(_DONE)
+    writer.join()
+    retries.stop()
+    connection = sqlite3.connect(analysis_path)
+    save_checkpoints(connection, progress.finish())
+    connection.close()
+    cache.commit()
+    if errors:
+        raise errors[0]
+    refresh_host_rollup(analysis_path)
@@ -0,0 +1,681 @@
+'''
+This file holds the domain sql cache used by url_tools.py and combine.py
+'''
+
+import atexit
+import collections
+import ipaddress
+import json
+import sqlite3
+import threading
+import time
+import negative_cache
+import url_extract
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class LRUCache:
+    '''
+    Bounded in-memory map that evicts the least recently used key once it
+    holds maxsize entries, and counts hits and misses. Not thread safe on its
+    own; DomainCache only touches it while holding its lock.
+    '''
+    def __init__(self, maxsize = 10000):
+        '''
+        Input:
+            maxsize: (int) maximum number of entries to keep, 0 disables
+        '''
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''
+        Looks up a key, marking it as recently used.
+
+        Input:
+            key: key to look up
+
+        Output:
+            the stored value, or None if the key is not held
+        '''
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        '''
+        Stores a value, evicting the least recently used key if full.
+
+        Inputs:
+            key: key to store under
+            value: value to store
+        '''
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
+
+    def stats(self):
+        '''
+        Output:
+            (dict) of hits, misses and current size
+        '''
+        return {'hits': self.hits, 'misses': self.misses,
+            'size': len(self.entries)}
+
+
+class DomainCache:
+    '''
+    Wraps one long-lived connection to the domain sql cache. The connection is
+    opened in WAL mode and shared between threads behind a lock, every query
+    uses one of the fixed strings below so sqlite3 reuses its compiled
+    statement, and writes are committed in batches (every commit_every writes
+    or commit_interval seconds, whichever comes first) instead of one commit
+    per url. Repeated lookups are answered from in-memory LRU tiers in front
+    of the redir and domains tables.
+
+    WhoIs results are stored once per network block (the NetRange/CIDR the
+    lookup returned) rather than per IP. Blocks are keyed by their network
+    address and prefix length, so finding the block that contains an IP takes
+    one primary key lookup per prefix length present in the table, most
+    specific first.
+
+    Failed lookups are kept in the failures table, keyed by lookup kind
+    ('redirect', 'dns' or 'whois') and url, domain or IP, with the error class
+    and the time after which they should be retried (see
+    negative_cache.retry_at). Until then the failure itself is the cached
+    answer; afterwards the lookup reads as a miss so that it is tried again.
+    '''
+    redir_check_str = "SELECT eff_url FROM redir WHERE url == :url"
+    redir_insert_str = '''INSERT OR REPLACE INTO redir (url, eff_url, success)
+                          VALUES (:url, :eff_url, :success)'''
+    dom_check_str = "SELECT ip FROM domains WHERE domain == :dom"
+    dom_insert_str = '''INSERT OR IGNORE INTO domains (domain, ip)
+                        VALUES (:dom, :ip)'''
+    whois_check_str = "SELECT record, fetched FROM whois WHERE network == :net"
+    whois_insert_str = '''INSERT OR REPLACE INTO whois
+                          (network, ip_version, prefix_len, record, fetched)
+                          VALUES (:net, :version, :prefix_len, :record,
+                          :fetched)'''
+    dom_clear_str = '''DELETE FROM domains
+                       WHERE domain == :dom AND ip IS NULL'''
+    failure_insert_str = '''INSERT OR REPLACE INTO failures
+                            (kind, key, error, failures, retry_at)
+                            VALUES (:kind, :key, :error, :failures,
+                            :retry_at)'''
+    failure_delete_str = '''DELETE FROM failures
+                            WHERE kind == :kind AND key == :key'''
+
+    def __init__(self, domain_cache_path = 'domain_cache.sql',
+        commit_every = 500, commit_interval = 5.0, lru_size = 10000,
+        whois_ttl = 30 * 86400):
+        '''
+        Inputs:
+            domain_cache_path: (str) path to location of domain sql cache
+            commit_every: (int) number of writes to batch into one commit
+            commit_interval: (float) maximum number of seconds a write can
+                sit uncommitted
+            lru_size: (int) number of urls, and of domains, to keep in memory
+            whois_ttl: (float) seconds before a cached WhoIs block expires
+        '''
+        self.path = domain_cache_path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(domain_cache_path,
+            check_same_thread = False, cached_statements = 64)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.uncommitted = 0
+        self.last_commit = time.monotonic()
+        self.redirects = LRUCache(lru_size)
+        self.domains = LRUCache(lru_size)
+        self.whois_ttl = whois_ttl
+        self.whois_prefixes = None
+        self.redirect_hosts = None
+        self.failures = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_redirect(self, url):
+        '''
+        Looks up the cached effective url for a cleaned url.
+
+        Input:
+            url: (str) cleaned url
+
+        Output:
+            (str) effective url, or None if the url has not been seen or its
+            failed lookup is due for a retry
+        '''
+        with self.lock:
+            if self._due('redirect', url):
+                return None
+            eff_url = self.redirects.get(url)
+            if eff_url is not None:
+                return eff_url
+            row = self.connection.execute(self.redir_check_str,
+                {'url':url}).fetchone()
+            if row is None:
+                return None
+            self.redirects.put(url, row[0])
+            return row[0]
+
+    def get_redirects(self, urls):
+        '''
+        Looks up the cached effective urls for a batch of cleaned urls.
+
+        Input:
+            urls: (iterable of strs) cleaned urls
+
+        Output:
+            (dict) mapping each url that has been seen to its effective url,
+            leaving out failed lookups that are due for a retry
+        '''
+        with self.lock:
+            urls = [url for url in urls if not self._due('redirect', url)]
+            cached, missing = self._split(self.redirects, urls)
+            for url, eff_url in self._select_in(
+                'SELECT url, eff_url FROM redir WHERE url IN', missing):
+                self.redirects.put(url, eff_url)
+                cached[url] = eff_url
+        return cached
+
+    def add_redirect(self, url, eff_url, success):
+        '''
+        Stores the effective url for a cleaned url.
+
+        Inputs:
+            url: (str) cleaned url
+            eff_url: (str) effective url after all redirects
+            success: (bool) whether the redirect lookup succeeded
+        '''
+        self.add_redirects([(url, eff_url, success)])
+
+    def add_redirects(self, rows, errors = None):
+        '''
+        Stores a batch of (url, effective url, success) tuples, and records
+        or clears each url's failure.
+
+        Inputs:
+            rows: (list of tuples) redirect lookup results
+            errors: (dict, or None) error classes of failed urls, see
+                url_tools.follow_redirects_many; failures missing from it
+                are recorded as 'error'
+        '''
+        errors = errors or {}
+        params = [{'url':url, 'eff_url':eff_url, 'success':success}
+            for url, eff_url, success in rows]
+        with self.lock:
+            self.connection.executemany(self.redir_insert_str, params)
+            for url, eff_url, success in rows:
+                self.redirects.put(url, eff_url)
+                if success:
+                    self._clear_failure('redirect', url)
+                else:
+                    self._record_failure('redirect', url,
+                        errors.get(url, 'error'))
+            if self.redirect_hosts is not None:
+                self._count_redirects(rows)
+            self._wrote(len(params))
+
+    def never_redirects(self, host, min_samples = 5):
+        '''
+        Checks whether every url seen on a host so far resolved to itself, so
+        that new urls on it can skip following redirects. The per-host counts
+        are read from the redir table on first use and kept up to date as
+        redirects are added.
+
+        Inputs:
+            host: (str) host name, as url_tools.url_host returns it
+            min_samples: (int) successful lookups a host needs before it is
+                trusted not to redirect
+
+        Output:
+            (bool) True if the host has at least min_samples successful
+            lookups and none of them redirected
+        '''
+        with self.lock:
+            if self.redirect_hosts is None:
+                self.redirect_hosts = {}
+                self._count_redirects(self.connection.execute(
+                    'SELECT url, eff_url, success FROM redir'))
+            seen, redirected = self.redirect_hosts.get(host, (0, 0))
+        return seen >= min_samples and redirected == 0
+
+    def get_ips(self, domain):
+        '''
+        Looks up the cached IP addresses for a domain.
+
+        Input:
+            domain: (str) domain name
+
+        Output:
+            (list) of IP addresses (a failed lookup is stored as [None]), or
+            None if the domain has not been seen or its failed lookup is due
+            for a retry
+        '''
+        with self.lock:
+            if self._due('dns', domain):
+                return None
+            ips = self.domains.get(domain)
+            if ips is not None:
+                return list(ips)
+            rows = self.connection.execute(self.dom_check_str,
+                {'dom':domain}).fetchall()
+            if not rows:
+                return None
+            ips = [ip for (ip,) in rows]
+            self.domains.put(domain, tuple(ips))
+            return ips
+
+    def get_domains(self, domains):
+        '''
+        Looks up the cached IP addresses for a batch of domains.
+
+        Input:
+            domains: (iterable of strs) domain names
+
+        Output:
+            (dict) mapping each domain that has been seen to its IP addresses,
+            leaving out failed lookups that are due for a retry
+        '''
+        with self.lock:
+            domains = [dom for dom in domains if not self._due('dns', dom)]
+            cached, missing = self._split(self.domains, domains)
+            cached = {dom: list(ips) for dom, ips in cached.items()}
+            found = {}
+            for dom, ip in self._select_in(
+                'SELECT domain, ip FROM domains WHERE domain IN', missing):
+                found.setdefault(dom, []).append(ip)
+            for dom, ips in found.items():
+                self.domains.put(dom, tuple(ips))
+        cached.update(found)
+        return cached
+
+    def add_ips(self, domain, ips, error = None):
+        '''
+        Stores the IP addresses found for a domain.
+
+        Inputs:
+            domain: (str) domain name
+            ips: (list) of IP addresses, [None] for a failed lookup
+            error: (str, or None) error class of a failed lookup
+        '''
+        self.add_domains({domain: ips},
+            None if error is None else {domain: error})
+
+    def add_domains(self, resolved, errors = None):
+        '''
+        Stores the IP addresses found for a batch of domains in one insert,
+        and records or clears each domain's failure. A domain keeps at most
+        one [None] row, which is dropped once it resolves.
+
+        Inputs:
+            resolved: (dict) mapping domain names to lists of IP addresses
+            errors: (dict, or None) error classes of failed domains, see
+                url_tools.resolve_domains; failures missing from it are
+                recorded as 'no_answer'
+        '''
+        errors = errors or {}
+        params = [{'dom':dom, 'ip':ip}
+            for dom, ips in resolved.items() for ip in ips]
+        with self.lock:
+            self.connection.executemany(self.dom_clear_str,
+                [{'dom':dom} for dom in resolved])
+            self.connection.executemany(self.dom_insert_str, params)
+            for dom, ips in resolved.items():
+                self.domains.put(dom, tuple(ips))
+                if ips == [None]:
+                    self._record_failure('dns', dom,
+                        errors.get(dom, 'no_answer'))
+                else:
+                    self._clear_failure('dns', dom)
+            self._wrote(len(params))
+
+    def get_whois(self, ip):
+        '''
+        Looks up the cached WhoIs record of the most specific known network
+        block containing an IP.
+
+        Input:
+            ip: (str) IP address
+
+        Output:
+            (dict) parsed WhoIs record, or None if no block contains the IP
+            or the most specific one has expired
+        '''
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        with self.lock:
+            self._load_whois_prefixes()
+            oldest = time.time() - self.whois_ttl
+            for prefix_len in sorted(
+                self.whois_prefixes.get(address.version, ()), reverse = True):
+                network = ipaddress.ip_network((address, prefix_len),
+                    strict = False)
+                row = self.connection.execute(self.whois_check_str,
+                    {'net':str(network)}).fetchone()
+                if row is None:
+                    continue
+                # an expired block is a miss, not a reason to fall back on a
+                # less specific one that may belong to someone else
+                if row[1] < oldest:
+                    return None
+                return json.loads(row[0])
+        return None
+
+    def add_whois(self, record):
+        '''
+        Stores a parsed WhoIs record under every network block it covers.
+
+        Input:
+            record: (dict) parsed WhoIs record, see url_tools.parse_lines
+
+        Output:
+            (list) of the networks the record was stored under, empty if the
+            record names no NetRange or CIDR
+        '''
+        networks = whois_networks(record)
+        fetched = time.time()
+        params = [{'net':str(network), 'version':network.version,
+            'prefix_len':network.prefixlen, 'record':json.dumps(record),
+            'fetched':fetched} for network in networks]
+        with self.lock:
+            self._load_whois_prefixes()
+            self.connection.executemany(self.whois_insert_str, params)
+            for network in networks:
+                self.whois_prefixes.setdefault(network.version,
+                    set()).add(network.prefixlen)
+            self._wrote(len(params))
+        return networks
+
+    def get_failure(self, kind, key):
+        '''
+        Looks up the cached failure of a lookup.
+
+        Inputs:
+            kind: (str) 'redirect', 'dns' or 'whois'
+            key: (str) cleaned url, domain or IP address
+
+        Output:
+            (tuple, or None) (error class, failures in a row, retry time), or
+            None if the last lookup did not fail
+        '''
+        with self.lock:
+            self._load_failures()
+            return self.failures.get((kind, key))
+
+    def failing(self, kind, key):
+        '''
+        Checks whether a lookup failed and is not yet due for a retry, in
+        which case the failure should be used instead of calling upstream.
+
+        Inputs:
+            kind: (str) 'redirect', 'dns' or 'whois'
+            key: (str) cleaned url, domain or IP address
+
+        Output:
+            (bool) True while the failure is cached
+        '''
+        failure = self.get_failure(kind, key)
+        return failure is not None and failure[2] > time.time()
+
+    def add_failure(self, kind, key, error):
+        '''
+        Records a failed lookup, pushing its retry back further for each
+        failure in a row.
+
+        Inputs:
+            kind: (str) 'redirect', 'dns' or 'whois'
+            key: (str) cleaned url, domain or IP address
+            error: (str) error class, see negative_cache.FAILURE_TTLS
+        '''
+        with self.lock:
+            self._record_failure(kind, key, error)
+
+    def clear_failure(self, kind, key):
+        '''
+        Forgets the failure of a lookup that has since succeeded.
+
+        Inputs:
+            kind: (str) 'redirect', 'dns' or 'whois'
+            key: (str) cleaned url, domain or IP address
+        '''
+        with self.lock:
+            self._clear_failure(kind, key)
+
+    def due_failures(self, limit = None):
+        '''
+        Lists the failed lookups whose retry time has passed, the longest
+        overdue first.
+
+        Input:
+            limit: (int, or None) most failures to return
+
+        Output:
+            (list of tuples) (kind, key) pairs
+        '''
+        now = time.time()
+        with self.lock:
+            self._load_failures()
+            due = sorted((retry, kind, key) for (kind, key), (_, _, retry)
+                in self.failures.items() if retry <= now)
+        return [(kind, key) for _, kind, key in due[:limit]]
+
+    def stats(self):
+        '''
+        Reports how often lookups were answered from memory, and how many
+        failures are cached.
+
+        Output:
+            (dict) of LRUCache.stats() for the 'redir' and 'domains' tiers,
+            and the number of cached failures of each kind
+        '''
+        with self.lock:
+            self._load_failures()
+            failures = collections.Counter(kind for kind, _ in self.failures)
+            return {'redir': self.redirects.stats(),
+                'domains': self.domains.stats(),
+                'failures': dict(failures)}
+
+    def commit(self):
+        '''
+        Commits any outstanding writes.
+        '''
+        with self.lock:
+            self.connection.commit()
+            self.uncommitted = 0
+            self.last_commit = time.monotonic()
+
+    def close(self):
+        '''
+        Commits any outstanding writes and closes the connection.
+        '''
+        with self.lock:
+            if self.connection is None:
+                return
+            self.commit()
+            self.connection.close()
+            self.connection = None
+        with _caches_lock:
+            if _caches.get(self.path) is self:
+                del _caches[self.path]
+
+    def _wrote(self, count):
+        '''
+        Internal function that counts writes and commits once the batch size
+        or the commit interval is reached. Must be called holding self.lock.
+        '''
+        self.uncommitted += count
+        if self.uncommitted >= self.commit_every or \
+            time.monotonic() - self.last_commit >= self.commit_interval:
+            self.commit()
+
+    def _load_whois_prefixes(self):
+        '''
+        Internal function that reads which prefix lengths are present in the
+        whois table, the first time they are needed. Must be called holding
+        self.lock.
+        '''
+        if self.whois_prefixes is None:
+            self.whois_prefixes = {}
+            for version, prefix_len in self.connection.execute(
+                'SELECT DISTINCT ip_version, prefix_len FROM whois'):
+                self.whois_prefixes.setdefault(version, set()).add(prefix_len)
+
+    def _load_failures(self):
+        '''
+        Internal function that reads the failures table the first time it is
+        needed. Must be called holding self.lock.
+        '''
+        if self.failures is None:
+            self.failures = {(kind, key): (error, failures, retry)
+                for kind, key, error, failures, retry in
+                self.connection.execute('SELECT kind, key, error, failures, '
+                'retry_at FROM failures')}
+
+    def _due(self, kind, key):
+        '''
+        Internal function that checks whether a lookup failed and its retry
+        time has passed. Must be called holding self.lock.
+        '''
+        self._load_failures()
+        failure = self.failures.get((kind, key))
+        return failure is not None and failure[2] <= time.time()
+
+    def _record_failure(self, kind, key, error):
+        '''
+        Internal function behind add_failure. Must be called holding
+        self.lock.
+        '''
+        self._load_failures()
+        previous = self.failures.get((kind, key))
+        failures = 1 if previous is None else previous[1] + 1
+        retry = negative_cache.retry_at(kind, error, failures)
+        self.failures[(kind, key)] = (error, failures, retry)
+        self.connection.execute(self.failure_insert_str, {'kind':kind,
+            'key':key, 'error':error, 'failures':failures, 'retry_at':retry})
+        self._wrote(1)
+
+    def _clear_failure(self, kind, key):
+        '''
+        Internal function behind clear_failure. Must be called holding
+        self.lock.
+        '''
+        self._load_failures()
+        if self.failures.pop((kind, key), None) is not None:
+            self.connection.execute(self.failure_delete_str,
+                {'kind':kind, 'key':key})
+            self._wrote(1)
+
+    def _count_redirects(self, rows):
+        '''
+        Internal function that adds successful (url, effective url, success)
+        lookups to the per-host counts used by never_redirects.
+        '''
+        for url, eff_url, success in rows:
+            if not success or eff_url is None:
+                continue
+            host = url_extract.host(url)
+            seen, redirected = self.redirect_hosts.get(host, (0, 0))
+            self.redirect_hosts[host] = (seen + 1,
+                redirected + (url_extract.clean(eff_url) != url))
+
+    def _split(self, lru, keys):
+        '''
+        Internal function that splits keys into those held in an LRU tier
+        (returned as a dict) and those that still need a database lookup.
+        '''
+        cached = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            value = lru.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                cached[key] = value
+        return cached, missing
+
+    def _select_in(self, query, keys, chunk_size = 500):
+        '''
+        Internal function that runs "query (?, ?, ...)" over keys in chunks,
+        staying under sqlite's limit on bound parameters.
+        '''
+        keys = list(dict.fromkeys(keys))
+        rows = []
+        with self.lock:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                marks = ', '.join('?' * len(chunk))
+                rows += self.connection.execute(
+                    f'{query} ({marks})', chunk).fetchall()
+        return rows
+
+
+def whois_networks(record):
+    '''
+    Finds the network blocks a parsed WhoIs record applies to, from its CIDR
+    field (which may list several blocks) or, failing that, its NetRange.
+
+    Input:
+        record: (dict) parsed WhoIs record
+
+    Output:
+        (list) of ipaddress network objects
+    '''
+    try:
+        if record.get('CIDR'):
+            return [ipaddress.ip_network(cidr.strip(), strict = False)
+                for cidr in record['CIDR'].split(',') if cidr.strip()]
+        if record.get('NetRange'):
+            first, last = record['NetRange'].split('-')
+            return list(ipaddress.summarize_address_range(
+                ipaddress.ip_address(first.strip()),
+                ipaddress.ip_address(last.strip())))
+    except ValueError:
+        pass
+    return []
+
+
+def get_cache(domain_cache_path = 'domain_cache.sql'):
+    '''
+    Returns the shared DomainCache for a cache file, opening it on first use.
+
+    Input:
+        domain_cache_path: (str) path to location of domain sql cache
+
+    Output:
+        (DomainCache) shared cache
+    '''
+    with _caches_lock:
+        if domain_cache_path not in _caches:
+            _caches[domain_cache_path] = DomainCache(domain_cache_path)
+        return _caches[domain_cache_path]
+
+
+@atexit.register
+def _close_caches():
+    '''
+    Flushes and closes every shared cache when the interpreter exits.
+    '''
+    for cache in list(_caches.values()):
+        cache.close()
@@ -0,0 +1,150 @@
+'''
+This file holds the failure policy shared by the redirect, DNS and WhoIs
+lookups in url_tools.py: how long each class of failure is cached before it
+is retried, and a circuit breaker per upstream server
+'''
+
+import threading
+import time
+
+# seconds a failure is cached before it is first retried, by lookup and error
+# class; each further failure in a row doubles the wait, up to MAX_TTL
+FAILURE_TTLS = {
+    'redirect': {'timeout': 3600, 'connect': 6 * 3600, 'dns': 7 * 86400,
+        'tls': 7 * 86400, 'too_many_redirects': 30 * 86400,
+        'circuit_open': 600, 'error': 6 * 3600},
+    'dns': {'nxdomain': 86400, 'no_answer': 86400, 'server': 600,
+        'circuit_open': 600},
+    'whois': {'network': 600, 'unparsed': 86400, 'circuit_open': 600},
+}
+DEFAULT_TTL = 3600
+MAX_TTL = 30 * 86400
+# error classes worth retrying straight away, within the same lookup
+TRANSIENT = frozenset(['timeout', 'connect', 'error', 'server', 'network'])
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(ConnectionError):
+    '''
+    Raised instead of calling an upstream whose circuit breaker is open.
+    '''
+
+
+def retry_at(kind, error, failures, now = None):
+    '''
+    Works out when a failed lookup should next be tried.
+
+    Inputs:
+        kind: (str) 'redirect', 'dns' or 'whois'
+        error: (str) error class of the failure
+        failures: (int) failures in a row, including this one
+        now: (float, or None) time of the failure, if None the current time
+
+    Output:
+        (float) unix time after which the lookup is retried
+    '''
+    if now is None:
+        now = time.time()
+    ttl = FAILURE_TTLS.get(kind, {}).get(error, DEFAULT_TTL)
+    return now + min(ttl * 2 ** (max(failures, 1) - 1), MAX_TTL)
+
+
+class CircuitBreaker:
+    '''
+    Counts failures in a row against one upstream. Once threshold is reached
+    the breaker opens and calls are refused for reset_after seconds, after
+    which one trial call is let through: if it succeeds the breaker closes,
+    if it fails the breaker opens again. Thread safe.
+    '''
+    def __init__(self, threshold = 5, reset_after = 60.0):
+        '''
+        Inputs:
+            threshold: (int) failures in a row that open the breaker
+            reset_after: (float) seconds the breaker stays open before a
+                trial call
+        '''
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        '''
+        Checks whether a call may go ahead. Must be followed by record() when
+        it returns True.
+
+        Output:
+            (bool) False while the breaker is open
+        '''
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.trial or \
+                time.monotonic() - self.opened < self.reset_after:
+                return False
+            self.trial = True
+            return True
+
+    def record(self, success):
+        '''
+        Records the outcome of a call that allow() let through.
+
+        Input:
+            success: (bool) whether the upstream answered
+        '''
+        with self.lock:
+            self.trial = False
+            if success:
+                self.failures = 0
+                self.opened = None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.monotonic()
+
+    @property
+    def state(self):
+        '''
+        'closed', 'open', or 'half open' once a trial call is due.
+        '''
+        with self.lock:
+            if self.opened is None:
+                return 'closed'
+            if time.monotonic() - self.opened < self.reset_after:
+                return 'open'
+            return 'half open'
+
+
+def get_breaker(upstream, threshold = 5, reset_after = 60.0):
+    '''
+    Returns the shared CircuitBreaker for an upstream, creating it on first
+    use.
+
+    Inputs:
+        upstream: (str) name of the upstream, e.g. 'http://example.com',
+            'dns://1.1.1.1:53' or 'whois://whois.arin.net:43'
+        threshold: (int) failures in a row that open a new breaker
+        reset_after: (float) seconds a new breaker stays open
+
+    Output:
+        (CircuitBreaker) shared breaker
+    '''
+    with _breakers_lock:
+        if upstream not in _breakers:
+            _breakers[upstream] = CircuitBreaker(threshold, reset_after)
+        return _breakers[upstream]
+
+
+def open_breakers():
+    '''
+    Output:
+        (list of strs) upstreams whose breakers are currently open
+    '''
+    with _breakers_lock:
+        breakers = list(_breakers.items())
+    return [upstream for upstream, breaker in breakers
+        if breaker.state == 'open']
@@ -0,0 +1,128 @@
+'''
+This file decodes Pushshift submissions, from API pages or from raw NDJSON
+dump files, keeping only the fields the scraper reads
+'''
+
+import io
+import re
+import json
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the only submission fields extract_rows and scrape_window look at
+POST_FIELDS = ('id', 'created_utc', 'selftext', 'url')
+# Pushshift dumps are compressed with a long window, which zstandard refuses
+# to decode by default
+ZST_WINDOW = 2 ** 31
+CHUNK_SIZE = 2 ** 24
+# finds a submission's subreddit without decoding the rest of its line
+SUBREDDIT_FIELD = re.compile(rb'"subreddit"\s*:\s*"([^"\\]*)"')
+
+
+def project(post, fields = POST_FIELDS):
+    '''
+    Keeps only the fields the scraper needs from a decoded submission, so the
+    rest can be freed straight away.
+
+    Inputs:
+        post: (dict) decoded submission
+        fields: (tuple of strs) fields to keep; fields the post lacks are
+            left out rather than set to None
+
+    Output:
+        (dict) projected submission, with created_utc as an int
+    '''
+    projected = {field: post[field] for field in fields if field in post}
+    if 'created_utc' in projected:
+        projected['created_utc'] = int(projected['created_utc'])
+    return projected
+
+
+def parse_page(body):
+    '''
+    Decodes a Pushshift search response.
+
+    Input:
+        body: (bytes or str) raw response body
+
+    Output:
+        (list of dicts) projected submissions, in the order the API sent them
+    '''
+    return [project(post) for post in loads(body)['data']]
+
+
+def iter_lines(path, chunk_size = CHUNK_SIZE):
+    '''
+    Reads a dump file one line at a time without holding more than one chunk
+    of it in memory. Files ending in .zst are decompressed on the fly.
+
+    Inputs:
+        path: (str) path to an NDJSON or .zst compressed NDJSON file
+        chunk_size: (int) bytes to read at a time
+
+    Output:
+        (generator of bytes) lines, without line endings
+    '''
+    with open(path, 'rb') as fh:
+        if path.endswith('.zst'):
+            if zstandard is None:
+                raise ImportError('reading .zst dumps needs the zstandard '
+                    'package')
+            reader = zstandard.ZstdDecompressor(
+                max_window_size = ZST_WINDOW).stream_reader(fh)
+        else:
+            reader = io.BufferedReader(fh)
+        tail = b''
+        while True:
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                break
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield line
+        if tail.strip():
+            yield tail
+
+
+def filter_lines(lines, windows):
+    '''
+    Picks the submissions that fall in one of the wanted subreddit windows
+    out of a batch of dump lines. Lines from other subreddits are skipped
+    before they are decoded.
+
+    Inputs:
+        lines: (list of bytes) NDJSON lines from iter_lines
+        windows: (dict) maps lowercased subreddit names to lists of
+            (after, before) timestamp pairs, both exclusive
+
+    Output:
+        (dict) maps lowercased subreddit names to lists of projected
+        submissions, in file order
+    '''
+    found = {}
+    for line in lines:
+        # crossposts nest their parent's subreddit in the line too, so look
+        # at every match and leave the final say to the decoded post
+        if not any(name.decode('utf-8', 'replace').lower() in windows
+            for name in SUBREDDIT_FIELD.findall(line)):
+            continue
+        post = loads(line)
+        subreddit = str(post.get('subreddit', '')).lower()
+        if subreddit not in windows:
+            continue
+        post = project(post)
+        if any(after < post['created_utc'] < before
+            for after, before in windows[subreddit]):
+            found.setdefault(subreddit, []).append(post)
+    return found
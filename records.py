@@ -0,0 +1,164 @@
+'''
+This file holds the compact record types combine.py passes through its
+pipeline: one UrlRecord per url, with a ResolvedHost per IP address and a
+WhoisRecord shared by every url hosted on the same IP
+'''
+
+import sys
+import ipaddress
+
+# stored for whois keys a WhoIs response did not have
+KEY_NOT_FOUND = '**WHOIS KEY NOT FOUND**'
+
+
+def intern(value):
+    '''
+    Interns strings, so that repeated org names, places and subreddits are
+    stored once, and passes anything else through.
+    '''
+    if type(value) is str:
+        return sys.intern(value)
+    return value
+
+
+class WhoisRecord:
+    '''
+    The whois_keys fields of a parsed WhoIs response, as one tuple of
+    interned values.
+    '''
+    __slots__ = ('keys', 'values')
+
+    def __init__(self, keys, values):
+        '''
+        Inputs:
+            keys: (tuple of strs) whois keys, shared by every record
+            values: (tuple) values in the order of keys
+        '''
+        self.keys = keys
+        self.values = values
+
+    @classmethod
+    def from_parsed(cls, parsed, keys):
+        '''
+        Builds a record from a parsed WhoIs dict as ip_whois returns it.
+
+        Inputs:
+            parsed: (dict, or None) parsed response, None if the lookup
+                failed
+            keys: (tuple of strs) whois keys to keep
+
+        Output:
+            (WhoisRecord) record; failed lookups get None for every key and
+            keys missing from the response get KEY_NOT_FOUND
+        '''
+        if parsed is None:
+            return cls(keys, (None,) * len(keys))
+        return cls(keys, tuple(intern(parsed.get(key, KEY_NOT_FOUND))
+            for key in keys))
+
+    def get(self, key, default = None):
+        '''
+        Returns the value of a whois key, like dict.get.
+        '''
+        try:
+            return self.values[self.keys.index(key)]
+        except ValueError:
+            return default
+
+
+class ResolvedHost:
+    '''
+    One IP address a url resolved to, packed into an int, with its WhoIs
+    record.
+    '''
+    __slots__ = ('ip', 'version', 'whois')
+
+    def __init__(self, ip, whois = None):
+        '''
+        Inputs:
+            ip: (str, or None) IP address, None if the domain did not resolve
+            whois: (WhoisRecord, or None) WhoIs record for the address
+        '''
+        if ip is None:
+            self.ip, self.version = None, 0
+        else:
+            address = ipaddress.ip_address(ip)
+            self.ip, self.version = int(address), address.version
+        self.whois = whois
+
+    @property
+    def address(self):
+        '''
+        The IP address as a string, None if the domain did not resolve.
+        '''
+        if self.ip is None:
+            return None
+        if self.version == 4:
+            return str(ipaddress.IPv4Address(self.ip))
+        return str(ipaddress.IPv6Address(self.ip))
+
+
+class UrlRecord:
+    '''
+    A url as it moves through combine.go: read from a scraper database,
+    resolved to an effective url and domain, then to hosts.
+    '''
+    __slots__ = ('url_id', 'url', 'subreddit', 'date', 'post_id',
+        'checkpoint', 'eff_url', 'domain', 'hosts')
+
+    def __init__(self, url_id, url, subreddit, date, post_id, checkpoint):
+        '''
+        Inputs:
+            url_id: (str) id of the url in the scraper database
+            url: (str) url as posted
+            subreddit: (str) subreddit the url was posted in
+            date: (int) post date, unix seconds
+            post_id: (str) id of the post
+            checkpoint: (str) subreddit whose checkpoint covers the url
+        '''
+        self.url_id = url_id
+        self.url = url
+        self.subreddit = intern(subreddit)
+        self.date = date
+        self.post_id = post_id
+        self.checkpoint = intern(checkpoint)
+        self.eff_url = None
+        self.domain = None
+        self.hosts = []
+
+    def set_domain(self, domain):
+        self.domain = intern(domain)
+
+    def url_params(self):
+        '''
+        Output:
+            (tuple) bind parameters for combine.INSERT_URL_DATA
+        '''
+        return (self.url_id, self.url, self.subreddit, self.domain, self.date)
+
+    def ip_params(self, keys):
+        '''
+        Builds the analysis_ips bind parameters for the url's hosts. Each
+        host is weighted by one over the number of addresses the domain
+        resolved to.
+
+        Input:
+            keys: (list of strs) whois keys in the order of the columns they
+                fill
+
+        Output:
+            (list of tuples) bind parameters for combine.INSERT_DATA_IP, one
+            per resolved host
+        '''
+        weight = 1 / len(self.hosts) if self.hosts else None
+        return [(self.url_id, host.address, self.domain) +
+            tuple(host.whois.get(key) if host.whois is not None else None
+            for key in keys) + (weight,)
+            for host in self.hosts if host.ip is not None]
+
+    def index_params(self):
+        '''
+        Output:
+            (tuple) (url, subreddit, post date, post id) for url_index
+        '''
+        return (self.url, self.subreddit, self.date, self.post_id)
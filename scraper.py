@@ -1,7 +1,6 @@
 # This script scrapes reddit posts and extracts urls
 
 import requests
-import re
 import os
 import time
 import json
@@ -9,104 +8,568 @@ import uuid
 import math
 import random
 import sqlite3
+import asyncio
+import functools
+import collections
+import multiprocessing
+import email.utils
+import url_extract
+import post_stream
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 
 SIZE = 100
 six_weeks = 604800 * 6
-query = """INSERT INTO urls (url_id, url_text, url_domain, url_type,
+PUSHSHIFT_URL = 'https://api.pushshift.io/reddit/search/submission'
+query = """INSERT OR IGNORE INTO urls (url_id, url_text, url_domain, url_type,
         post_date, subreddit_name, post_id)
         VALUES (?, ?, ?, ?, ?, ?, ?);"""
 command = """
-    CREATE TABLE urls 
+    CREATE TABLE IF NOT EXISTS urls 
     (url_id VARCHAR(40),
     url_text VARCHAR(255),
     url_domain VARCHAR(255),
     url_type VARCHAR(40),
     post_date DATETIME,
     subreddit_name VARCHAR(255),
-    post_id VARCHAR(40));"""
+    post_id VARCHAR(40));
+    CREATE UNIQUE INDEX IF NOT EXISTS urls_url_id ON urls (url_id);"""
+# the optional consolidated store holds every subreddit's urls in one file,
+# indexed so readers can pull one subreddit's window without a full scan
+URLS_PATH = 'data/urls.sql'
+consolidated_command = """
+    CREATE INDEX IF NOT EXISTS urls_subreddit_date
+        ON urls (subreddit_name, post_date);"""
+# PRAGMAs set on every database the scraper writes to
+PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}
 
 
-def get_more_posts(subreddit, before):
+def subreddit_window(subreddit_link):
+    '''
+    Reads one line of subreddits.txt.
+    Input:
+        subreddit_link (string): 'name,YYYY-MM-DD'
+    Output:
+        (tuple) subreddit name, and the timestamps six weeks either side of
+        the date
+    '''
+    subreddit, day = subreddit_link.split(',')
+    day = int(datetime.strptime(day, '%Y-%m-%d').timestamp())
+    return subreddit, day - six_weeks, day + six_weeks
+
+
+def urls_path(subreddit, consolidated = False):
+    '''
+    Gives the database a subreddit's urls are stored in.
+    Input:
+        subreddit (string): name of the subreddit
+        consolidated (bool): use the single store shared by all subreddits
+            instead of one file per subreddit
+    Output:
+        (string) path to the database
+    '''
+    if consolidated:
+        return URLS_PATH
+    return f'data/{subreddit}.sql'
+
+
+class TokenBucket:
+    '''
+    Token-bucket rate limiter shared by every request of a scrape: tokens
+    refill at rate per second up to capacity, and each request spends one.
+    '''
+    def __init__(self, rate, capacity):
+        '''
+        Inputs:
+            rate: (float) tokens added per second
+            capacity: (int) maximum burst of requests
+        '''
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        '''
+        Waits until a token is available and spends it.
+        '''
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def make_session(pool_size):
+    '''
+    Creates the HTTP session shared by a scrape, with a connection pool big
+    enough for every concurrent request.
+
+    Input:
+        pool_size: (int) number of pooled connections per host
+
+    Output:
+        (requests.Session) session
+    '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections = 1,
+        pool_maxsize = pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def retry_delay(resp, attempt, base_delay = 1, max_delay = 60):
+    '''
+    Works out how long to wait before retrying a failed request: the
+    server's Retry-After if it sent one, otherwise exponential backoff with
+    full jitter.
+
+    Inputs:
+        resp: (requests.Response, or None) failed response, None if the
+            request never got one
+        attempt: (int) number of failed attempts so far, starting at 0
+        base_delay: (float) backoff for the first retry, in seconds
+        max_delay: (float) longest backoff, in seconds
+
+    Output:
+        (float) seconds to wait
+    '''
+    retry_after = resp.headers.get('Retry-After') if resp is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+                return max(0, retry_at.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+async def get_more_posts(session, limiter, subreddit, before, after = None,
+    api_url = PUSHSHIFT_URL, max_attempts = 10):
     '''
     Gets the subreddit posts.
     Input:
+        session (requests.Session): shared HTTP session
+        limiter (TokenBucket): shared rate limiter
         subreddit (string): name of the subreddit 
         before (int): timestamp to limit the search 
+        after (int): optional timestamp the posts must be newer than
+        api_url (string): Pushshift submission search endpoint
+        max_attempts (int): attempts before giving up on the page
     '''
-    url = 'https://api.pushshift.io/reddit/search/submission?'
-    url += f'subreddit={subreddit}&before={before}&size={SIZE}&sort=desc'
+    params = {'subreddit': subreddit, 'before': before, 'size': SIZE,
+        'sort': 'desc'}
+    if after is not None:
+        params['after'] = after
     print('scraping before:', datetime.fromtimestamp(before))
-    resp = requests.get(url, timeout = 200)
-    status_code = resp.status_code
-    if status_code == 200:
-        return resp.json()['data']
-    else:
-        print('no output; sleeping for 1 min before retrying...')
-        time.sleep(60*1)
-        return get_more_posts(subreddit, before)
+    loop = asyncio.get_running_loop()
+    for attempt in range(max_attempts):
+        await limiter.acquire()
+        try:
+            resp = await loop.run_in_executor(None, functools.partial(
+                session.get, api_url, params = params, timeout = 200))
+        except requests.RequestException:
+            resp = None
+        if resp is not None and resp.status_code == 200:
+            return post_stream.parse_page(resp.content)
+        delay = retry_delay(resp, attempt)
+        print(f'no output; sleeping for {delay:.1f} s before retrying...')
+        await asyncio.sleep(delay)
+    raise RuntimeError(f'giving up on r/{subreddit} before {before}')
+
+
+def make_url_id(post_id, link, url_type, deterministic = False):
+    '''
+    Makes the url_id for a link found in a post.
+    Input:
+        post_id (string): id of the post the link was found in
+        link (string): the link
+        url_type (string): where in the post the link was found, so a link
+            both in the text and as the post's url gets one id for each
+        deterministic (bool): if True the id is a uuid5 hash of the post id,
+            url type and link, so scraping the same post again gives the
+            same id; otherwise it is a random uuid4
+    Output:
+        (string) url_id
+    '''
+    if deterministic:
+        return str(uuid.uuid5(uuid.NAMESPACE_URL,
+            f'{post_id} {url_type} {link}'))
+    return str(uuid.uuid4())
+
+
+def extract_rows(posts, subreddit, seen = None, deterministic_ids = False):
+    '''
+    Extracts the links from a page of posts as rows of the urls table.
+
+    Input:
+        posts (list): posts returned by get_more_posts
+        subreddit (string): name of the subreddit
+        seen (set): optional ids of posts already written, posts in it are
+            skipped and new ones are added to it
+        deterministic_ids (bool): derive url_ids from post id, url type and
+            link, see make_url_id
+    Output:
+        (list) of tuples in the column order of query
+    '''
+    rows = []
+    for post in posts:
+        id_ = post['id']
+        if seen is not None:
+            if id_ in seen:
+                continue
+            seen.add(id_)
+        post_date = post['created_utc']
+        for link, domain, url_type in url_extract.post_links(post):
+            rows.append((make_url_id(id_, link, url_type,
+                deterministic_ids), link, domain, url_type, post_date,
+                subreddit, id_))
+    return rows
+
+
+class UrlWriter:
+    '''
+    Writes the links scraped from one subreddit into its database: one
+    executemany and one transaction per page, and no post written twice.
+    '''
+    def __init__(self, db_path, subreddit, deterministic_ids = False,
+        pragmas = PRAGMAS, consolidated = False):
+        '''
+        Input:
+            db_path (string): path to the subreddit's database
+            subreddit (string): name of the subreddit
+            deterministic_ids (bool): derive url_ids from post id and link,
+                so that re-scrapes do not add duplicate rows
+            pragmas (dict): sqlite PRAGMAs to set on the connection
+            consolidated (bool): db_path is the store shared by all
+                subreddits, which also gets the (subreddit, date) index
+        '''
+        self.subreddit = subreddit
+        self.deterministic_ids = deterministic_ids
+        self.seen = set()
+        self.connection = sqlite3.connect(db_path)
+        for pragma, value in pragmas.items():
+            self.connection.execute(f'PRAGMA {pragma}={value}')
+        self.connection.executescript(command)
+        if consolidated:
+            self.connection.executescript(consolidated_command)
+
+    def write(self, posts):
+        '''
+        Writes the links found in a page of posts.
+        Input:
+            posts (list): posts returned by get_more_posts
+        '''
+        rows = extract_rows(posts, self.subreddit, self.seen,
+            self.deterministic_ids)
+        with self.connection:
+            self.connection.executemany(query, rows)
+
+    def close(self):
+        self.connection.close()
+
+
+async def scrape_window(session, limiter, subreddit, after, before,
+    writer, api_url = PUSHSHIFT_URL):
+    '''
+    Walks a subreddit backwards from before to after, one page at a time, and
+    writes the links found to the subreddit's database.
+
+    Input:
+        session (requests.Session): shared HTTP session
+        limiter (TokenBucket): shared rate limiter
+        subreddit (string): name of the subreddit
+        after (int): timestamp the window starts at
+        before (int): timestamp the window ends at
+        writer (UrlWriter): writer for the subreddit's database
+        api_url (string): Pushshift submission search endpoint
+    '''
+    get_farthest = before
+    output_length = SIZE
+    while output_length == SIZE and get_farthest >= after:
+        posts = await get_more_posts(session, limiter, subreddit,
+            get_farthest, after, api_url)
+        output_length = len(posts)
+        if not posts:
+            break
+        writer.write(posts)
+        post_date = posts[-1]['created_utc']
+        if get_farthest != post_date:
+            get_farthest = post_date
+        else:
+            get_farthest -= 1
+
+
+def plan_shards(page_length, page_span, remaining_span, pages_per_shard = 10,
+    max_shards = 16):
+    '''
+    Picks how many sub-windows to split the rest of a scrape into, from the
+    post density seen on its first page, so that each sub-window holds about
+    pages_per_shard pages of posts.
+
+    Input:
+        page_length (int): number of posts on the first page
+        page_span (int): seconds covered by the first page
+        remaining_span (int): seconds left to scrape
+        pages_per_shard (int): pages of posts to aim for per sub-window
+        max_shards (int): most sub-windows to split into
+
+    Output:
+        (int) number of sub-windows
+    '''
+    density = page_length / max(page_span, 1)
+    expected_pages = density * remaining_span / SIZE
+    shards = math.ceil(expected_pages / pages_per_shard)
+    return max(1, min(max_shards, shards))
+
+
+def shard_window(after, before, shards):
+    '''
+    Splits the window between after and before into equal sub-windows.
+    Pushshift treats both bounds as exclusive, so each sub-window starts one
+    second before the edge the previous one ends at: together they cover
+    every second of the window exactly once, without overlap.
+
+    Input:
+        after (int): timestamp the window starts at
+        before (int): timestamp the window ends at
+        shards (int): number of sub-windows
+
+    Output:
+        (list) of (after, before) timestamp pairs, newest first
+    '''
+    step = (before - after) / shards
+    edges = [after + round(i * step) for i in range(shards)] + [before]
+    windows = [(edges[i] - 1 if i else edges[i], edges[i + 1])
+        for i in range(shards)]
+    return windows[::-1]
+
+
+async def scrape_subreddit(session, limiter, subreddit, after, before,
+    writer, api_url = PUSHSHIFT_URL, shards = None, pages_per_shard = 10,
+    max_shards = 16):
+    '''
+    Scrapes a subreddit's window as several sub-windows walked concurrently,
+    merging them into the subreddit's database without duplicate posts.
+    The newest page is fetched first and, unless shards is given, the number
+    of sub-windows is picked from its post density (see plan_shards).
+
+    Input:
+        session (requests.Session): shared HTTP session
+        limiter (TokenBucket): shared rate limiter
+        subreddit (string): name of the subreddit
+        after (int): timestamp the window starts at
+        before (int): timestamp the window ends at
+        writer (UrlWriter): writer for the subreddit's database
+        api_url (string): Pushshift submission search endpoint
+        shards (int): number of sub-windows, None to pick adaptively
+        pages_per_shard (int): pages of posts to aim for per sub-window
+        max_shards (int): most sub-windows to split into
+    '''
+    posts = await get_more_posts(session, limiter, subreddit, before, after,
+        api_url)
+    writer.write(posts)
+    if len(posts) < SIZE:
+        return
+    oldest = posts[-1]['created_utc']
+    if shards is None:
+        shards = plan_shards(len(posts), before - oldest, oldest - after,
+            pages_per_shard, max_shards)
+    # let every sub-window finish before raising, as they share the writer
+    results = await asyncio.gather(*[scrape_window(session, limiter,
+        subreddit, shard_after, shard_before, writer, api_url)
+        for shard_after, shard_before in shard_window(after, oldest + 1,
+        shards)], return_exceptions = True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
 
+async def get_subreddits_async(subreddits, rate = 1.0, burst = 5,
+    max_connections = 8, api_url = PUSHSHIFT_URL, shards = None,
+    pages_per_shard = 10, max_shards = 16, deterministic_ids = False,
+    consolidated = False):
+    '''
+    Downloads posts for every subreddit concurrently and writes them into
+    databases. All requests share one connection pool and one rate limiter,
+    and each subreddit's window is split into concurrently scraped
+    sub-windows (see scrape_subreddit). A subreddit that fails, e.g. on a
+    page that runs out of attempts, is reported and skipped without
+    stopping the others.
+
+    Input:
+        subreddits (list): subreddits to go through, as 'name,YYYY-MM-DD'
+        rate (float): requests per second allowed by the API quota
+        burst (int): requests that may be sent back to back
+        max_connections (int): requests in flight at once
+        api_url (string): Pushshift submission search endpoint
+        shards (int): sub-windows per subreddit, None to pick adaptively
+        pages_per_shard (int): pages of posts to aim for per sub-window
+        max_shards (int): most sub-windows per subreddit
+        deterministic_ids (bool): derive url_ids from post id and link, so
+            re-scrapes are idempotent, see make_url_id
+        consolidated (bool): write every subreddit to the single store at
+            URLS_PATH instead of one database per subreddit
+    Output:
+        (dict) maps each subreddit that failed to its exception
+    '''
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_connections))
+    session = make_session(max_connections)
+    limiter = TokenBucket(rate, burst)
+
+    async def scrape(subreddit_link):
+        subreddit, after, before = subreddit_window(subreddit_link)
+        writer = UrlWriter(urls_path(subreddit, consolidated), subreddit,
+            deterministic_ids, consolidated = consolidated)
+        try:
+            await scrape_subreddit(session, limiter, subreddit, after, before,
+                writer, api_url, shards, pages_per_shard, max_shards)
+        finally:
+            writer.close()
+
+    subreddit_links = [link for link in subreddits if link]
+    try:
+        results = await asyncio.gather(*[scrape(subreddit_link)
+            for subreddit_link in subreddit_links], return_exceptions = True)
+    finally:
+        session.close()
+    failed = {}
+    for subreddit_link, result in zip(subreddit_links, results):
+        if isinstance(result, Exception):
+            subreddit = subreddit_link.split(',')[0]
+            print(f'scraping r/{subreddit} failed: {result}')
+            failed[subreddit] = result
+    return failed
 
-def get_subreddits(subreddits):
+
+def get_subreddits(subreddits, **kwargs):
     '''
     Downloads posts and writes them into databases.
 
     Input:
         subreddits (list): subreddits to go through
+        kwargs: passed on to get_subreddits_async
+    Output:
+        (dict) maps each subreddit that failed to its exception
     '''
+    return asyncio.run(get_subreddits_async(subreddits, **kwargs))
+
+
+def load_dump(path, subreddits, processes = 1, chunk_lines = 20000,
+    max_pending = None, deterministic_ids = True, consolidated = False):
+    '''
+    Backfills subreddits from a Pushshift submissions dump instead of the
+    API, writing the same rows get_subreddits would into the same databases,
+    in one pass over the dump for every subreddit. The main process
+    decompresses the dump and splits it into batches of lines, which are
+    decoded and filtered to the subreddits' windows either in the main
+    process or on worker processes; the results are written in dump order,
+    one transaction per subreddit per batch. At most max_pending batches are
+    out at once, so memory stays flat however big the dump is.
+
+    Input:
+        path (string): path to an RS_*.zst or NDJSON submissions dump
+        subreddits (list): subreddits to go through, as 'name,YYYY-MM-DD'
+        processes (int): worker processes, 1 to filter in the main process,
+            None for one per CPU
+        chunk_lines (int): dump lines per batch
+        max_pending (int): batches in flight, None for twice processes
+        deterministic_ids (bool): derive url_ids from post id and link, so
+            loading overlapping dumps, loading a dump on top of a scrape or
+            re-running is idempotent
+        consolidated (bool): write to the single store at URLS_PATH
+    Output:
+        (dict) number of posts written per subreddit
+    '''
+    windows = {}
+    names = {}
     for subreddit_link in subreddits:
-        subreddit, day = subreddit_link.split(',')
-        day = int(datetime.strptime(day, '%Y-%m-%d').timestamp())
-        next_6_weeks = day + six_weeks
-        prev_6_weeks = day - six_weeks
-        get_farthest = next_6_weeks
-        output_length = 100
-
-        connection = sqlite3.connect(f'data/{subreddit}.sql')
-        cursor = connection.cursor()
-        cursor.execute(command)
-
-        while output_length == 100 and get_farthest >= prev_6_weeks:
-            posts = get_more_posts(subreddit, get_farthest)
-            output_length = len(posts)
-            
-            for post in posts:
-                id_ = post['id']
-                post_date = post['created_utc']
-            
-                # url in text
-                if 'selftext' in post:
-                    domain_links = re.findall('''\(https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+''', post['selftext'])
-                    domain_links = [re.sub('[()]', '', x) for x in domain_links]
-                    all_links = re.findall('\(https?://[^\s]+\)', post['selftext'])
-                    all_links = [re.sub('[()]', '', x) for x in all_links]
-                    for ind, link in enumerate(all_links):
-                        if 'redd.it' not in link and \
-                        'reddit.com' not in link:
-                            cursor.execute(query,
-                                [str(uuid.uuid4()), link, domain_links[ind], 'text',
-                                    post_date, subreddit, id_]).fetchall()
-                
-                # url in media
-                all_links = re.findall('https?://[^\s]+', post['url'])
-                for a_link in all_links:
-                    if 'redd.it' not in a_link and \
-                    'reddit.com' not in a_link:
-                        domain_link = re.findall('https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+', a_link)
-                        cursor.execute(query,
-                            [str(uuid.uuid4()), a_link, domain_link[0], 'media',
-                                post_date, subreddit, id_]).fetchall()
-            
-            if get_farthest != post_date:
-                get_farthest = post_date
-            else:
-                get_farthest -= 1
-            
-            connection.commit()
-        
-        connection.close()
-        time.sleep(1 + random.randint(0, 1))
+        if not subreddit_link:
+            continue
+        subreddit, after, before = subreddit_window(subreddit_link)
+        windows.setdefault(subreddit.lower(), []).append((after, before))
+        names.setdefault(subreddit.lower(), subreddit)
+    writers = {}
+    counts = collections.Counter()
+
+    def write(found):
+        for key, posts in found.items():
+            if key not in writers:
+                writers[key] = UrlWriter(urls_path(names[key],
+                    consolidated), names[key], deterministic_ids,
+                    consolidated = consolidated)
+            writers[key].write(posts)
+            counts[names[key]] += len(posts)
+
+    def batches():
+        chunk = []
+        for line in post_stream.iter_lines(path):
+            chunk.append(line)
+            if len(chunk) == chunk_lines:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    try:
+        if processes == 1:
+            for chunk in batches():
+                write(post_stream.filter_lines(chunk, windows))
+        else:
+            processes = processes or os.cpu_count()
+            max_pending = max_pending or 2 * processes
+            pending = collections.deque()
+            with multiprocessing.Pool(processes) as pool:
+                for chunk in batches():
+                    if len(pending) == max_pending:
+                        write(pending.popleft().get())
+                    pending.append(pool.apply_async(post_stream.filter_lines,
+                        (chunk, windows)))
+                while pending:
+                    write(pending.popleft().get())
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return dict(counts)
+
+
+def ingest_dump(path, subreddits_path = 'data/subreddits.txt',
+    processes = None, chunk_lines = 20000, max_pending = None,
+    deterministic_ids = True, consolidated = False):
+    '''
+    Bulk loads a Pushshift monthly submissions dump (RS_*.zst) into the
+    subreddit databases, keeping only the subreddits and windows listed in
+    subreddits.txt and decoding the dump on worker processes (see
+    load_dump).
+
+    Input:
+        path (string): path to an RS_*.zst or NDJSON submissions dump
+        subreddits_path (string): file of 'name,YYYY-MM-DD' lines
+        processes (int): worker processes, None for one per CPU
+        chunk_lines (int): dump lines per batch
+        max_pending (int): batches in flight, None for twice processes
+        deterministic_ids (bool): derive url_ids from post id and link, see
+            load_dump
+        consolidated (bool): write to the single store at URLS_PATH
+    Output:
+        (dict) number of posts written per subreddit
+    '''
+    with open(subreddits_path) as links:
+        subreddits = links.read().split('\n')
+    return load_dump(path, subreddits, processes, chunk_lines, max_pending,
+        deterministic_ids, consolidated)
 
 
 def go(mode='scrape'):
@@ -0,0 +1,38 @@
+'''
+Tests for analyze_spread.calc_daily_spread matching urls as posted or by
+canonical url
+'''
+
+import datetime as dt
+
+import pandas as pd
+
+import analyze_spread
+
+START = dt.datetime(2019, 1, 1)
+END = dt.datetime(2019, 1, 5)
+
+
+def frame(posts):
+    return pd.DataFrame({'url': [url for url, _, _ in posts],
+                         'domain': [domain for _, domain, _ in posts],
+                         'post_date': pd.to_datetime([date for _, _, date in posts])})
+
+
+MAIN = frame([('https://www.example.com/a/?utm_source=feed', 'https://www.example.com',
+               '2019-01-02 12:00'),
+              ('https://example.com/b', 'https://example.com', '2019-01-02 13:00')])
+COMPARE = frame([('http://example.com/a', 'http://example.com', '2019-01-03 09:00'),
+                 ('https://example.com/b', 'https://example.com', '2019-01-03 10:00')])
+
+
+def test_as_posted_needs_the_same_url():
+    daily = analyze_spread.calc_daily_spread(MAIN, COMPARE, START, END)
+    assert daily == {START: 0, START + dt.timedelta(days=1): 0.5,
+                     START + dt.timedelta(days=2): 0.5, START + dt.timedelta(days=3): 0}
+
+
+def test_canonical_matches_other_forms_of_a_url():
+    daily = analyze_spread.calc_daily_spread(MAIN, COMPARE, START, END, canonical=True)
+    assert daily == {START: 0, START + dt.timedelta(days=1): 1.0,
+                     START + dt.timedelta(days=2): 1.0, START + dt.timedelta(days=3): 0}
@@ -0,0 +1,73 @@
+'''
+Tests for the schema migrations in combine.py, run on copies of the
+shipped databases
+'''
+
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+import combine
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def is_sqlite(path):
+    '''
+    Checks for the sqlite header, since a checkout without git-lfs holds
+    pointer files in place of the databases.
+    '''
+    with open(path, 'rb') as fh:
+        return fh.read(16) == b'SQLite format 3\x00'
+
+
+@pytest.fixture
+def dbs(tmp_path):
+    '''
+    Copies of the shipped domain cache and analysis database. If the
+    analysis database was not fetched, one is made with the original schema.
+    '''
+    cache_path = str(tmp_path / 'domain_cache.sql')
+    analysis_path = str(tmp_path / 'analysis.sql')
+    shutil.copy(os.path.join(REPO, 'domain_cache.sql'), cache_path)
+    shipped = os.path.join(REPO, 'data', 'analysis.sql')
+    if is_sqlite(shipped):
+        shutil.copy(shipped, analysis_path)
+    else:
+        combine.migrate(analysis_path, combine.ANALYSIS_MIGRATIONS[:1])
+    return cache_path, analysis_path
+
+
+def test_hot_lookups_use_indexes(dbs):
+    combine.init_dbs(*dbs)
+    assert combine.unindexed_lookups(*dbs) == []
+
+
+def test_original_cache_schema_scans(dbs):
+    # the original tables, plus the whois table but none of the indexes
+    combine.migrate(dbs[0], combine.DOMAIN_CACHE_MIGRATIONS[:1])
+    connection = sqlite3.connect(dbs[0])
+    connection.executescript(combine.DOMAIN_CACHE_MIGRATIONS[2])
+    connection.close()
+    combine.migrate(dbs[1], combine.ANALYSIS_MIGRATIONS)
+    assert combine.unindexed_lookups(*dbs) == \
+        combine.HOT_LOOKUPS['domain_cache'][:2]
+
+
+def test_migrations_upgrade_in_place(dbs):
+    cache_path, analysis_path = dbs
+    connection = sqlite3.connect(cache_path)
+    before = connection.execute('SELECT COUNT(DISTINCT url) FROM redir'
+        ).fetchone()[0]
+    connection.close()
+    combine.init_dbs(cache_path, analysis_path)
+    combine.init_dbs(cache_path, analysis_path)
+    connection = sqlite3.connect(cache_path)
+    assert connection.execute('PRAGMA user_version').fetchone()[0] == \
+        len(combine.DOMAIN_CACHE_MIGRATIONS)
+    assert connection.execute('SELECT COUNT(*) FROM redir').fetchone()[0] \
+        == before
+    connection.close()
+
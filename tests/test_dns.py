@@ -0,0 +1,118 @@
+'''
+Tests for url_tools.resolve_domains and prefetch_domains against a local
+UDP stub DNS server
+'''
+
+import socketserver
+import threading
+import time
+
+import dns.message
+import dns.rcode
+import dns.rrset
+import pytest
+
+import combine
+import domain_cache
+import negative_cache
+import url_tools
+
+
+class StubDNSHandler(socketserver.BaseRequestHandler):
+    '''
+    Answers A queries after a short wait, recording each name and counting
+    how many are open at once. missing.test does not exist, empty.test has no
+    A records, broken.test gets SERVFAIL and any other name resolves to
+    10.0.0.1.
+    '''
+    def handle(self):
+        data, sock = self.request
+        server = self.server
+        query = dns.message.from_wire(data)
+        name = query.question[0].name.to_text()
+        with server.lock:
+            server.queries.append(name)
+            server.open_queries += 1
+            server.most_open = max(server.most_open, server.open_queries)
+        time.sleep(0.05)
+        response = dns.message.make_response(query)
+        if name == 'missing.test.':
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        elif name == 'broken.test.':
+            response.set_rcode(dns.rcode.SERVFAIL)
+        elif name != 'empty.test.':
+            response.answer.append(dns.rrset.from_text(name, 60, 'IN', 'A',
+                '10.0.0.1'))
+        with server.lock:
+            server.open_queries -= 1
+        sock.sendto(response.to_wire(), self.client_address)
+
+
+@pytest.fixture
+def stub():
+    negative_cache._breakers.clear()
+    server = socketserver.ThreadingUDPServer(('127.0.0.1', 0), StubDNSHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.queries = []
+    server.open_queries = 0
+    server.most_open = 0
+    server.port = server.server_address[1]
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def resolve(stub, domains, **kwargs):
+    return url_tools.resolve_domains(domains, dns_servers = ['127.0.0.1'],
+        dns_port = stub.port, **kwargs)
+
+
+def test_duplicates_queried_once(stub):
+    results = resolve(stub, ['a.test', 'b.test', 'a.test', 'a.test'])
+    assert results == {'a.test': ['10.0.0.1'],
+        'b.test': ['10.0.0.1']}
+    assert sorted(stub.queries) == ['a.test.', 'b.test.']
+
+
+def test_in_flight_bounded(stub):
+    domains = [f'd{i}.test' for i in range(12)]
+    results = resolve(stub, domains, max_in_flight = 3)
+    assert list(results) == domains
+    assert stub.most_open == 3
+
+
+def test_error_classes(stub):
+    errors = {}
+    results = resolve(stub, ['missing.test', 'empty.test', 'broken.test',
+        'a.test'], errors = errors)
+    assert errors == {'missing.test': 'nxdomain', 'empty.test': 'no_answer',
+        'broken.test': 'server'}
+    assert results['missing.test'] == results['empty.test'] == \
+        results['broken.test'] == [None]
+    assert results['a.test'] == ['10.0.0.1']
+
+
+def test_prefetch_writes_once_and_skips_cached(stub, tmp_path):
+    path = str(tmp_path / 'domain_cache.sql')
+    combine.migrate(path, combine.DOMAIN_CACHE_MIGRATIONS)
+    cache = domain_cache.DomainCache(path)
+    writes = []
+    add_domains = cache.add_domains
+    cache.add_domains = lambda resolved, errors = None: \
+        writes.append(dict(resolved)) or add_domains(resolved, errors)
+    try:
+        assert url_tools.prefetch_domains(['a.test', 'missing.test',
+            'a.test'], dns_servers = ['127.0.0.1'], dns_port = stub.port,
+            cache = cache) == 2
+        assert writes == [{'a.test': ['10.0.0.1'],
+            'missing.test': [None]}]
+        assert cache.get_failure('dns', 'missing.test')[0] == 'nxdomain'
+        # both are cached now, the failure until it is due
+        assert url_tools.prefetch_domains(['a.test', 'missing.test'],
+            dns_servers = ['127.0.0.1'], dns_port = stub.port,
+            cache = cache) == 0
+        assert len(stub.queries) == 2
+    finally:
+        cache.close()
@@ -0,0 +1,107 @@
+'''
+Tests for the failures DomainCache keeps: fresh failures are answered from
+the cache, due ones read as misses so they are looked up again
+'''
+
+import sqlite3
+
+import pytest
+
+import combine
+import domain_cache
+import negative_cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    '''
+    A settable time.time for the cache and negative_cache.
+    '''
+    now = [1.6e9]
+    monkeypatch.setattr(domain_cache.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'domain_cache.sql')
+
+
+@pytest.fixture
+def cache(cache_path, clock):
+    combine.migrate(cache_path, combine.DOMAIN_CACHE_MIGRATIONS)
+    cache = domain_cache.DomainCache(cache_path)
+    yield cache
+    cache.close()
+
+
+def ttl(kind, error):
+    return negative_cache.FAILURE_TTLS[kind][error]
+
+
+def test_failed_redirect_served_until_due(cache, clock):
+    cache.add_redirects([('a.com/x', 'a.com/x', False)], {'a.com/x': 'timeout'})
+    assert cache.failing('redirect', 'a.com/x')
+    assert cache.get_redirect('a.com/x') == 'a.com/x'
+    assert cache.get_redirects(['a.com/x']) == {'a.com/x': 'a.com/x'}
+    clock[0] += ttl('redirect', 'timeout')
+    assert not cache.failing('redirect', 'a.com/x')
+    assert cache.get_redirect('a.com/x') is None
+    assert cache.get_redirects(['a.com/x']) == {}
+    assert cache.due_failures() == [('redirect', 'a.com/x')]
+
+
+def test_failed_domain_served_until_due(cache, clock):
+    cache.add_domains({'gone.com': [None], 'ok.com': ['1.2.3.4']},
+        {'gone.com': 'nxdomain'})
+    assert cache.get_failure('dns', 'gone.com')[:2] == ('nxdomain', 1)
+    assert cache.get_ips('gone.com') == [None]
+    clock[0] += ttl('dns', 'nxdomain')
+    assert cache.get_ips('gone.com') is None
+    assert cache.get_domains(['gone.com', 'ok.com']) == \
+        {'ok.com': ['1.2.3.4']}
+    # failing again pushes the retry back twice as far
+    cache.add_domains({'gone.com': [None]}, {'gone.com': 'nxdomain'})
+    assert cache.get_failure('dns', 'gone.com')[1:] == \
+        (2, clock[0] + 2 * ttl('dns', 'nxdomain'))
+    cache.add_domains({'gone.com': ['5.6.7.8']})
+    assert cache.get_failure('dns', 'gone.com') is None
+    assert cache.get_ips('gone.com') == ['5.6.7.8']
+
+
+def test_failed_whois_served_until_due(cache, clock):
+    cache.add_failure('whois', '10.0.0.1', 'network')
+    assert cache.failing('whois', '10.0.0.1')
+    assert cache.get_whois('10.0.0.1') is None
+    clock[0] += ttl('whois', 'network')
+    assert not cache.failing('whois', '10.0.0.1')
+    assert cache.due_failures() == [('whois', '10.0.0.1')]
+    cache.add_whois({'CIDR': '10.0.0.0/24', 'OrgName': 'Example'})
+    cache.clear_failure('whois', '10.0.0.1')
+    assert cache.get_whois('10.0.0.1') == \
+        {'CIDR': '10.0.0.0/24', 'OrgName': 'Example'}
+    assert cache.due_failures() == []
+
+
+def test_failures_migration_seeds_old_failures_as_due(cache_path, clock):
+    combine.migrate(cache_path, combine.DOMAIN_CACHE_MIGRATIONS[:3])
+    connection = sqlite3.connect(cache_path)
+    with connection:
+        connection.executemany('INSERT INTO redir VALUES (?, ?, ?)',
+            [('a.com/ok', 'http://a.com/ok', 1),
+            ('a.com/bad', 'a.com/bad', 0)])
+        connection.executemany('INSERT INTO domains VALUES (?, ?)',
+            [('a.com', '1.2.3.4'), ('gone.com', None)])
+    connection.close()
+    assert combine.migrate(cache_path, combine.DOMAIN_CACHE_MIGRATIONS) == \
+        len(combine.DOMAIN_CACHE_MIGRATIONS)
+    cache = domain_cache.DomainCache(cache_path)
+    try:
+        assert sorted(cache.due_failures()) == \
+            [('dns', 'gone.com'), ('redirect', 'a.com/bad')]
+        assert cache.get_redirect('a.com/bad') is None
+        assert cache.get_redirect('a.com/ok') == 'http://a.com/ok'
+        assert cache.get_ips('gone.com') is None
+        assert cache.get_ips('a.com') == ['1.2.3.4']
+    finally:
+        cache.close()
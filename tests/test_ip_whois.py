@@ -0,0 +1,81 @@
+'''
+Tests for url_tools.ip_whois on saved WhoIs responses, answered by stub
+clients in place of the registries
+'''
+
+import os
+
+import pytest
+
+import combine
+import domain_cache
+import negative_cache
+import url_tools
+
+RESPONSES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'benchmarks', 'whois_responses')
+WHOIS_KEYS = ['OrgName', 'City', 'StateProv', 'Country', 'RegDate']
+
+
+def response(name):
+    with open(os.path.join(RESPONSES, name), encoding = 'utf-8') as fh:
+        return fh.read()
+
+
+class StubClient:
+    '''
+    Answers every query with one canned response, or raises OSError for
+    each entry of failures that is True, counting the queries it got.
+    '''
+    def __init__(self, text = None, failures = ()):
+        self.text = text
+        self.failures = list(failures)
+        self.queries = []
+
+    def query(self, query):
+        self.queries.append(query)
+        if self.failures and self.failures.pop(0):
+            raise OSError('stub network error')
+        return self.text
+
+
+@pytest.fixture
+def cache(tmp_path):
+    negative_cache._breakers.clear()
+    path = str(tmp_path / 'domain_cache.sql')
+    combine.migrate(path, combine.DOMAIN_CACHE_MIGRATIONS)
+    cache = domain_cache.DomainCache(path)
+    yield cache
+    cache.close()
+
+
+def test_referral_replaces_arin_block_and_holder(cache, monkeypatch):
+    ripe = StubClient(response('ripe_151.101.1.69.txt'))
+    monkeypatch.setattr(url_tools.whois_client, 'get_client',
+        lambda server, port: ripe)
+    arin = StubClient(response('arin_151.101.1.69_referral.txt'))
+    [(_, record)] = url_tools.ip_whois(['151.101.1.69'], cache = cache,
+        client = arin, whois_keys = WHOIS_KEYS)
+    assert record['OrgName'] == 'Fastly, Inc.'
+    assert 'City' not in record and 'CIDR' not in record
+    assert [str(network) for network in
+        domain_cache.whois_networks(record)] == ['151.101.0.0/16']
+    assert cache.get_whois('151.101.200.1')['OrgName'] == 'Fastly, Inc.'
+    # the rest of RIPE's /8 is not answered from Fastly's record
+    assert cache.get_whois('151.1.2.3') is None
+
+
+def test_each_ip_gets_its_own_attempts(cache):
+    client = StubClient(response('arin_104.16.0.1.txt'),
+        failures = [True, True, False, True, True, True])
+    results = url_tools.ip_whois(['104.16.0.1', '8.8.8.8'], max_attempts = 3,
+        cache = cache, client = client, whois_keys = WHOIS_KEYS)
+    assert client.queries == ['n + 104.16.0.1'] * 3 + ['n + 8.8.8.8'] * 3
+    assert results[0][1]['CIDR'] == '104.16.0.0/12'
+    assert results[1] == ('8.8.8.8', None)
+    assert cache.get_failure('whois', '104.16.0.1') is None
+    assert cache.get_failure('whois', '8.8.8.8')[:2] == ('network', 1)
+    # the cached failure answers the next lookup without a query
+    assert url_tools.ip_whois(['8.8.8.8'], cache = cache,
+        client = client) == [('8.8.8.8', None)]
+    assert len(client.queries) == 6
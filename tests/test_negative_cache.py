@@ -0,0 +1,39 @@
+'''
+Tests for the failure TTLs and circuit breakers in negative_cache.py
+'''
+
+import negative_cache
+
+
+def test_retry_at_doubles_per_failure():
+    ttl = negative_cache.FAILURE_TTLS['redirect']['timeout']
+    assert [negative_cache.retry_at('redirect', 'timeout', failures,
+        now = 1000) - 1000 for failures in (1, 2, 3)] == \
+        [ttl, 2 * ttl, 4 * ttl]
+
+
+def test_retry_at_capped_at_max_ttl():
+    assert negative_cache.retry_at('dns', 'nxdomain', 40, now = 0) == \
+        negative_cache.MAX_TTL
+    assert negative_cache.retry_at('redirect', 'too_many_redirects', 1,
+        now = 0) == negative_cache.MAX_TTL
+
+
+def test_retry_at_unknown_error_uses_default():
+    assert negative_cache.retry_at('whois', 'mystery', 0, now = 0) == \
+        negative_cache.DEFAULT_TTL
+
+
+def test_breaker_opens_and_lets_one_trial_through(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(negative_cache.time, 'monotonic', lambda: clock[0])
+    breaker = negative_cache.CircuitBreaker(threshold = 2, reset_after = 10)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record(False)
+    assert breaker.state == 'open' and not breaker.allow()
+    clock[0] += 10
+    assert breaker.state == 'half open'
+    assert breaker.allow() and not breaker.allow()
+    breaker.record(True)
+    assert breaker.state == 'closed' and breaker.allow()
@@ -0,0 +1,178 @@
+'''
+Tests for scraper.get_subreddits_async against a local mock of the
+Pushshift submission search API
+'''
+
+import json
+import random
+import sqlite3
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+import scraper
+
+DAY = '2021-03-01'
+
+
+class PushshiftHandler(BaseHTTPRequestHandler):
+    '''
+    Answers searches from the server's posts, newest first and strictly
+    between after and before. Every fail_every-th request gets a 429 with
+    Retry-After: 0, and subreddits in server.broken always get a 500.
+    '''
+    def do_GET(self):
+        server = self.server
+        params = parse_qs(urlparse(self.path).query)
+        subreddit = params['subreddit'][0]
+        with server.lock:
+            server.requests += 1
+            throttle = server.fail_every and \
+                server.requests % server.fail_every == 0
+        if throttle or subreddit in server.broken:
+            self.send_response(429 if throttle else 500)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        before = int(params['before'][0])
+        after = int(params.get('after', [-1])[0])
+        size = int(params['size'][0])
+        data = [post for post in server.posts.get(subreddit, [])
+            if after < post['created_utc'] < before][:size]
+        body = json.dumps({'data': data}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_posts(subreddit, count):
+    '''
+    Posts spread over the subreddit's scrape window, each linking to two
+    urls in its text and one as its url, newest first.
+    '''
+    _, after, before = scraper.subreddit_window(f'{subreddit},{DAY}')
+    rnd = random.Random(subreddit)
+    times = sorted(rnd.sample(range(after + 1, before), count), reverse = True)
+    return [{'id': f'{subreddit}{i:05x}', 'created_utc': created,
+        'selftext': f'see [a](https://ex{i % 7}.com/p/{i}) and '
+            f'(http://t{i % 3}.org/x/{i})',
+        'url': f'https://media{i % 5}.net/{i}'}
+        for i, created in enumerate(times)]
+
+
+@pytest.fixture
+def pushshift(tmp_path, monkeypatch):
+    (tmp_path / 'data').mkdir()
+    monkeypatch.chdir(tmp_path)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PushshiftHandler)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.fail_every = 0
+    server.broken = set()
+    server.posts = {subreddit: make_posts(subreddit, 350)
+        for subreddit in ('alpha', 'beta')}
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}' \
+        '/reddit/search/submission'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def scrape(server, subreddits, **kwargs):
+    return scraper.get_subreddits([f'{subreddit},{DAY}'
+        for subreddit in subreddits], rate = 1000, burst = 50,
+        api_url = server.url, **kwargs)
+
+
+def stored(subreddit):
+    with sqlite3.connect(scraper.urls_path(subreddit)) as connection:
+        return connection.execute('''SELECT url_id, url_text, post_id
+            FROM urls ORDER BY url_id''').fetchall()
+
+
+def test_every_post_written(pushshift):
+    assert scrape(pushshift, ['alpha', 'beta'], shards = 3) == {}
+    for subreddit in ('alpha', 'beta'):
+        rows = stored(subreddit)
+        assert len(rows) == 3 * 350
+        assert {post_id for _, _, post_id in rows} == \
+            {post['id'] for post in pushshift.posts[subreddit]}
+
+
+def test_throttled_requests_retried(pushshift):
+    pushshift.fail_every = 3
+    assert scrape(pushshift, ['alpha']) == {}
+    assert len(stored('alpha')) == 3 * 350
+
+
+def test_failed_subreddit_isolated(pushshift):
+    pushshift.broken.add('alpha')
+    failed = scrape(pushshift, ['alpha', 'beta'])
+    assert list(failed) == ['alpha']
+    assert isinstance(failed['alpha'], RuntimeError)
+    assert len(stored('beta')) == 3 * 350
+    # the failed subreddit's writer was closed, so its database reopens
+    assert stored('alpha') == []
+
+
+def test_deterministic_rescrape_idempotent(pushshift):
+    scrape(pushshift, ['alpha'], deterministic_ids = True)
+    first = stored('alpha')
+    scrape(pushshift, ['alpha'], deterministic_ids = True, shards = 4)
+    assert stored('alpha') == first
+
+
+@pytest.mark.parametrize('after, before, shards', [(0, 100, 3),
+    (1000, 87400, 7), (5, 9, 4)])
+def test_shard_window_tiles_exactly(after, before, shards):
+    # both bounds are exclusive, so every second between them is in
+    # exactly one sub-window
+    seconds = [second for low, high in scraper.shard_window(after, before,
+        shards) for second in range(low + 1, high)]
+    assert sorted(seconds) == list(range(after + 1, before))
+
+
+def test_load_dump_reads_once(tmp_path, monkeypatch):
+    (tmp_path / 'data').mkdir()
+    monkeypatch.chdir(tmp_path)
+    posts = {subreddit: make_posts(subreddit, 250)
+        for subreddit in ('alpha', 'beta')}
+    dump = tmp_path / 'RS_test.ndjson'
+    with open(dump, 'w') as fh:
+        for subreddit in ('alpha', 'beta', 'gamma'):
+            for post in posts.get(subreddit, posts['alpha'][:10]):
+                fh.write(json.dumps(dict(post, subreddit = subreddit)) + '\n')
+    reads = []
+    iter_lines = scraper.post_stream.iter_lines
+    monkeypatch.setattr(scraper.post_stream, 'iter_lines',
+        lambda path: reads.append(path) or iter_lines(path))
+    counts = scraper.load_dump(str(dump), [f'Alpha,{DAY}', f'beta,{DAY}'],
+        chunk_lines = 40)
+    assert len(reads) == 1
+    assert counts == {'Alpha': 250, 'beta': 250}
+    assert len(stored('Alpha')) == len(stored('beta')) == 3 * 250
+    # worker processes write the same rows, deterministic ids by default
+    first = stored('beta')
+    (tmp_path / 'subreddits.txt').write_text(f'Alpha,{DAY}\nbeta,{DAY}\n')
+    assert scraper.ingest_dump(str(dump), 'subreddits.txt', processes = 2,
+        chunk_lines = 40) == counts
+    assert stored('beta') == first
+
+
+def test_same_link_as_text_and_url_kept_twice():
+    post = {'id': 'abc', 'created_utc': 1614556800,
+        'selftext': 'mirror of [story](https://example.com/story)',
+        'url': 'https://example.com/story'}
+    rows = scraper.extract_rows([post], 'alpha', deterministic_ids = True)
+    assert len({row[0] for row in rows}) == len(rows) == 2
+    assert rows == scraper.extract_rows([post], 'alpha',
+        deterministic_ids = True)
@@ -0,0 +1,91 @@
+'''
+Tests for the canonical url index in url_index.py
+'''
+
+import sqlite3
+
+import pytest
+
+import combine
+import url_index
+
+
+@pytest.fixture
+def connection(tmp_path):
+    analysis_path = str(tmp_path / 'analysis.sql')
+    combine.migrate(analysis_path, combine.ANALYSIS_MIGRATIONS)
+    connection = sqlite3.connect(analysis_path)
+    yield connection
+    connection.close()
+
+
+@pytest.mark.parametrize('url', ['https://www.Example.com/a/',
+    'http://example.com/a', 'example.com/a#comments',
+    'https://example.com/a?utm_source=twitter&fbclid=xyz'])
+def test_canonical_forms_of_one_page(url):
+    assert url_index.canonical_url(url) == 'example.com/a'
+
+
+def test_canonical_keeps_what_names_the_page():
+    assert url_index.canonical_url('https://example.com/Watch?v=Ab1&utm_medium=x') \
+        == 'example.com/Watch?v=Ab1'
+    assert url_index.canonical_url('https://m.example.com/a') != \
+        url_index.canonical_url('https://example.com/a')
+
+
+def test_lookup_merges_forms_oldest_first(connection):
+    with connection:
+        url_index.add_posts(connection, [
+            ('https://www.example.com/a/', 'beta', 1550000300, 'b2'),
+            ('http://example.com/a?utm_source=x', 'alpha', 1550000100, 't3_a1'),
+            ('https://example.com/other', 'alpha', 1550000000, 'zz')])
+    assert url_index.lookup(connection, 'example.com/a') == \
+        [('alpha', 1550000100, 'a1'), ('beta', 1550000300, 'b2')]
+    assert url_index.first_seen(connection, 'https://example.com/a/') == \
+        ('alpha', 1550000100, 'a1')
+    assert url_index.lookup(connection, 'example.com/missing') == []
+    assert url_index.first_seen(connection, 'example.com/missing') is None
+
+
+def test_adding_again_keeps_postings_once(connection):
+    posts = [('example.com/a', 'alpha', 1550000100, 'a1')]
+    with connection:
+        url_index.add_posts(connection, posts)
+        url_index.add_posts(connection, posts +
+            [('example.com/a', 'beta', 1550000000, 'b1')])
+    assert url_index.lookup(connection, 'example.com/a') == \
+        [('beta', 1550000000, 'b1'), ('alpha', 1550000100, 'a1')]
+
+
+def test_cascade_and_spread(connection):
+    with connection:
+        url_index.add_posts(connection, [
+            ('example.com/a', 'gamma', 1550000900, 'c1'),
+            ('example.com/a', 'alpha', 1550000100, 'a1'),
+            ('example.com/a', 'beta', 1550000500, 'b1'),
+            ('example.com/a', 'beta', 1550000700, 'b2')])
+    assert url_index.cascade(connection, 'example.com/a') == \
+        [('alpha', 1550000100), ('beta', 1550000500), ('gamma', 1550000900)]
+    assert url_index.spread(connection, 'www.example.com/a', 'beta') == \
+        [(1550000500, 'b1'), (1550000700, 'b2')]
+    assert url_index.spread(connection, 'example.com/a', 'beta',
+        start = 1550000600) == [(1550000700, 'b2')]
+
+
+def test_hash_collision_is_not_a_match(connection):
+    with connection:
+        url_index.add_posts(connection,
+            [('example.com/a', 'alpha', 1550000100, 'a1')])
+        # another canonical url stored under the same hash
+        connection.execute('UPDATE url_index SET canonical = ?',
+            ['example.com/b'])
+    assert url_index.lookup(connection, 'example.com/a') == []
+
+
+def test_index_skips_posts_without_date(connection):
+    with connection:
+        url_index.add_posts(connection, [
+            ('https://example.com/a', 'alpha', None, 'abc'),
+            ('https://www.example.com/a/', 'beta', 1550000000, 'abd')])
+    assert url_index.lookup(connection, 'example.com/a') == \
+        [('beta', 1550000000, 'abd')]
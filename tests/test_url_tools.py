@@ -0,0 +1,200 @@
+'''
+Tests for url_tools.follow_redirects_many and prefetch_redirects against a
+local HTTP redirect server
+'''
+
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import combine
+import domain_cache
+import negative_cache
+import url_tools
+
+
+class RedirectHandler(BaseHTTPRequestHandler):
+    '''
+    /chain/N redirects to /chain/N-1 until /chain/0, /loop redirects to
+    itself, /slow never answers in time and /hold answers after a short
+    wait while counting how many requests are open at once; any other path
+    answers 200 straight away. Every request is recorded in server.requests
+    as (method, path).
+    '''
+    def do_HEAD(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path))
+        if self.path.startswith('/chain/'):
+            hops = int(self.path.split('/')[2])
+            if hops > 0:
+                return self.redirect(f'/chain/{hops - 1}')
+        elif self.path == '/loop':
+            return self.redirect('/loop')
+        elif self.path == '/slow':
+            time.sleep(3)
+        elif self.path.startswith('/hold'):
+            with server.lock:
+                server.open_requests += 1
+                server.most_open = max(server.most_open, server.open_requests)
+            time.sleep(0.2)
+            with server.lock:
+                server.open_requests -= 1
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    # answered alike, so a GET shows up in server.requests rather than as a
+    # failed transfer
+    do_GET = do_HEAD
+
+    def redirect(self, location):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    '''
+    Starts the redirect server, with fresh circuit breakers so that failures
+    in one test cannot open the host's breaker for the next.
+    '''
+    negative_cache._breakers.clear()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RedirectHandler)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.open_requests = 0
+    httpd.most_open = 0
+    httpd.requests = []
+    threading.Thread(target = httpd.serve_forever, daemon = True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def base_url(httpd):
+    return f'http://127.0.0.1:{httpd.server_address[1]}'
+
+
+def closed_port():
+    '''
+    Finds a local port with nothing listening on it.
+    '''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_follows_redirect_chain(server):
+    url = base_url(server) + '/chain/3'
+    results = url_tools.follow_redirects_many([url])
+    assert results == {url: (base_url(server) + '/chain/0', True)}
+    # every hop is a HEAD request, no page bodies are fetched
+    assert server.requests == [('HEAD', f'/chain/{hops}')
+        for hops in (3, 2, 1, 0)]
+
+
+def test_hop_cap(server):
+    url = base_url(server) + '/chain/5'
+    errors = {}
+    results = url_tools.follow_redirects_many([url], max_redirects = 2,
+        errors = errors)
+    assert results[url] == (url, False)
+    assert errors == {url: 'too_many_redirects'}
+
+
+def test_redirect_loop_gives_up(server):
+    url = base_url(server) + '/loop'
+    errors = {}
+    results = url_tools.follow_redirects_many([url], errors = errors)
+    assert results[url][1] is False
+    assert errors[url] == 'too_many_redirects'
+
+
+def test_timeout(server):
+    url = base_url(server) + '/slow'
+    errors = {}
+    start = time.monotonic()
+    results = url_tools.follow_redirects_many([url], max_attempts = 1,
+        timeout_len = 1, errors = errors)
+    assert results[url] == (url, False)
+    assert errors == {url: 'timeout'}
+    assert time.monotonic() - start < 2.5
+
+
+def test_per_host_limit(server):
+    urls = [base_url(server) + f'/hold/{i}' for i in range(12)]
+    results = url_tools.follow_redirects_many(urls, max_in_flight = 10,
+        max_per_host = 2)
+    assert all(success for _, success in results.values())
+    assert server.most_open == 2
+
+
+def test_duplicates_followed_once(server):
+    url = base_url(server) + '/chain/1'
+    results = url_tools.follow_redirects_many([url, url, url])
+    assert list(results) == [url]
+    # one request per hop, not one per copy of the url
+    assert server.requests == [('HEAD', '/chain/1'), ('HEAD', '/chain/0')]
+
+
+def test_breaker_stops_transfers_to_failing_host(server):
+    # hosts are keyed without their port, so the dead port and the server
+    # share 127.0.0.1's breaker
+    dead = [f'http://127.0.0.1:{closed_port()}/{i}' for i in range(7)]
+    live = base_url(server) + '/chain/0'
+    errors = {}
+    results = url_tools.follow_redirects_many(dead + [live],
+        max_in_flight = 1, max_attempts = 1, errors = errors)
+    threshold = url_tools.HOST_BREAKER_THRESHOLD
+    assert [errors[url] for url in dead] == ['connect'] * threshold + \
+        ['circuit_open'] * (len(dead) - threshold)
+    assert results[live] == (live, False) and errors[live] == 'circuit_open'
+    assert server.requests == []
+    assert negative_cache.open_breakers() == ['http://127.0.0.1']
+
+
+def test_priority_host_starts_first(server):
+    # localhost and 127.0.0.1 are the same server but different hosts
+    port = server.server_address[1]
+    urls = [f'http://127.0.0.1:{port}/page/{i}' for i in range(4)] + \
+        [f'http://localhost:{port}/page/first']
+    results = url_tools.follow_redirects_many(urls, max_in_flight = 1,
+        priority = lambda host: host == 'localhost')
+    assert all(success for _, success in results.values())
+    assert [path for _, path in server.requests] == \
+        ['/page/first'] + [f'/page/{i}' for i in range(4)]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    path = str(tmp_path / 'domain_cache.sql')
+    combine.migrate(path, combine.DOMAIN_CACHE_MIGRATIONS)
+    cache = domain_cache.DomainCache(path)
+    yield cache
+    cache.close()
+
+
+@pytest.mark.parametrize('samples', [url_tools.NEVER_REDIRECT_SAMPLES,
+    url_tools.NEVER_REDIRECT_SAMPLES - 1])
+def test_never_redirecting_host_skipped(server, cache, samples):
+    seen = [url_tools.clean_url(base_url(server) + f'/page/{i}')
+        for i in range(samples)]
+    cache.add_redirects([(url, 'http://' + url, True) for url in seen])
+    url = url_tools.clean_url(base_url(server) + '/page/new')
+    assert url_tools.prefetch_redirects([url], cache = cache) == \
+        {url: 'http://' + url}
+    if samples >= url_tools.NEVER_REDIRECT_SAMPLES:
+        assert server.requests == []
+    else:
+        assert server.requests == [('HEAD', '/page/new')]
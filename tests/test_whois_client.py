@@ -0,0 +1,101 @@
+'''
+Tests for whois_client.WhoisClient against a local TCP stub server
+'''
+
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+import negative_cache
+import whois_client
+
+
+class StubHandler(socketserver.StreamRequestHandler):
+    '''
+    Answers each query line with a canned ARIN style response, holding the
+    connection open briefly so concurrent queries overlap.
+    '''
+    def handle(self):
+        server = self.server
+        query = self.rfile.readline().decode('utf-8').strip()
+        with server.lock:
+            server.queries.append((query, time.monotonic()))
+            server.open_connections += 1
+            server.most_open = max(server.most_open, server.open_connections)
+        time.sleep(0.05)
+        self.wfile.write(('# ARIN WHOIS data\n'
+            f'NetRange:       {query.split()[-1]} - 8.8.8.255\n'
+            'OrgName:        Société Exemple\n').encode('utf-8'))
+        with server.lock:
+            server.open_connections -= 1
+
+
+@pytest.fixture
+def stub():
+    negative_cache._breakers.clear()
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.queries = []
+    server.open_connections = 0
+    server.most_open = 0
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def closed_port():
+    '''
+    Finds a local port with nothing listening on it.
+    '''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_query_returns_decoded_text(stub):
+    client = whois_client.WhoisClient('127.0.0.1', stub.server_address[1])
+    response = client.query('n + 8.8.8.8')
+    assert 'NetRange:       8.8.8.8 - 8.8.8.255' in response
+    assert 'Société Exemple' in response
+    assert stub.queries[0][0] == 'n + 8.8.8.8'
+
+
+def test_query_many_is_concurrent_and_rate_limited(stub):
+    client = whois_client.WhoisClient('127.0.0.1', stub.server_address[1],
+        max_connections = 4, rate = 40)
+    queries = [f'n + 10.0.0.{i}' for i in range(12)]
+    responses = client.query_many(queries + queries[:3])
+    assert list(responses) == queries
+    assert all('OrgName' in text for text in responses.values())
+    assert len(stub.queries) == 12
+    assert 1 < stub.most_open <= 4
+    starts = sorted(start for _, start in stub.queries)
+    # 12 queries at 40 a second take at least 11 intervals of 1 / 40 s
+    assert starts[-1] - starts[0] >= 0.8 * 11 / 40
+
+
+def test_network_error_maps_to_none():
+    negative_cache._breakers.clear()
+    client = whois_client.WhoisClient('127.0.0.1', closed_port(),
+        rate = 1000)
+    assert client.query_many(['n + 8.8.8.8']) == {'n + 8.8.8.8': None}
+    with pytest.raises(OSError):
+        client.query('n + 8.8.8.8')
+
+
+def test_breaker_stops_queries_to_a_dead_server():
+    negative_cache._breakers.clear()
+    client = whois_client.WhoisClient('127.0.0.1', closed_port(),
+        rate = 1000)
+    for _ in range(client.breaker.threshold):
+        with pytest.raises(ConnectionRefusedError):
+            client.query('n + 8.8.8.8')
+    with pytest.raises(negative_cache.CircuitOpenError):
+        client.query('n + 8.8.8.8')
@@ -0,0 +1,143 @@
+'''
+This file finds and normalizes the urls in reddit posts, and is shared by
+scraper.py and url_tools.py
+'''
+
+import re
+
+#a markdown link '(http...)' in post text, capturing its domain as it goes
+TEXT_LINK = re.compile(r'\((https?://(?:[-\w.]|%[\da-fA-F]{2})+)[^\s]*\)')
+#a bare link in a post's url field, capturing its domain as it goes
+MEDIA_LINK = re.compile(r'(https?://(?=\S)(?:[-\w.]|%[\da-fA-F]{2})*)\S*')
+ANCHOR = re.compile(r'#.*')
+TRAILING_SLASH = re.compile(r'/$')
+PROTOCOL = re.compile(r'https?://')
+HOST = re.compile(r'(?:[a-zA-Z]+://)?([^/:?#]*)')
+EFFECTIVE_DOMAIN = re.compile(r'(?:/+|^)([\w\.]*?)(?=/|$)')
+PARENS = str.maketrans('', '', '()')
+
+
+def is_reddit(link):
+    '''
+    Checks whether a link points back to reddit itself.
+
+    Input:
+        link: (str) url
+
+    Output:
+        (bool) True for redd.it and reddit.com links
+    '''
+    return 'redd.it' in link or 'reddit.com' in link
+
+
+def text_links(text):
+    '''
+    Finds the markdown links in a post's text in one pass.
+
+    Input:
+        text: (str) post selftext
+
+    Output:
+        (list of tuples) (url, domain) pairs, where domain keeps the transfer
+        protocol, e.g. ('https://a.com/b', 'https://a.com')
+    '''
+    return [(match.group(0)[1:-1].translate(PARENS), match.group(1))
+        for match in TEXT_LINK.finditer(text)]
+
+
+def media_links(url_field):
+    '''
+    Finds the links in a post's url field in one pass.
+
+    Input:
+        url_field: (str) post url
+
+    Output:
+        (list of tuples) (url, domain) pairs, see text_links
+    '''
+    return [(match.group(0), match.group(1))
+        for match in MEDIA_LINK.finditer(url_field)]
+
+
+def post_links(post):
+    '''
+    Finds every non-reddit link in a post.
+
+    Input:
+        post: (dict) Pushshift submission with 'url' and optionally
+            'selftext'
+
+    Output:
+        (list of tuples) (url, domain, url type) with url type 'text' or
+        'media'
+    '''
+    links = []
+    if 'selftext' in post:
+        links += [(link, domain, 'text')
+            for link, domain in text_links(post['selftext'])
+            if not is_reddit(link)]
+    links += [(link, domain, 'media')
+        for link, domain in media_links(post['url']) if not is_reddit(link)]
+    return links
+
+
+def distill(url):
+    '''
+    Removes anchors, a trailing slash and transfer protocols from a url.
+
+    Input:
+        url: (str) url to distill
+
+    Output:
+        (str) distilled url
+    '''
+    distilled = ANCHOR.sub('', url)
+    distilled = TRAILING_SLASH.sub('', distilled)
+    return PROTOCOL.sub('', distilled)
+
+
+def clean(url):
+    '''
+    Distills a url and adds a 'www.' prefix to bare domains, which is the form
+    urls are stored in within the redir cache.
+
+    Input:
+        url: (str) url to clean
+
+    Output:
+        (str) cleaned url
+    '''
+    url = distill(url)
+    if url.count('.') == 1:
+        url = 'www.' + url
+    return url
+
+
+def host(url):
+    '''
+    Returns the host portion of a url, with or without a transfer protocol.
+
+    Input:
+        url: (str) url to parse
+
+    Output:
+        (str) host name, lowercased
+    '''
+    return HOST.match(url).group(1).lower()
+
+
+def effective_domain(eff_url):
+    '''
+    Pulls the domain out of an effective (redirected) url. Bare domains get
+    a 'www.' prefix.
+
+    Input:
+        eff_url: (str) effective url
+
+    Output:
+        (str) domain
+    '''
+    domain = EFFECTIVE_DOMAIN.search(eff_url).group(1)
+    if eff_url.count('.') == 1:
+        domain = 'www.' + domain
+    return domain
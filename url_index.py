@@ -0,0 +1,238 @@
+'''
+This file keeps an index of where every url was posted: each canonical url is
+hashed to a 64 bit key that maps to a packed list of (subreddit, post date,
+post id) postings. combine.py adds to it as urls are written, and the
+queries here answer spread, first-seen and cascade questions with one keyed
+lookup per url.
+'''
+
+import re
+import struct
+import hashlib
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+# query parameters that only track where a click came from
+TRACKING_PARAM = re.compile(r'utm_.*|fbclid|gclid|dclid|msclkid|mc_eid', re.I)
+# one posting: subreddit id, post date (unix seconds), post id (base 36)
+POSTING = struct.Struct('<IqQ')
+
+get_postings_str = '''SELECT canonical, postings FROM url_index
+    WHERE url_hash = ?'''
+set_postings_str = '''INSERT OR REPLACE INTO url_index
+    (url_hash, canonical, postings) VALUES (?, ?, ?)'''
+subreddit_insert_str = '''INSERT OR IGNORE INTO url_index_subreddits
+    (subreddit) VALUES (?)'''
+subreddit_ids_str = 'SELECT subreddit_id, subreddit FROM url_index_subreddits'
+
+
+def canonical_url(url):
+    '''
+    Reduces a url to the form two posts of the same page share: no transfer
+    protocol, 'www.', fragment, trailing slash or tracking parameters, and a
+    lowercased host.
+
+    Input:
+        url: (str) url as posted
+
+    Output:
+        (str) canonical url
+    '''
+    parts = urlsplit(url.strip() if '://' in url else '//' + url.strip())
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    query = urlencode([(key, value) for key, value in
+        parse_qsl(parts.query, keep_blank_values = True)
+        if not TRACKING_PARAM.fullmatch(key)])
+    canonical = host + parts.path.rstrip('/')
+    if query:
+        canonical += '?' + query
+    return canonical
+
+
+def url_hash(canonical):
+    '''
+    Hashes a canonical url to a signed 64 bit int, which SQLite stores as the
+    url_index rowid.
+
+    Input:
+        canonical: (str) canonical url from canonical_url
+
+    Output:
+        (int) hash
+    '''
+    digest = hashlib.blake2b(canonical.encode('utf-8'), digest_size = 8)
+    return int.from_bytes(digest.digest(), 'big', signed = True)
+
+
+def post_number(post_id):
+    '''
+    Converts a reddit base 36 post id, with or without its 't3_' prefix, to
+    an int. Ids that are not base 36 map to 0.
+    '''
+    if post_id is None:
+        return 0
+    post_id = str(post_id)
+    if post_id.startswith('t3_'):
+        post_id = post_id[3:]
+    try:
+        return int(post_id, 36)
+    except ValueError:
+        return 0
+
+
+def post_id_str(number):
+    '''
+    Converts a post number from post_number back to a base 36 post id.
+    '''
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    post_id = ''
+    while number:
+        number, digit = divmod(number, 36)
+        post_id = digits[digit] + post_id
+    return post_id or '0'
+
+
+def unpack(postings):
+    '''
+    Splits a postings blob into (subreddit id, post date, post number)
+    tuples.
+    '''
+    return list(POSTING.iter_unpack(postings))
+
+
+def subreddit_ids(connection, subreddits = ()):
+    '''
+    Gives the ids of subreddits in the index, adding any that are new.
+
+    Inputs:
+        connection: (sqlite3.Connection) connection to analysis sql
+        subreddits: (iterable of strs) subreddits that must have an id
+
+    Output:
+        (dict) maps subreddit names to ids
+    '''
+    connection.executemany(subreddit_insert_str,
+        [(subreddit,) for subreddit in set(subreddits)])
+    return {name: id_ for id_, name in connection.execute(subreddit_ids_str)}
+
+
+def add_posts(connection, posts):
+    '''
+    Adds posts to the index within the caller's transaction. A url's
+    postings are read and rewritten once per call, postings already in the
+    index are skipped, and each list is kept in post date order. Posts
+    without a post date cannot be placed in that order and are left out.
+
+    Inputs:
+        connection: (sqlite3.Connection) connection to analysis sql
+        posts: (iterable of tuples) (url, subreddit, post date, post id)
+    '''
+    posts = [post for post in posts if post[2] is not None]
+    if not posts:
+        return
+    ids = subreddit_ids(connection, [post[1] for post in posts])
+    new = {}
+    for url, subreddit, post_date, post_id in posts:
+        canonical = canonical_url(url)
+        entry = new.setdefault(url_hash(canonical), (canonical, set()))
+        entry[1].add((ids[subreddit], int(post_date), post_number(post_id)))
+    rows = []
+    for key, (canonical, postings) in new.items():
+        found = connection.execute(get_postings_str, [key]).fetchone()
+        if found is not None:
+            postings.update(unpack(found[1]))
+        postings = sorted(postings,
+            key = lambda posting: (posting[1], posting[0], posting[2]))
+        rows.append((key, canonical,
+            b''.join(POSTING.pack(*posting) for posting in postings)))
+    connection.executemany(set_postings_str, rows)
+
+
+def lookup(connection, url):
+    '''
+    Finds every post of a url, in any form that has the same canonical url.
+
+    Inputs:
+        connection: (sqlite3.Connection) connection to analysis sql
+        url: (str) url to look up
+
+    Output:
+        (list of tuples) (subreddit, post date, post id), oldest first
+    '''
+    canonical = canonical_url(url)
+    found = connection.execute(get_postings_str,
+        [url_hash(canonical)]).fetchone()
+    if found is None or found[0] != canonical:
+        return []
+    names = dict(connection.execute(subreddit_ids_str).fetchall())
+    return [(names[subreddit_id], post_date, post_id_str(number))
+        for subreddit_id, post_date, number in unpack(found[1])]
+
+
+def first_seen(connection, url):
+    '''
+    Finds the earliest post of a url.
+
+    Output:
+        (tuple, or None) (subreddit, post date, post id), None if the url
+        was never indexed
+    '''
+    postings = lookup(connection, url)
+    return postings[0] if postings else None
+
+
+def cascade(connection, url):
+    '''
+    Orders the subreddits a url was posted in by when it first appeared in
+    each, which is the path it spread along.
+
+    Output:
+        (list of tuples) (subreddit, first post date), earliest first
+    '''
+    firsts = {}
+    for subreddit, post_date, _ in lookup(connection, url):
+        firsts.setdefault(subreddit, post_date)
+    return list(firsts.items())
+
+
+def spread(connection, url, subreddit, start = None, end = None):
+    '''
+    Finds the posts of a url on one subreddit within a time window, e.g. to
+    check whether a url from a quarantined subreddit reached a neighbour.
+
+    Inputs:
+        connection: (sqlite3.Connection) connection to analysis sql
+        url: (str) url to look up
+        subreddit: (str) subreddit to look in
+        start: (int) earliest post date, unix seconds, None for no limit
+        end: (int) latest post date, unix seconds, None for no limit
+
+    Output:
+        (list of tuples) (post date, post id) of matching posts
+    '''
+    return [(post_date, post_id) for name, post_date, post_id
+        in lookup(connection, url) if name == subreddit and
+        (start is None or post_date >= start) and
+        (end is None or post_date <= end)]
+
+
+def backfill(connection, sql_path):
+    '''
+    Indexes the urls of a scraper database that are already in analysis_urls,
+    e.g. those written before the index existed. Safe to repeat.
+
+    Inputs:
+        connection: (sqlite3.Connection) connection to analysis sql
+        sql_path: (str) path to a subreddit (or consolidated) sql database
+    '''
+    connection.execute('ATTACH DATABASE ? AS scraped', [sql_path])
+    try:
+        posts = connection.execute('''
+            SELECT u.url_text, u.subreddit_name, u.post_date, u.post_id
+            FROM scraped.urls AS u INNER JOIN analysis_urls AS a
+            ON a.url_id = u.url_id''').fetchall()
+        with connection:
+            add_posts(connection, posts)
+    finally:
+        connection.execute('DETACH DATABASE scraped')
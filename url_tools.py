@@ -1,16 +1,82 @@
 import os
-import subprocess
 import re
+import collections
+import functools
 from nslookup import Nslookup
+import dns.exception
+import dns.resolver
 import pycurl
 import certifi
-import sqlite3
 import combine
+import domain_cache
+import negative_cache
+import whois_client
+import url_extract
 import pandas as pd
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+#using cloudflare's public dns resolver by default
+DNS_SERVERS = ['1.1.1.1']
+_resolvers = {}
+_resolvers_lock = threading.Lock()
+#number of urls and effective urls whose cleaned form is kept in memory
+URL_MEMO_SIZE = 65536
+
+#one whois line: either an RWhois 'network:Key:value' line, or 'Key: value'.
+#Lines starting with '#' or '%' are comments (ARIN and RIPE/APNIC style)
+WHOIS_LINE = re.compile(
+    r'(?![#%])(?:(?:network|org):([\w-]+)(?:;\w+)?:|([^:\n]*):)\s*(.*)')
+WHOIS_REFERRAL = re.compile(r'(r?whois)://([^:/\s]+)(?::(\d+))?')
+#RIPE/APNIC and RWhois field names, mapped to their ARIN equivalents
+WHOIS_ALIASES = {
+    'inetnum': 'NetRange', 'inet6num': 'CIDR', 'IP-Network': 'CIDR',
+    'netname': 'NetName', 'Network-Name': 'NetName',
+    'org-name': 'OrgName', 'Org-Name': 'OrgName',
+    'country': 'Country', 'Country-Code': 'Country',
+    'city': 'City', 'City': 'City',
+    'State': 'StateProv',
+    'created': 'RegDate', 'Created': 'RegDate',
+}
+#fields that ip_whois always needs, whatever the caller asks for
+WHOIS_BLOCK_KEYS = {'NetRange', 'CIDR', 'ReferralServer'}
+#fields of an ARIN response that describe the network block and its holder.
+#When ARIN refers a block to another registry these are ARIN's entry for the
+#registry's whole allocation, so the referred response replaces them
+WHOIS_REFERRED_KEYS = {'NetRange', 'CIDR', 'OrgName', 'City', 'StateProv',
+    'Country', 'RegDate'}
+#fields only some responses have, which parse_lines does not wait for before
+#it stops reading. ARIN lists ReferralServer below its network's NetRange, so
+#it has already been read by the time the NetRange is found
+WHOIS_OPTIONAL_KEYS = {'ReferralServer'}
+#most redirect hops followed for one url
+MAX_REDIRECTS = 10
+#successful lookups a host needs, none of them redirected, before its urls
+#skip following redirects
+NEVER_REDIRECT_SAMPLES = 5
+#url shortening services, whose urls always redirect and are followed first
+SHORTENERS = frozenset(['bit.ly', 't.co', 'goo.gl', 'tinyurl.com', 'ow.ly',
+    'buff.ly', 'is.gd', 'dlvr.it', 'ift.tt', 'youtu.be', 'amzn.to', 'fb.me',
+    'trib.al', 'lnkd.in', 'wp.me', 'tiny.cc', 'cutt.ly', 'rebrand.ly',
+    'shorturl.at', 'bl.ink', 'rb.gy', 'po.st', 'redd.it'])
+#curl error codes, mapped to the error classes in negative_cache.FAILURE_TTLS
+CURL_ERRORS = {
+    pycurl.E_COULDNT_RESOLVE_HOST: 'dns',
+    pycurl.E_COULDNT_CONNECT: 'connect',
+    pycurl.E_OPERATION_TIMEDOUT: 'timeout',
+    pycurl.E_ABORTED_BY_CALLBACK: 'timeout',
+    pycurl.E_TOO_MANY_REDIRECTS: 'too_many_redirects',
+    pycurl.E_SSL_CONNECT_ERROR: 'tls',
+    pycurl.E_PEER_FAILED_VERIFICATION: 'tls',
+}
+#failures in a row that open the circuit breaker of a web host, and of a set
+#of DNS servers
+HOST_BREAKER_THRESHOLD = 5
+DNS_BREAKER_THRESHOLD = 20
 
 def url_to_ip(url, domain_cache_path = 'domain_cache.sql',
-    log_file_path = 'cache_log.txt', test = False):
+    log_file_path = 'cache_log.txt', test = False, cache = None):
     '''
     Takes in urls, follows any redirects, and uses nslookup to find all IP
     addresses that are associated with the domain of the redirected url. 
@@ -21,39 +87,30 @@ def url_to_ip(url, domain_cache_path = 'domain_cache.sql',
     Input:
         url: (str) url to process
         domain_cache_path: (str) path to location of domain sql cache
+        cache: (DomainCache, or None) open cache to use, if None the shared
+            cache for domain_cache_path is used
     
     Output:
         (dict) associating domain names with their associated IP addresses
     '''
-    #using cloudflare's public dns resolver
-    dns_query = Nslookup(dns_servers=["1.1.1.1"])
-    
-    connection = sqlite3.connect(domain_cache_path)
-    cursor = connection.cursor()
+    dns_query = get_resolver()
+    if cache is None:
+        cache = domain_cache.get_cache(domain_cache_path)
 
     if test:
         print('Processing url: ' + str(url))
-    #Defining sql queries for cache lookup and insertion
-    dom_insert_str = "INSERT INTO domains (domain, ip) VALUES (:dom, :ip)" 
-    dom_check_str = "SELECT * from domains WHERE domain == :dom"
-    redir_insert_str = '''INSERT INTO redir (url, eff_url, success) VALUES 
-                          (:url, :eff_url, :success)''' 
-    redir_check_str = "SELECT * from redir WHERE url == :url"
 
     #Clean up URL
-    url = distill_url(url)
-    if len(re.findall('\.', url)) == 1:
-        url = 'www.' + url
+    url = clean_url(url)
 
     #Find redirect (use cache if already seen)
-    cached_redir = cursor.execute(redir_check_str, {'url':url}).fetchall()
-    if len(cached_redir) == 1:
-        eff_url = cached_redir[0][1]
-    else:
-        eff_url, success = follow_redirects(url)
-        cursor.execute(redir_insert_str,
-            {'url':url, 'eff_url':eff_url, 'success':success})
-        connection.commit()
+    eff_url = cache.get_redirect(url)
+    if eff_url is None:
+        if cache.never_redirects(url_host(url), NEVER_REDIRECT_SAMPLES):
+            eff_url, success = ('http://' + url, True)
+        else:
+            eff_url, success = follow_redirects(url)
+        cache.add_redirect(url, eff_url, success)
     if test:
         if eff_url is not None:
             print('\'---> Redirected url: ' + str(url))
@@ -61,89 +118,358 @@ def url_to_ip(url, domain_cache_path = 'domain_cache.sql',
             print('No response from remote server, using original url: ' + url)
 
     #Find ip addresses associated with domain (use cache if already seen)
-    domain = re.search('(?:/+|^)([\w\.]*?)(?=/|$)', eff_url).groups()[0]
-    if len(re.findall('\.', eff_url)) == 1:
-        domain = 'www.' + domain
-    cached_result = \
-        cursor.execute(dom_check_str, {'dom':domain}).fetchall()
-    if len(cached_result) > 0:
-        ip_cache = [ip for (dom, ip) in cached_result]
-        connection.close()
+    domain = effective_domain(eff_url)
+    ip_cache = cache.get_ips(domain)
+    if ip_cache is not None:
         return (domain, ip_cache)
     else:
-        ip_result = dns_query.dns_lookup(domain).answer
+        ip_result, error = dns_answer(dns_query, domain)
         if ip_result == []:
             ip_result = [None]
-        for ip in ip_result:
-            cursor.execute(dom_insert_str, {'dom':domain, 'ip':ip})
-        connection.commit()
-        connection.close()
+        cache.add_ips(domain, ip_result, error)
         return (domain, ip_result)
 
 
-def ip_whois(ips, max_attempts = 3, test = False):
+def dns_answer(dns_query, domain):
+    '''
+    Looks up the A records of a domain, telling apart the ways a lookup can
+    come back empty.
+
+    Inputs:
+        dns_query: (Nslookup) resolver, see get_resolver()
+        domain: (str) domain name
+
+    Output:
+        (tuple) (list of IP addresses, error class), where the error class is
+        None if the domain resolved, 'nxdomain' or 'no_answer' if the servers
+        said it has no addresses, and 'server' if they did not answer
+    '''
+    try:
+        answer = dns_query.dns_resolver.resolve(domain, rdtype = 'A',
+            tcp = dns_query.tcp)
+    except dns.resolver.NXDOMAIN:
+        return ([], 'nxdomain')
+    except dns.resolver.NoAnswer:
+        return ([], 'no_answer')
+    except dns.exception.DNSException:
+        return ([], 'server')
+    return ([ip.address for ip in answer], None)
+
+
+def get_resolver(dns_servers = None, dns_port = 53):
+    '''
+    Returns the shared Nslookup resolver for a set of upstream DNS servers,
+    creating it on first use. The resolver is safe to share between threads.
+
+    Input:
+        dns_servers: (list of strs, or None) upstream servers to query, if None
+            DNS_SERVERS is used
+        dns_port: (int) port the upstream servers listen on
+
+    Output:
+        (Nslookup) resolver
+    '''
+    if dns_servers is None:
+        dns_servers = DNS_SERVERS
+    key = (tuple(dns_servers), dns_port)
+    with _resolvers_lock:
+        if key not in _resolvers:
+            dns_query = Nslookup(dns_servers = list(dns_servers))
+            dns_query.dns_resolver.port = dns_port
+            _resolvers[key] = dns_query
+        return _resolvers[key]
+
+
+def resolve_domains(domains, dns_servers = None, dns_port = 53,
+    max_in_flight = 32, errors = None):
+    '''
+    Resolves a batch of domains concurrently with one shared resolver. 
+    Duplicate domains are only queried once, and no more than max_in_flight
+    queries are outstanding at a time. Once the servers stop answering, their
+    circuit breaker fails the remaining domains without querying.
+
+    Input:
+        domains: (iterable of strs) domains to resolve
+        dns_servers: (list of strs, or None) upstream servers to query, if None
+            DNS_SERVERS is used
+        dns_port: (int) port the upstream servers listen on
+        max_in_flight: (int) maximum number of queries outstanding at once
+        errors: (dict, or None) if given, filled with the error class of
+            each domain that did not resolve, see dns_answer()
+
+    Output:
+        (dict) mapping each domain to its list of IP addresses, or [None] if
+        the lookup returned no answer
+    '''
+    if dns_servers is None:
+        dns_servers = DNS_SERVERS
+    dns_query = get_resolver(dns_servers, dns_port)
+    breaker = negative_cache.get_breaker(
+        'dns://' + ','.join(dns_servers) + f':{dns_port}',
+        DNS_BREAKER_THRESHOLD)
+    unique_domains = list(dict.fromkeys(domains))
+    if not unique_domains:
+        return {}
+
+    def lookup(domain):
+        if not breaker.allow():
+            return ([], 'circuit_open')
+        ips, error = dns_answer(dns_query, domain)
+        breaker.record(error != 'server')
+        return (ips, error)
+
+    with ThreadPoolExecutor(max_workers = max_in_flight) as pool:
+        answers = list(pool.map(lookup, unique_domains))
+    if errors is not None:
+        errors.update({dom: error for dom, (_, error)
+            in zip(unique_domains, answers) if error is not None})
+    return {dom: (ips if ips else [None])
+        for dom, (ips, _) in zip(unique_domains, answers)}
+
+
+def prefetch_domains(domains, domain_cache_path = 'domain_cache.sql',
+    dns_servers = None, dns_port = 53, max_in_flight = 32, cache = None):
+    '''
+    Resolves every domain in a batch that is not already in the domains cache,
+    or whose failed lookup is due for a retry, using resolve_domains(), and
+    writes all of the results to the cache in a single bulk insert.
+
+    Input:
+        domains: (iterable of strs) domains to resolve
+        domain_cache_path: (str) path to location of domain sql cache
+        dns_servers: (list of strs, or None) upstream servers to query
+        dns_port: (int) port the upstream servers listen on
+        max_in_flight: (int) maximum number of queries outstanding at once
+        cache: (DomainCache, or None) open cache to use, if None the shared
+            cache for domain_cache_path is used
+
+    Output:
+        (int) number of domains that had to be looked up
+    '''
+    if cache is None:
+        cache = domain_cache.get_cache(domain_cache_path)
+    domains = list(dict.fromkeys(domains))
+    cached = cache.get_domains(domains)
+    to_resolve = [dom for dom in domains if dom not in cached]
+    errors = {}
+    resolved = resolve_domains(to_resolve, dns_servers, dns_port,
+        max_in_flight, errors)
+    cache.add_domains(resolved, errors)
+    cache.commit()
+    return len(to_resolve)
+
+
+def ip_whois(ips, max_attempts = 3, test = False,
+    domain_cache_path = 'domain_cache.sql', cache = None, client = None,
+    whois_keys = None):
     '''
     Takes in domains mapped to ip addresses, and generates a dict of dicts, where
     the top level key is an ip adress, and each subkey is an entry in the whois
-    lookup for that ip address.
+    lookup for that ip address. IPs that fall inside a network block already
+    in the whois cache are answered without calling whois, as are IPs whose
+    lookup failed and is not yet due for a retry. Each IP gets up to
+    max_attempts queries, retrying only network errors.
 
     Input:
         ip map: (dict) dict of domains and associated IP addresses
+        max_attempts: (int) queries per IP before giving up
+        domain_cache_path: (str) path to location of domain sql cache
+        cache: (DomainCache, or None) open cache to use, if None the shared
+            cache for domain_cache_path is used
+        client: (WhoisClient, or None) client to query, if None the shared
+            ARIN client is used
+        whois_keys: (list of strs, or None) fields to keep from each lookup,
+            if None every field is kept. Fresh lookups are cached with only
+            these fields (plus the network block), so keep it the same
+            between runs sharing a cache.
     
     Output:
         (dict) with (domain, ip) as key and whois information as key:value pairs
     '''
+    if cache is None:
+        cache = domain_cache.get_cache(domain_cache_path)
+    if client is None:
+        client = whois_client.get_client()
+    if whois_keys is not None:
+        whois_keys = set(whois_keys) | WHOIS_BLOCK_KEYS
     whois_rv = []
-    attempts = 0
     if ips != [None]:
         for ip in ips:
-            while attempts < max_attempts:
-                whois_stdout = subprocess.check_output(\
-                    'whois -h whois.arin.net "n + ' + str(ip) + '"', shell=True)
-                whois_parsed = parse_lines(whois_stdout)
+            whois_parsed = cache.get_whois(ip)
+            if whois_parsed is not None:
+                if test:
+                    print('\tWhoIs cache hit for ip address: ' + ip)
+                whois_rv.append((ip, whois_parsed))
+                continue
+            if cache.failing('whois', ip):
+                if test:
+                    print('\tWhoIs failure cached for ip address: ' + ip)
+                whois_rv.append((ip, None))
+                continue
+            error = None
+            for _ in range(max_attempts):
+                try:
+                    whois_stdout = client.query('n + ' + str(ip))
+                except negative_cache.CircuitOpenError:
+                    error = 'circuit_open'
+                    break
+                except OSError:
+                    error = 'network'
+                    continue
+                whois_parsed = parse_lines(whois_stdout, whois_keys)
+                error = 'unparsed'
                 if whois_parsed is not None:
+                    whois_parsed = follow_referral(ip, whois_parsed,
+                        whois_keys)
+                    cache.add_whois(whois_parsed)
+                    cache.clear_failure('whois', ip)
                     if test:
                         print('\tWhoIs lookup using ip address: ' + ip)
                         for key in ['OrgName', 'Country', 'StateProv', 'City']:
-                            print('\t\t'+ key + " : " + whois_parsed[key])
-                    break
-                else:
-                    attempts += 1
+                            print('\t\t'+ key + " : " +
+                                str(whois_parsed.get(key)))
+                break
+            if whois_parsed is None and error is not None:
+                cache.add_failure('whois', ip, error)
             whois_rv.append((ip, whois_parsed))
     else:
          whois_rv.append((None, None))
     return whois_rv
 
 
-def parse_lines(whois_stdout):
+def prefetch_whois(ips, domain_cache_path = 'domain_cache.sql', cache = None,
+    client = None, whois_keys = None):
+    '''
+    Runs WhoIs lookups concurrently for every IP in a batch that is not
+    already covered by a cached network block, and whose last lookup did not
+    fail too recently, and stores the results (failures included) so that
+    later ip_whois() calls are answered from the cache.
+
+    Input:
+        ips: (iterable of strs) IP addresses, None entries are skipped
+        domain_cache_path: (str) path to location of domain sql cache
+        cache: (DomainCache, or None) open cache to use, if None the shared
+            cache for domain_cache_path is used
+        client: (WhoisClient, or None) client to query, if None the shared
+            ARIN client is used
+        whois_keys: (list of strs, or None) fields to keep, see ip_whois()
+
+    Output:
+        (int) number of IPs that had to be looked up
+    '''
+    if cache is None:
+        cache = domain_cache.get_cache(domain_cache_path)
+    if client is None:
+        client = whois_client.get_client()
+    if whois_keys is not None:
+        whois_keys = set(whois_keys) | WHOIS_BLOCK_KEYS
+    to_query = [ip for ip in dict.fromkeys(ips) if ip is not None and
+        cache.get_whois(ip) is None and not cache.failing('whois', ip)]
+    responses = client.query_many(['n + ' + ip for ip in to_query])
+    for ip in to_query:
+        response = responses['n + ' + ip]
+        whois_parsed = parse_lines(response or '', whois_keys)
+        if whois_parsed is not None:
+            cache.add_whois(follow_referral(ip, whois_parsed, whois_keys))
+            cache.clear_failure('whois', ip)
+        else:
+            cache.add_failure('whois', ip,
+                'network' if response is None else 'unparsed')
+    cache.commit()
+    return len(to_query)
+
+
+def parse_lines(whois_stdout, whois_keys = None):
     '''
     Takes in whois as a block of text and returns a dict with whois info 
-    as key:value pairs
+    as key:value pairs. Reads ARIN, RIPE/APNIC and RWhois style responses in
+    one pass with a precompiled pattern, naming fields by their ARIN
+    equivalents (see WHOIS_ALIASES). When a field repeats, the last value
+    wins, as the most specific network is listed last.
 
     Input:
-        whois_stdout: (str) stdout from whois call in bash
+        whois_stdout: (str) WhoIs response text
+        whois_keys: (set of strs, or None) fields to keep, if None every field
+            is kept. With a key set the response is read from the bottom up
+            and reading stops once every wanted key has been found, not
+            counting WHOIS_OPTIONAL_KEYS.
     
     Output:
         (dict) dict of whois key:value pairs
     '''
+    if isinstance(whois_stdout, bytes):
+        whois_stdout = whois_stdout.decode('utf-8', errors = 'replace')
+    lines = whois_stdout.splitlines()
     line_dict = {}
-    for line in str(whois_stdout).split('\\n'):
-        if re.search(':', line) and not re.match('#', line):
-            field = re.search('.*?(?=:)', line).group()
-            val = re.search('(?<=:)(?:\s*)(.*)', line).groups()[0]
-            if not re.match('Comment:', field):
-                line_dict[field] = val
+    if whois_keys is not None:
+        lines = reversed(lines)
+        remaining = len(set(whois_keys) - WHOIS_OPTIONAL_KEYS)
+    for line in lines:
+        match = WHOIS_LINE.match(line)
+        if match is None:
+            continue
+        rwhois_field, field, val = match.groups()
+        field = rwhois_field or field
+        field = WHOIS_ALIASES.get(field, field)
+        if field == 'Comment':
+            continue
+        if whois_keys is None:
+            line_dict[field] = val
+        elif field in whois_keys and field not in line_dict:
+            line_dict[field] = val
+            if field in WHOIS_OPTIONAL_KEYS:
+                continue
+            remaining -= 1
+            if remaining == 0:
+                break
     if line_dict == {}:
         return None
     return line_dict
 
-def follow_redirects(url, max_attempts = 3, timeout_len = 3):
+def follow_referral(ip, whois_parsed, whois_keys = None):
+    '''
+    Follows a ReferralServer line (whois:// or rwhois://) in an ARIN response
+    to the registry that holds the network's details. The network block and
+    holder come from the referred response alone (see WHOIS_REFERRED_KEYS);
+    other ARIN fields are kept unless the referred response has them too.
+
+    Input:
+        ip: (str) IP address that was looked up
+        whois_parsed: (dict) parsed ARIN response
+        whois_keys: (set of strs, or None) fields to keep, see parse_lines()
+
+    Output:
+        (dict) parsed WhoIs record
+    '''
+    match = WHOIS_REFERRAL.match(whois_parsed.get('ReferralServer', ''))
+    if match is None:
+        return whois_parsed
+    scheme, server, port = match.groups()
+    if port is None:
+        port = 4321 if scheme == 'rwhois' else 43
+    try:
+        referral = whois_client.get_client(server, int(port)).query(ip)
+    except OSError:
+        return whois_parsed
+    referred = parse_lines(referral, whois_keys)
+    if referred is None:
+        return whois_parsed
+    merged = {key: val for key, val in whois_parsed.items()
+        if key not in WHOIS_REFERRED_KEYS}
+    merged.update(referred)
+    merged.pop('ReferralServer', None)
+    return merged
+
+def follow_redirects(url, max_attempts = 3, timeout_len = 3,
+    max_redirects = MAX_REDIRECTS):
     '''
     Takes in a curl and uses cURL to follow it through any potential redirects
-    to arrive at the actual linked url. 
+    to arrive at the actual linked url. Only HEAD requests are sent, so no
+    page bodies are downloaded, and at most max_redirects hops are followed.
 
     Input:
         url: (str) a url to follow redirects
+        max_redirects: (int) most redirect hops to follow
     
     Output:
         (str) the effective url after all redirects
@@ -157,6 +483,8 @@ def follow_redirects(url, max_attempts = 3, timeout_len = 3):
             curl_pointer.setopt(curl_pointer.URL, url)
             curl_pointer.setopt(curl_pointer.CAINFO, certifi.where())
             curl_pointer.setopt(curl_pointer.FOLLOWLOCATION, True)
+            curl_pointer.setopt(curl_pointer.MAXREDIRS, max_redirects)
+            curl_pointer.setopt(curl_pointer.NOBODY, True)
             #To prevent printing and saving of things we aren't interested in
             curl_pointer.setopt(curl_pointer.WRITEFUNCTION, lambda x: None)
             curl_pointer.setopt(curl_pointer.NOPROGRESS, False)
@@ -177,6 +505,279 @@ def follow_redirects(url, max_attempts = 3, timeout_len = 3):
             continue
     return (redirected, success)
 
+def follow_redirects_many(urls, max_in_flight = 50, max_per_host = 4,
+    max_attempts = 3, timeout_len = 3, max_redirects = MAX_REDIRECTS,
+    priority = None, errors = None):
+    '''
+    Batch version of follow_redirects(). Drives many cURL transfers at once
+    through a single pycurl.CurlMulti, reusing a fixed pool of curl handles and
+    capping the number of simultaneous transfers to any one host. Timeouts
+    and HEAD-only requests follow the same rules as follow_redirects(), but
+    only transient errors (see negative_cache.TRANSIENT) are retried, and
+    once a host fails HOST_BREAKER_THRESHOLD times in a row its circuit
+    breaker fails its remaining urls without a transfer. Hosts picked out by
+    priority get free handles before any other host.
+
+    Input:
+        urls: (iterable of strs) urls to follow redirects
+        max_in_flight: (int) maximum number of transfers running at once
+        max_per_host: (int) maximum number of transfers running against a
+            single host at once
+        max_attempts: (int) attempts per url before giving up
+        timeout_len: (int) seconds to wait on a single attempt
+        max_redirects: (int) most redirect hops to follow per url
+        priority: (function, or None) takes a host and returns True for hosts
+            whose urls should be followed first, e.g. is_shortener
+        errors: (dict, or None) if given, filled with the error class of
+            each url that failed, see CURL_ERRORS
+
+    Output:
+        (dict) mapping each url to an (effective url, success) tuple
+    '''
+    results = {}
+    url_errors = {}
+    pending = {}
+    #hosts waiting for a handle, the priority lane is served first
+    lanes = (collections.deque(), collections.deque())
+
+    def queue_host(host):
+        '''
+        Puts a host with queued urls at the back of its lane.
+        '''
+        lanes[0 if priority is not None and priority(host) else 1].append(host)
+
+    for url in urls:
+        if url in results:
+            continue
+        results[url] = (url, False)
+        host = url_host(url)
+        if host not in pending:
+            pending[host] = collections.deque()
+            queue_host(host)
+        pending[host].append((url, 0))
+    if not results:
+        return results
+
+    timeout = datetime.timedelta(seconds = timeout_len)
+    multi = pycurl.CurlMulti()
+    free_handles = []
+    for _ in range(min(max_in_flight, len(results))):
+        curl_pointer = pycurl.Curl()
+        curl_pointer.setopt(curl_pointer.CAINFO, certifi.where())
+        curl_pointer.setopt(curl_pointer.FOLLOWLOCATION, True)
+        curl_pointer.setopt(curl_pointer.MAXREDIRS, max_redirects)
+        curl_pointer.setopt(curl_pointer.NOBODY, True)
+        curl_pointer.setopt(curl_pointer.WRITEFUNCTION, lambda x: None)
+        curl_pointer.setopt(curl_pointer.NOPROGRESS, False)
+        free_handles.append(curl_pointer)
+    active_per_host = collections.Counter()
+    in_flight = 0
+
+    def start_transfers():
+        '''
+        Hands free curl handles to queued urls, round-robin over hosts that
+        are below max_per_host, the priority lane first.
+        '''
+        for host_order in lanes:
+            stalled = 0
+            while free_handles and host_order and stalled < len(host_order):
+                host = host_order.popleft()
+                if active_per_host[host] >= max_per_host:
+                    host_order.append(host)
+                    stalled += 1
+                    continue
+                stalled = 0
+                start_transfer(host)
+
+    def start_transfer(host):
+        '''
+        Starts the next queued url of a host on a free curl handle, unless
+        the host's circuit breaker is open.
+        '''
+        nonlocal in_flight
+        url, attempt = pending[host].popleft()
+        if negative_cache.get_breaker('http://' + host,
+            HOST_BREAKER_THRESHOLD).allow():
+            curl_pointer = free_handles.pop()
+            curl_pointer.setopt(curl_pointer.URL, url)
+            start_time = datetime.datetime.now()
+            curl_pointer.setopt(curl_pointer.XFERINFOFUNCTION,
+                lambda dl_t, dl_d, up_t, up_d, start_time = start_time:
+                curl_progress(dl_t, dl_d, up_t, up_d, start_time, timeout))
+            curl_pointer.job = (url, host, attempt)
+            multi.add_handle(curl_pointer)
+            active_per_host[host] += 1
+            in_flight += 1
+        else:
+            url_errors[url] = 'circuit_open'
+        if pending[host]:
+            queue_host(host)
+        else:
+            del pending[host]
+
+    def finish_transfer(curl_pointer, errno = None):
+        '''
+        Records the outcome of a finished transfer (errno is the curl error
+        code of a failed one), queueing a retry if the attempt failed with a
+        transient error, and returns the handle to the pool.
+        '''
+        nonlocal in_flight
+        url, host, attempt = curl_pointer.job
+        multi.remove_handle(curl_pointer)
+        active_per_host[host] -= 1
+        in_flight -= 1
+        negative_cache.get_breaker('http://' + host,
+            HOST_BREAKER_THRESHOLD).record(errno is None)
+        if errno is None:
+            results[url] = \
+                (curl_pointer.getinfo(curl_pointer.EFFECTIVE_URL), True)
+            url_errors.pop(url, None)
+        else:
+            url_errors[url] = CURL_ERRORS.get(errno, 'error')
+            if url_errors[url] in negative_cache.TRANSIENT and \
+                attempt + 1 < max_attempts:
+                print('Redirect failed (timeout ' + str(timeout_len) +
+                    ' s), making ' + str(max_attempts - attempt) +
+                    ' more attempts.')
+                if host not in pending:
+                    pending[host] = collections.deque()
+                    queue_host(host)
+                pending[host].append((url, attempt + 1))
+        free_handles.append(curl_pointer)
+
+    start_transfers()
+    while in_flight:
+        while True:
+            ret, _ = multi.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        while True:
+            queued, ok_list, err_list = multi.info_read()
+            for curl_pointer in ok_list:
+                finish_transfer(curl_pointer)
+            for curl_pointer, errno, _ in err_list:
+                finish_transfer(curl_pointer, errno)
+            if queued == 0:
+                break
+        start_transfers()
+        if in_flight:
+            multi.select(1.0)
+
+    for curl_pointer in free_handles:
+        curl_pointer.close()
+    multi.close()
+    if errors is not None:
+        errors.update(url_errors)
+    return results
+
+def prefetch_redirects(urls, domain_cache_path = 'domain_cache.sql',
+    max_in_flight = 50, cache = None, min_samples = NEVER_REDIRECT_SAMPLES):
+    '''
+    Follows redirects for every url in a batch that is not already in the
+    redir cache, or whose failed lookup is due for a retry, using
+    follow_redirects_many(), and stores the results so that later url_to_ip()
+    calls are answered from the cache. Urls on hosts the cache has never seen
+    redirect (see DomainCache.never_redirects) skip the network, and url
+    shorteners are followed first.
+
+    Input:
+        urls: (iterable of strs) urls to process
+        domain_cache_path: (str) path to location of domain sql cache
+        max_in_flight: (int) maximum number of transfers running at once
+        cache: (DomainCache, or None) open cache to use, if None the shared
+            cache for domain_cache_path is used
+        min_samples: (int) successful lookups, none redirected, a host needs
+            before its urls skip the network
+
+    Output:
+        (dict) mapping each cleaned url in the batch to its effective url
+    '''
+    if cache is None:
+        cache = domain_cache.get_cache(domain_cache_path)
+    cleaned = {clean_url(url) for url in urls}
+    eff_urls = cache.get_redirects(cleaned)
+    to_fetch = [url for url in cleaned if url not in eff_urls]
+    #urls on hosts that have never redirected resolve to themselves
+    redirected = {url: ('http://' + url, True) for url in to_fetch
+        if cache.never_redirects(url_host(url), min_samples)}
+    errors = {}
+    redirected.update(follow_redirects_many(
+        [url for url in to_fetch if url not in redirected],
+        max_in_flight = max_in_flight, priority = is_shortener,
+        errors = errors))
+    cache.add_redirects([(url, eff_url, success)
+        for url, (eff_url, success) in redirected.items()], errors)
+    cache.commit()
+    eff_urls.update({url: eff_url
+        for url, (eff_url, _) in redirected.items()})
+    return eff_urls
+
+def retry_failures(cache, limit = 500, whois_keys = None):
+    '''
+    Retries a batch of the cached failures whose retry time has passed,
+    longest overdue first. The prefetch functions treat due failures as
+    misses, so they look them up again and store the new results, or push
+    the next retry further back if the lookup fails again.
+
+    Inputs:
+        cache: (DomainCache) open cache
+        limit: (int) most failures to retry
+        whois_keys: (list of strs, or None) fields to keep from WhoIs
+            lookups, see ip_whois()
+
+    Output:
+        (dict) number of lookups retried of each kind
+    '''
+    due = {}
+    for kind, key in cache.due_failures(limit):
+        due.setdefault(kind, []).append(key)
+    if 'redirect' in due:
+        prefetch_redirects(due['redirect'], cache = cache)
+    if 'dns' in due:
+        prefetch_domains(due['dns'], cache = cache)
+    if 'whois' in due:
+        prefetch_whois(due['whois'], cache = cache, whois_keys = whois_keys)
+    return {kind: len(keys) for kind, keys in due.items()}
+
+class RetryWorker(threading.Thread):
+    '''
+    Background thread that runs retry_failures() every interval seconds
+    until stopped, so that failures heal while the pipeline works through
+    other urls instead of only when a url comes up again.
+    '''
+    def __init__(self, cache, interval = 30.0, batch_size = 200,
+        whois_keys = None):
+        '''
+        Inputs:
+            cache: (DomainCache) open cache
+            interval: (float) seconds between batches
+            batch_size: (int) most failures retried per batch
+            whois_keys: (list of strs, or None) fields to keep from WhoIs
+                lookups, see ip_whois()
+        '''
+        super().__init__(daemon = True)
+        self.cache = cache
+        self.interval = interval
+        self.batch_size = batch_size
+        self.whois_keys = whois_keys
+        self.stopped = threading.Event()
+        self.retried = collections.Counter()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.retried.update(retry_failures(self.cache,
+                    self.batch_size, self.whois_keys))
+            except Exception as err:
+                print('Retrying failed lookups failed: ' + repr(err))
+
+    def stop(self):
+        '''
+        Stops the thread once any batch in progress is done.
+        '''
+        self.stopped.set()
+        self.join()
+
 def curl_progress(download_t, download_d, upload_t, upload_d, start_time, timeout):
     '''
     Internal function to curl.execute() - this is called periodically throughout
@@ -198,6 +799,60 @@ def curl_progress(download_t, download_d, upload_t, upload_d, start_time, timeou
     if run_time - start_time > timeout:
         return -1
 
+def is_shortener(host):
+    '''
+    Checks whether a host is a known url shortening service.
+
+    Input:
+        host: (str) host name, as url_host returns it
+
+    Output:
+        (bool) True for hosts in SHORTENERS, with or without 'www.'
+    '''
+    if host.startswith('www.'):
+        host = host[4:]
+    return host in SHORTENERS
+
+def url_host(url):
+    '''
+    Returns the host portion of a url, with or without a transfer protocol.
+
+    Input:
+        url: (str) url to parse
+
+    Output:
+        (str) host name, lowercased
+    '''
+    return url_extract.host(url)
+
+@functools.lru_cache(maxsize = URL_MEMO_SIZE)
+def effective_domain(eff_url):
+    '''
+    Pulls the domain out of an effective (redirected) url, in the form domains
+    are stored in within the domains cache.
+
+    Input:
+        eff_url: (str) effective url
+
+    Output:
+        (str) domain
+    '''
+    return url_extract.effective_domain(eff_url)
+
+@functools.lru_cache(maxsize = URL_MEMO_SIZE)
+def clean_url(url):
+    '''
+    Distills a url and adds a 'www.' prefix to bare domains, which is the form
+    urls are stored in within the redir cache.
+
+    Input:
+        url: (str) url to clean
+
+    Output:
+        (str) cleaned url
+    '''
+    return url_extract.clean(url)
+
 def distill_url(url):
     '''
     Removes anchors and transfer protocols from URLs for matching purposes.
@@ -208,6 +863,4 @@ def distill_url(url):
     Output:
         (str) url without anchor or transfer protocols
     '''
-    distilled = re.sub('#.*', '', url)
-    distilled = re.sub('\/$', '', distilled)
-    return re.sub('https?://', '', distilled)
\ No newline at end of file
+    return url_extract.distill(url)
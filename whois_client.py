@@ -0,0 +1,153 @@
+'''
+This file speaks the WhoIs protocol (RFC 3912, port 43) directly, so lookups
+do not need to spawn the whois binary
+'''
+
+import socket
+import threading
+import time
+import negative_cache
+from concurrent.futures import ThreadPoolExecutor
+
+WHOIS_SERVER = 'whois.arin.net'
+WHOIS_PORT = 43
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def whois_query(query, server = WHOIS_SERVER, port = WHOIS_PORT,
+    timeout = 10):
+    '''
+    Sends one query to a WhoIs server and reads the whole response.
+
+    Inputs:
+        query: (str) query text, e.g. 'n + 8.8.8.8' for ARIN
+        server: (str) WhoIs server host name
+        port: (int) WhoIs server port
+        timeout: (float) seconds to wait on the connection before giving up
+
+    Output:
+        (str) decoded response text
+    '''
+    chunks = []
+    with socket.create_connection((server, port), timeout = timeout) as sock:
+        sock.sendall((query + '\r\n').encode('utf-8'))
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            chunks.append(data)
+    return b''.join(chunks).decode('utf-8', errors = 'replace')
+
+
+class WhoisClient:
+    '''
+    WhoIs client for one server that allows up to max_connections queries to
+    run at once while starting no more than rate queries per second, which
+    keeps us under the server's query limits. Queries go through the
+    server's circuit breaker, so once it stops answering they fail straight
+    away instead of each waiting out the timeout.
+    '''
+    def __init__(self, server = WHOIS_SERVER, port = WHOIS_PORT,
+        max_connections = 8, rate = 10.0, timeout = 10):
+        '''
+        Inputs:
+            server: (str) WhoIs server host name
+            port: (int) WhoIs server port
+            max_connections: (int) maximum number of open connections
+            rate: (float) maximum number of queries started per second
+            timeout: (float) seconds to wait on a connection before giving up
+        '''
+        self.server = server
+        self.port = port
+        self.max_connections = max_connections
+        self.interval = 1 / rate
+        self.timeout = timeout
+        self.connections = threading.BoundedSemaphore(max_connections)
+        self.rate_lock = threading.Lock()
+        self.next_start = time.monotonic()
+        self.breaker = negative_cache.get_breaker(f'whois://{server}:{port}')
+
+    def query(self, query):
+        '''
+        Runs one query, waiting for a free connection and for the rate limit.
+
+        Input:
+            query: (str) query text
+
+        Output:
+            (str) decoded response text; raises CircuitOpenError without
+            querying while the server's breaker is open
+        '''
+        if not self.breaker.allow():
+            raise negative_cache.CircuitOpenError(
+                f'{self.server}:{self.port} is not answering')
+        try:
+            with self.connections:
+                self._wait_turn()
+                response = whois_query(query, self.server, self.port,
+                    self.timeout)
+        except OSError:
+            self.breaker.record(False)
+            raise
+        self.breaker.record(True)
+        return response
+
+    def query_many(self, queries):
+        '''
+        Runs a batch of queries concurrently. Queries that fail with a network
+        error, or are refused by the circuit breaker, map to None.
+
+        Input:
+            queries: (iterable of strs) query texts
+
+        Output:
+            (dict) mapping each query to its response text, or None
+        '''
+        queries = list(dict.fromkeys(queries))
+        if not queries:
+            return {}
+        with ThreadPoolExecutor(max_workers = self.max_connections) as pool:
+            responses = pool.map(self._query_or_none, queries)
+            return dict(zip(queries, responses))
+
+    def _query_or_none(self, query):
+        '''
+        Internal function that runs a query and returns None on a network
+        error instead of raising.
+        '''
+        try:
+            return self.query(query)
+        except OSError:
+            return None
+
+    def _wait_turn(self):
+        '''
+        Internal function that sleeps until this thread may start a query
+        under the rate limit.
+        '''
+        with self.rate_lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def get_client(server = WHOIS_SERVER, port = WHOIS_PORT):
+    '''
+    Returns the shared WhoisClient for a server, creating it on first use so
+    that every caller shares the server's rate limit.
+
+    Inputs:
+        server: (str) WhoIs server host name
+        port: (int) WhoIs server port
+
+    Output:
+        (WhoisClient) shared client
+    '''
+    with _clients_lock:
+        if (server, port) not in _clients:
+            _clients[(server, port)] = WhoisClient(server, port)
+        return _clients[(server, port)]